@@ -7,3 +7,4 @@ Utilities for working with the cameras, servos, and compute on the test stand.
 """
 
 from .mech import _Dynamixel as Servo
+from .mech import Bus, BusManager
@@ -0,0 +1,7 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+Benchmarks for the Dynamixel stack. Each module can be run with ``python -m dragon_stand.bench.<module>``.
+"""
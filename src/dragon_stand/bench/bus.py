@@ -0,0 +1,360 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+End-to-end bus benchmarks: transactions per second, round trip latency, jitter and host CPU time for the operations a
+stand actually performs, measured through :class:`~dragon_stand.mech.bus.Bus` so scheduling is included. Works the
+same against real servos or a :class:`~dragon_stand.sim.BusSimulator`::
+
+    python -m dragon_stand.bench.bus            # against a simulated bus
+    dhs bench --port /dev/ttyUSB0 --ids 1 2 --baudrates 57600 1000000 --output results.json
+
+Every write puts back the value read from the servo before the run so benchmarking leaves the servos as it found
+them.
+"""
+
+import asyncio
+import datetime
+import functools
+import json
+import logging
+import math
+import platform
+import sys
+import time
+import typing
+
+from .._version import __version__
+from ..mech import Bus, Priority, dynamixel_sdk
+
+OPERATIONS: typing.Tuple[str, ...] = (
+    "ping",
+    "read2Byte",
+    "write2Byte",
+    "GroupSyncWrite",
+    "GroupSyncRead",
+    "GroupBulkRead",
+)
+
+TX_ONLY_OPERATIONS: typing.FrozenSet[str] = frozenset({"GroupSyncWrite"})
+"""Operations that get no reply: their latency is the time for the instruction to leave the port, not a round trip."""
+
+DEFAULT_TRANSACTIONS = 200
+DEFAULT_WARMUP = 10
+
+
+class _Registers(typing.NamedTuple):
+    read_address: int
+    write_address: int
+
+
+# bytes of a SYNC_WRITE besides its per-servo parameters: header, ID, length, instruction, address, data length and
+# checksum (before any Protocol 2.0 byte stuffing, so a lower bound)
+_SYNC_WRITE_OVERHEAD = {1.0: 8, 2.0: 14}
+
+# present position is read; a register that does not move the servo (MX moving speed, X position P gain) is written
+_REGISTERS = {1.0: _Registers(36, 32), 2.0: _Registers(132, 84)}
+
+
+class BenchResult(typing.NamedTuple):
+    """
+    Timing of one operation at one baud rate and servo count. Latencies are in milliseconds.
+    """
+
+    operation: str
+    protocol_version: float
+    baudrate: int
+    servos: int
+    transactions: int
+    failures: int
+    seconds: float
+    tx_per_second: float
+    latency_min_ms: float
+    latency_p50_ms: float
+    latency_p90_ms: float
+    latency_p99_ms: float
+    latency_max_ms: float
+    latency_mean_ms: float
+    jitter_ms: float
+    cpu_us_per_tx: float
+
+    @property
+    def tx_only(self) -> bool:
+        return self.operation in TX_ONLY_OPERATIONS
+
+    @property
+    def key(self) -> typing.Tuple[str, int, int]:
+        return (self.operation, self.baudrate, self.servos)
+
+
+def _percentile(ordered: typing.Sequence[float], percentile: float) -> float:
+    if not ordered:
+        return math.nan
+    return ordered[min(len(ordered) - 1, int(round(percentile / 100.0 * (len(ordered) - 1))))]
+
+
+def _operation(
+    bus: Bus, operation: str, device_ids: typing.Sequence[int], values: typing.Mapping[int, int]
+) -> typing.Callable[[int], typing.Any]:
+    """
+    Returns a function taking the transaction number and returning a :data:`~dragon_stand.mech.bus.Transaction` that
+    resolves to the SDK's communication result.
+    """
+    port, ph = bus.port_handler, bus.packet_handler
+    registers = _REGISTERS[ph.getProtocolVersion()]
+
+    if operation == "ping":
+
+        def ping(n: int) -> typing.Any:
+            async def _ping(port: typing.Any, ph: typing.Any) -> int:
+                return int((await ph.pingAsync(port, device_ids[n % len(device_ids)]))[1])
+
+            return _ping
+
+        return ping
+
+    if operation == "read2Byte":
+
+        def read(n: int) -> typing.Any:
+            async def _read(port: typing.Any, ph: typing.Any) -> int:
+                device_id = device_ids[n % len(device_ids)]
+                return int((await ph.read2ByteTxRxAsync(port, device_id, registers.read_address))[1])
+
+            return _read
+
+        return read
+
+    if operation == "write2Byte":
+
+        def write(n: int) -> typing.Any:
+            async def _write(port: typing.Any, ph: typing.Any) -> int:
+                device_id = device_ids[n % len(device_ids)]
+                return int(
+                    (await ph.write2ByteTxRxAsync(port, device_id, registers.write_address, values[device_id]))[0]
+                )
+
+            return _write
+
+        return write
+
+    if operation == "GroupSyncWrite":
+        group: typing.Any = dynamixel_sdk.GroupSyncWrite(port, ph, registers.write_address, 2)
+        for device_id in device_ids:
+            group.addParam(device_id, dynamixel_sdk.packValue(values[device_id], 2))
+    elif operation == "GroupSyncRead":
+        group = dynamixel_sdk.GroupSyncRead(port, ph, registers.read_address, 2)
+        for device_id in device_ids:
+            group.addParam(device_id)
+    elif operation == "GroupBulkRead":
+        group = dynamixel_sdk.GroupBulkRead(port, ph)
+        for device_id in device_ids:
+            group.addParam(device_id, registers.read_address, 2)
+    else:
+        raise ValueError("Unknown operation {}".format(operation))
+
+    async def _group(port: typing.Any, ph: typing.Any) -> int:
+        if operation == "GroupSyncWrite":
+            sent = time.perf_counter()
+            result = int(group.txPacket())
+            if result == dynamixel_sdk.COMM_SUCCESS:
+                # txPacket returns once the OS has the bytes; the write is done when the last of them is on the wire.
+                # flush() blocks until the driver has drained, which not every adapter reports honestly, so also wait
+                # out the packet's own transmit time (blocking too: an event loop timer can overshoot by a millisecond)
+                port.ser.flush()
+                on_wire = port.tx_time_per_byte * (len(group.param) + _SYNC_WRITE_OVERHEAD[ph.getProtocolVersion()])
+                time.sleep(max(0.0, sent + on_wire / 1000.0 - time.perf_counter()))
+            return result
+        return int(await group.txRxPacketAsync())
+
+    return lambda n: _group
+
+
+async def _current_write_values(bus: Bus, device_ids: typing.Sequence[int]) -> typing.Dict[int, int]:
+    address = _REGISTERS[bus.packet_handler.getProtocolVersion()].write_address
+    values = {}
+    for device_id in device_ids:
+        value, result, error = await bus.transact(
+            functools.partial(_read2Byte, dxl_id=device_id, address=address), Priority.DIAGNOSTICS
+        )
+        if result != dynamixel_sdk.COMM_SUCCESS or error != 0:
+            raise RuntimeError(
+                "Servo {} did not answer: {}".format(device_id, bus.packet_handler.getTxRxResult(result))
+            )
+        values[device_id] = value
+    return values
+
+
+async def _read2Byte(port: typing.Any, ph: typing.Any, dxl_id: int, address: int) -> typing.Tuple[int, int, int]:
+    return typing.cast(typing.Tuple[int, int, int], await ph.read2ByteTxRxAsync(port, dxl_id, address))
+
+
+async def measure(
+    bus: Bus,
+    operation: str,
+    device_ids: typing.Sequence[int],
+    transactions: int = DEFAULT_TRANSACTIONS,
+    warmup: int = DEFAULT_WARMUP,
+    values: typing.Optional[typing.Mapping[int, int]] = None,
+) -> BenchResult:
+    """
+    Run ``operation`` ``transactions`` times on an open ``bus``. Single-servo operations take turns across
+    ``device_ids``; group operations address all of them at once.
+
+    CPU time is the event loop thread's own (:func:`time.thread_time_ns`) so an in-process simulator does not count.
+
+    :param values: the current value of the written register per servo, read from the servos if not given.
+    """
+    if values is None:
+        values = await _current_write_values(bus, device_ids)
+    make_transaction = _operation(bus, operation, device_ids, values)
+    for n in range(warmup):
+        await bus.transact(make_transaction(n))
+
+    latencies: typing.List[float] = []
+    failures = 0
+    cpu_started = time.thread_time_ns()
+    started = time.perf_counter_ns()
+    for n in range(transactions):
+        sent = time.perf_counter_ns()
+        result = await bus.transact(make_transaction(n))
+        latencies.append((time.perf_counter_ns() - sent) / 1e6)
+        if result != dynamixel_sdk.COMM_SUCCESS:
+            failures += 1
+    elapsed = (time.perf_counter_ns() - started) / 1e9
+    cpu = (time.thread_time_ns() - cpu_started) / 1e3
+
+    ordered = sorted(latencies)
+    mean = sum(ordered) / len(ordered) if ordered else math.nan
+    jitter = math.sqrt(sum((x - mean) ** 2 for x in ordered) / len(ordered)) if ordered else math.nan
+    return BenchResult(
+        operation=operation,
+        protocol_version=bus.packet_handler.getProtocolVersion(),
+        baudrate=bus.baudrate,
+        servos=len(device_ids),
+        transactions=transactions,
+        failures=failures,
+        seconds=elapsed,
+        tx_per_second=transactions / elapsed if elapsed > 0 else math.nan,
+        latency_min_ms=ordered[0] if ordered else math.nan,
+        latency_p50_ms=_percentile(ordered, 50),
+        latency_p90_ms=_percentile(ordered, 90),
+        latency_p99_ms=_percentile(ordered, 99),
+        latency_max_ms=ordered[-1] if ordered else math.nan,
+        latency_mean_ms=mean,
+        jitter_ms=jitter,
+        cpu_us_per_tx=cpu / transactions if transactions else math.nan,
+    )
+
+
+async def run(
+    bus: Bus,
+    device_ids: typing.Sequence[int],
+    baudrates: typing.Optional[typing.Iterable[int]] = None,
+    servo_counts: typing.Optional[typing.Iterable[int]] = None,
+    operations: typing.Iterable[str] = OPERATIONS,
+    transactions: int = DEFAULT_TRANSACTIONS,
+) -> typing.List[BenchResult]:
+    """
+    Measure every operation at every baud rate (the bus's current rate if none are given) for the first ``n`` of
+    ``device_ids`` for each ``n`` in ``servo_counts`` (all of them if not given). The servos are moved between rates
+    with :meth:`~dragon_stand.mech.bus.Bus.set_baudrate` and put back at the original rate afterwards.
+    """
+    logger = logging.getLogger(__name__)
+    original = bus.baudrate
+    counts = sorted(set(servo_counts or [len(device_ids)]))
+    values = await _current_write_values(bus, device_ids)
+    results = []
+    try:
+        for baudrate in baudrates or [original]:
+            if baudrate != bus.baudrate and not await bus.set_baudrate(baudrate, device_ids):
+                logger.warning("Could not move the bus to {} baud; skipping it".format(baudrate))
+                continue
+            for count in counts:
+                for operation in operations:
+                    result = await measure(bus, operation, device_ids[:count], transactions, values=values)
+                    logger.info(format_result(result))
+                    results.append(result)
+    finally:
+        if bus.baudrate != original and not await bus.set_baudrate(original, device_ids):
+            logger.error("Could not put the bus back at {} baud".format(original))
+    return results
+
+
+def report(results: typing.Iterable[BenchResult], **metadata: typing.Any) -> typing.Dict[str, typing.Any]:
+    """
+    A JSON-ready document of ``results`` and what they were measured with, for :func:`compare`.
+    """
+    return {
+        "dragon_stand": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        **metadata,
+        "results": [r._asdict() for r in results],
+    }
+
+
+def load(path: str) -> typing.Dict[str, typing.Any]:
+    with open(path, "r") as f:
+        return typing.cast(typing.Dict[str, typing.Any], json.load(f))
+
+
+def format_result(result: BenchResult) -> str:
+    return (
+        "{operation:>14} {baudrate:>8} {servos:>3} {tx_per_second:>9.1f} tx/s  p50 {latency_p50_ms:>7.3f}  "
+        "p99 {latency_p99_ms:>7.3f}  jitter {jitter_ms:>6.3f} ms  cpu {cpu_us_per_tx:>7.1f} us  fail {failures}{tx_only}"
+    ).format(tx_only="  (tx only)" if result.tx_only else "", **result._asdict())
+
+
+def compare(baseline: typing.Mapping[str, typing.Any], current: typing.Mapping[str, typing.Any]) -> typing.List[str]:
+    """
+    One line per benchmark present in both :func:`report` documents giving the change in throughput, p99 latency and
+    CPU time. Positive throughput and negative latency/CPU changes are improvements.
+    """
+
+    def _keyed(document: typing.Mapping[str, typing.Any]) -> typing.Dict[typing.Tuple[str, int, int], BenchResult]:
+        results = (BenchResult(**r) for r in document.get("results", []))
+        return {r.key: r for r in results}
+
+    def _change(before: float, after: float) -> str:
+        if not before or math.isnan(before) or math.isnan(after):
+            return "    n/a"
+        return "{:+6.1f}%".format((after - before) / before * 100.0)
+
+    old, new = _keyed(baseline), _keyed(current)
+    lines = [
+        "{} ({}) -> {} ({})".format(
+            baseline.get("dragon_stand"), baseline.get("created"), current.get("dragon_stand"), current.get("created")
+        )
+    ]
+    for key in sorted(old.keys() & new.keys()):
+        before, after = old[key], new[key]
+        lines.append(
+            "{:>14} {:>8} {:>3}  tx/s {}  p99 {}  cpu {}".format(
+                *key,
+                _change(before.tx_per_second, after.tx_per_second),
+                _change(before.latency_p99_ms, after.latency_p99_ms),
+                _change(before.cpu_us_per_tx, after.cpu_us_per_tx),
+            )
+        )
+    return lines
+
+
+async def _main() -> int:
+    from ..sim import BusSimulator, SimulatedServo
+
+    device_ids = [1, 2, 3, 4]
+    with BusSimulator([SimulatedServo(device_id) for device_id in device_ids]) as simulator:
+        async with Bus(simulator.port_name) as bus:
+            for result in await run(bus, device_ids, servo_counts=[1, len(device_ids)], transactions=100):
+                print(format_result(result))
+    return 0
+
+
+def main() -> int:
+    return asyncio.run(_main())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,320 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+Microbenchmarks of the host-side CPU paths in :mod:`~dragon_stand.mech.dynamixel_sdk`, in nanoseconds per packet, so
+a regression in checksumming, stuffing or framing shows up before it reaches the stand::
+
+    python -m dragon_stand.bench.codec [--json results.json]
+
+Status packet framing (``rxPacket``) is timed by replaying the byte streams in ``corpus/``, one file per protocol and
+condition:
+
+``clean``
+    one status packet per read, as a USB adapter with a short latency timer delivers them.
+``noisy``
+    garbage between packets and some packets corrupted, as on a bus with a marginal cable or termination.
+``fragmented``
+    the clean stream cut into reads of 1-8 bytes, as from a slow or heavily loaded host.
+
+A corpus file is a header, ``b"DXLC"`` | version (u8) | protocol (u8) | intact status packets (u32 LE), followed by
+one record per ``readPort`` result: length (u16 LE) | bytes. ``--write-corpus`` regenerates them (deterministically)
+from the simulator's status packets.
+"""
+
+import argparse
+import json
+import pathlib
+import random
+import struct
+import sys
+import time
+import typing
+
+from ..mech import dynamixel_sdk
+from ..sim.bus import status_packet
+from .stuffing import sync_write_packet
+
+CORPUS_MAGIC = b"DXLC"
+CORPUS_VERSION = 1
+STREAMS: typing.Tuple[str, ...] = ("clean", "noisy", "fragmented")
+
+_HEADER = struct.Struct("<4sBBI")
+_RECORD = struct.Struct("<H")
+
+_CORPUS_PACKETS = 2000
+_CORPUS_SEED = 0xD4A6
+_NOISE_RATE = 0.2
+_CORRUPT_RATE = 0.05
+
+# present position/velocity/load style reads of a handful of servos, like a stand's telemetry loop
+_REPLY_LENGTHS = (0, 1, 2, 2, 2, 4, 4, 8)
+
+
+class Corpus(typing.NamedTuple):
+    protocol_version: float
+    packets: int
+    """Intact status packets in the stream."""
+    chunks: typing.List[bytes]
+    """What each successive ``readPort`` call returns."""
+
+
+def corpus_path(protocol_version: float, stream: str) -> pathlib.Path:
+    return pathlib.Path(__file__).parent / "corpus" / "protocol{}_{}.bin".format(int(protocol_version), stream)
+
+
+def load_corpus(path: typing.Union[str, pathlib.Path]) -> Corpus:
+    data = pathlib.Path(path).read_bytes()
+    magic, version, protocol, packets = _HEADER.unpack_from(data, 0)
+    if magic != CORPUS_MAGIC or version != CORPUS_VERSION:
+        raise ValueError("{} is not a version {} corpus file".format(path, CORPUS_VERSION))
+    chunks = []
+    offset = _HEADER.size
+    while offset < len(data):
+        (length,) = _RECORD.unpack_from(data, offset)
+        offset += _RECORD.size
+        chunks.append(data[offset : offset + length])
+        offset += length
+    return Corpus(float(protocol), packets, chunks)
+
+
+def save_corpus(corpus: Corpus, path: typing.Union[str, pathlib.Path]) -> None:
+    with open(path, "wb") as f:
+        f.write(_HEADER.pack(CORPUS_MAGIC, CORPUS_VERSION, int(corpus.protocol_version), corpus.packets))
+        for chunk in corpus.chunks:
+            f.write(_RECORD.pack(len(chunk)))
+            f.write(chunk)
+
+
+def generate_corpus(
+    protocol_version: float, stream: str, packets: int = _CORPUS_PACKETS, seed: int = _CORPUS_SEED
+) -> Corpus:
+    rng = random.Random(seed)
+    replies = []
+    for _ in range(packets):
+        params = bytes(rng.randrange(256) for _ in range(rng.choice(_REPLY_LENGTHS)))
+        if protocol_version == 2.0 and rng.random() < 0.1:
+            # data that has to be stuffed
+            params = b"\xff\xff\xfd" + params
+        replies.append(status_packet(protocol_version, rng.randint(1, 6), 0, params))
+
+    if stream == "clean":
+        return Corpus(protocol_version, packets, replies)
+    if stream == "fragmented":
+        joined = b"".join(replies)
+        chunks = []
+        offset = 0
+        while offset < len(joined):
+            length = rng.randint(1, 8)
+            chunks.append(joined[offset : offset + length])
+            offset += length
+        return Corpus(protocol_version, packets, chunks)
+    if stream == "noisy":
+        chunks = []
+        intact = 0
+        for reply in replies:
+            if rng.random() < _NOISE_RATE:
+                chunks.append(bytes(rng.choice((0xFF, 0xFD, rng.randrange(256))) for _ in range(rng.randint(1, 6))))
+            if rng.random() < _CORRUPT_RATE:
+                corrupted = bytearray(reply)
+                corrupted[rng.randrange(2, len(corrupted))] ^= 1 << rng.randrange(8)
+                reply = bytes(corrupted)
+            else:
+                intact += 1
+            chunks.append(reply)
+        return Corpus(protocol_version, intact, chunks)
+    raise ValueError("Unknown stream {}".format(stream))
+
+
+def write_corpus() -> None:
+    for protocol_version in (1.0, 2.0):
+        for stream in STREAMS:
+            path = corpus_path(protocol_version, stream)
+            path.parent.mkdir(exist_ok=True)
+            save_corpus(generate_corpus(protocol_version, stream), path)
+
+
+class ReplayPort:
+    """
+    Enough of a :class:`~dragon_stand.mech.dynamixel_sdk.PortHandler` for ``rxPacket``: every ``readPort`` returns
+    (up to the requested length of) the next recorded chunk and the packet times out once the recording runs out.
+    """
+
+    def __init__(self, chunks: typing.Sequence[bytes]):
+        self._chunks = chunks
+        self.rewind()
+
+    def rewind(self) -> None:
+        self._index = 0
+        self._offset = 0
+        self.is_using = False
+
+    def readPort(self, length: int) -> bytes:
+        if self._index >= len(self._chunks):
+            return b""
+        chunk = self._chunks[self._index]
+        data = chunk[self._offset : self._offset + length]
+        self._offset += len(data)
+        if self._offset >= len(chunk):
+            self._index += 1
+            self._offset = 0
+        return data
+
+    def isPacketTimeout(self) -> bool:
+        return self._index >= len(self._chunks)
+
+    def recordRoundTrip(self, dxl_id: int, rx_length: int) -> None:
+        pass
+
+
+def _time(statement: typing.Callable[[], typing.Any], repeat: int = 5) -> float:
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter_ns()
+        statement()
+        elapsed = time.perf_counter_ns() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return float(typing.cast(int, best))
+
+
+def _row(benchmark: str, corpus: str, packets: int, ns: float) -> typing.Dict[str, typing.Any]:
+    return {"benchmark": benchmark, "corpus": corpus, "packets": packets, "ns_per_packet": ns / packets}
+
+
+def frame_stream(ph: typing.Any, port: ReplayPort) -> int:
+    """
+    Run ``rxPacket`` over the whole recording and return how many status packets it recovered.
+    """
+    port.rewind()
+    framed = 0
+    while not port.isPacketTimeout():
+        _, result = ph.rxPacket(port)
+        if result == dynamixel_sdk.COMM_SUCCESS:
+            framed += 1
+    return framed
+
+
+def run(repeat: int = 5) -> typing.List[typing.Dict[str, typing.Any]]:
+    """
+    Time every path and return one row per benchmark and corpus.
+    """
+    rows = []
+    for protocol_version in (1.0, 2.0):
+        ph = dynamixel_sdk.PacketHandler(protocol_version)
+        for stream in STREAMS:
+            corpus = load_corpus(corpus_path(protocol_version, stream))
+            port = ReplayPort(corpus.chunks)
+            recovered = frame_stream(ph, port)
+            ns = _time(lambda: frame_stream(ph, port), repeat)
+            row = _row("rxPacket", corpus_path(protocol_version, stream).name, corpus.packets, ns)
+            row["recovered"] = recovered
+            rows.append(row)
+
+    ph = dynamixel_sdk.PacketHandler(2.0)
+    clean = load_corpus(corpus_path(2.0, "clean"))
+    name = corpus_path(2.0, "clean").name
+    packets = [bytearray(p) for p in clean.chunks]
+
+    def _crc() -> None:
+        for packet in packets:
+            dynamixel_sdk.updateCRC(0, packet, len(packet) - 2)
+
+    rows.append(_row("updateCRC", name, len(packets), _time(_crc, repeat)))
+
+    def _remove() -> None:
+        for packet in packets:
+            ph.removeStuffing(bytearray(packet))
+
+    rows.append(_row("removeStuffing", name, len(packets), _time(_remove, repeat)))
+
+    rng = random.Random(_CORPUS_SEED)
+    instructions = [sync_write_packet([rng.choice((2048, 0xFDFFFF)) for _ in range(6)]) for _ in range(len(packets))]
+
+    def _add() -> None:
+        for packet in instructions:
+            ph.addStuffing(packet)
+
+    rows.append(_row("addStuffing", "6-servo sync writes", len(instructions), _time(_add, repeat)))
+
+    for protocol_version in (1.0, 2.0):
+        ph = dynamixel_sdk.PacketHandler(protocol_version)
+        device_ids = range(1, 7)
+        sync_write = dynamixel_sdk.GroupSyncWrite(None, ph, 30, 4)
+        for device_id in device_ids:
+            sync_write.addParam(device_id, dynamixel_sdk.packValue(2048 + device_id, 4))
+
+        def _make_param() -> None:
+            for _ in range(len(packets)):
+                sync_write.makeParam()
+
+        rows.append(
+            _row(
+                "GroupSyncWrite.makeParam",
+                "protocol {}, 6 servos".format(protocol_version),
+                len(packets),
+                _time(_make_param, repeat),
+            )
+        )
+
+        # fill a bulk read from recorded replies, then read every servo back out of it
+        replies = [status_packet(protocol_version, device_id, 0, bytes(range(8))) for device_id in device_ids]
+        reply_port = ReplayPort([b"".join(replies)])
+        bulk_read = dynamixel_sdk.GroupBulkRead(reply_port, ph)
+        for device_id in device_ids:
+            bulk_read.addParam(device_id, 36, 8)
+        if bulk_read.rxPacket() != dynamixel_sdk.COMM_SUCCESS:
+            raise AssertionError("GroupBulkRead did not accept the recorded replies")
+
+        def _receive() -> None:
+            for _ in range(len(packets) // len(device_ids)):
+                reply_port.rewind()
+                bulk_read.rxPacket()
+
+        rows.append(
+            _row(
+                "GroupBulkRead.rxPacket",
+                "protocol {}, 6 servos".format(protocol_version),
+                len(packets) // len(device_ids) * len(device_ids),
+                _time(_receive, repeat),
+            )
+        )
+
+        def _get_data() -> None:
+            for _ in range(len(packets) // len(device_ids)):
+                for device_id in device_ids:
+                    bulk_read.getData(device_id, 38, 2)
+
+        rows.append(
+            _row(
+                "GroupBulkRead.getData",
+                "protocol {}, 6 servos".format(protocol_version),
+                len(packets) // len(device_ids) * len(device_ids),
+                _time(_get_data, repeat),
+            )
+        )
+    return rows
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="python -m dragon_stand.bench.codec", description=__doc__)
+    parser.add_argument("--json", help="Also write the results to this file.")
+    parser.add_argument("--write-corpus", action="store_true", help="Regenerate the corpus files and exit.")
+    args = parser.parse_args()
+
+    if args.write_corpus:
+        write_corpus()
+        return 0
+
+    rows = run()
+    print("{:>26} {:>28} {:>8} {:>12}".format("benchmark", "corpus", "packets", "ns/packet"))
+    for row in rows:
+        print("{benchmark:>26} {corpus:>28} {packets:>8} {ns_per_packet:>12.0f}".format(**row))
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,364 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+Where the time in a register read goes, per servo and payload size, and what to change to get it back::
+
+    dhs servo --port /dev/ttyUSB0 profile --output stand-a.json
+    dhs servo --port /dev/ttyUSB0 profile --compare stand-a.json
+
+A read's round trip is split into
+
+``encode``
+    host CPU building and sending the instruction (``readTx`` against a port that discards it).
+``wire``
+    instruction and status packet on the line, from the port's per-byte transmit time (the figure
+    ``PortHandler.setPacketTimeout`` uses).
+``return delay``
+    the servo's Return Delay Time register.
+``adapter``
+    what is left of the measured round trip: USB scheduling, the adapter's latency timer and the servo's own
+    processing, which cannot be told apart from the host.
+``decode``
+    host CPU framing and checking the status packet (``readRx`` on a replay of the servo's actual reply).
+
+The round trip itself is the median of ``readTxRxAsync`` calls made with the port to ourselves.
+"""
+
+import asyncio
+import datetime
+import json
+import logging
+import math
+import platform
+import sys
+import time
+import typing
+
+from .._version import __version__
+from ..mech import Bus, Priority, baud, dynamixel_sdk
+from ..mech.profiles import MAX_THROUGHPUT, SAFE
+from ..mech.shadow import CONTROL_TABLES
+from ..sim.bus import status_packet
+from .codec import ReplayPort
+
+DEFAULT_PAYLOADS: typing.Tuple[int, ...] = (1, 2, 4, 8, 16, 32)
+DEFAULT_SAMPLES = 50
+DEFAULT_WARMUP = 5
+
+_INSTRUCTION_OVERHEAD = {1.0: 8, 2.0: 14}
+"""Length of a READ instruction packet."""
+
+_STATUS_OVERHEAD = {1.0: 6, 2.0: 11}
+"""Length of a status packet less its data."""
+
+_RETURN_DELAY_ADDRESS = {1.0: 5, 2.0: 9}
+
+_BAUD_LADDER: typing.Tuple[int, ...] = (57600, 115200, 1000000, 2000000, 3000000, 4000000)
+"""Rates recommended, in order; each protocol skips the ones its servos cannot run at."""
+
+
+class LatencyBreakdown(typing.NamedTuple):
+    """
+    One servo's reads of one payload size. Times are in microseconds except the round trip and timeout.
+    """
+
+    device_id: int
+    protocol_version: float
+    baudrate: int
+    latency_timer_ms: float
+    payload: int
+    samples: int
+    failures: int
+    round_trip_p50_ms: float
+    round_trip_p99_ms: float
+    encode_us: float
+    wire_us: float
+    return_delay_us: float
+    adapter_us: float
+    decode_us: float
+    timeout_ms: float
+    """The timeout ``setPacketTimeout`` allows this read."""
+
+    @property
+    def key(self) -> typing.Tuple[int, int]:
+        return (self.device_id, self.payload)
+
+
+class _NullPort:
+    """
+    Enough of a :class:`~dragon_stand.mech.dynamixel_sdk.PortHandler` for ``readTx``: writes succeed and go nowhere.
+    """
+
+    def __init__(self) -> None:
+        self.is_using = False
+
+    def clearPort(self) -> None:
+        pass
+
+    def writePort(self, packet: typing.Any) -> int:
+        return len(packet)
+
+    def setPacketTimeout(self, packet_length: int, dxl_id: typing.Optional[int] = None) -> None:
+        pass
+
+
+def _best_ns(statement: typing.Callable[[], typing.Any], repeat: int = 200) -> float:
+    best = math.inf
+    for _ in range(repeat):
+        started = time.perf_counter_ns()
+        statement()
+        best = min(best, time.perf_counter_ns() - started)
+    return best
+
+
+def _percentile(ordered: typing.Sequence[float], percentile: float) -> float:
+    if not ordered:
+        return math.nan
+    return ordered[min(len(ordered) - 1, int(round(percentile / 100.0 * (len(ordered) - 1))))]
+
+
+async def measure(
+    bus: Bus, device_id: int, payload: int, samples: int = DEFAULT_SAMPLES, warmup: int = DEFAULT_WARMUP
+) -> typing.Optional[LatencyBreakdown]:
+    """
+    Break down reads of ``payload`` bytes from the start of servo ``device_id``'s control table. ``None`` if the
+    servo does not answer at all.
+    """
+    ph = bus.packet_handler
+    protocol_version = ph.getProtocolVersion()
+
+    async def _read(port: typing.Any, ph: typing.Any) -> typing.Tuple[float, typing.Any, int, int]:
+        sent = time.perf_counter_ns()
+        data, result, error = await ph.readTxRxAsync(port, device_id, 0, payload)
+        return (time.perf_counter_ns() - sent) / 1e6, data, result, error
+
+    async def _return_delay(port: typing.Any, ph: typing.Any) -> typing.Tuple[int, int, int]:
+        return typing.cast(
+            typing.Tuple[int, int, int],
+            await ph.read1ByteTxRxAsync(port, device_id, _RETURN_DELAY_ADDRESS[protocol_version]),
+        )
+
+    return_delay, result, _ = await bus.transact(_return_delay, Priority.DIAGNOSTICS)
+    if result != dynamixel_sdk.COMM_SUCCESS:
+        return None
+
+    for _ in range(warmup):
+        await bus.transact(_read, Priority.DIAGNOSTICS)
+
+    round_trips = []
+    reply = None
+    failures = 0
+    for _ in range(samples):
+        elapsed, data, result, error = await bus.transact(_read, Priority.DIAGNOSTICS)
+        if result != dynamixel_sdk.COMM_SUCCESS:
+            failures += 1
+            continue
+        round_trips.append(elapsed)
+        reply = status_packet(protocol_version, device_id, error, bytes(data))
+    if reply is None:
+        return None
+
+    async def _timeout(port: typing.Any, ph: typing.Any) -> float:
+        # what readTxRx allows this reply (the learned figure if the port has adaptive timeouts)
+        port.setPacketTimeout(payload + _STATUS_OVERHEAD[protocol_version], device_id)
+        return float(port.packet_timeout)
+
+    timeout_ms = await bus.transact(_timeout, Priority.DIAGNOSTICS)
+
+    null_port = _NullPort()
+    replay_port = ReplayPort([reply])
+
+    def _decode() -> None:
+        replay_port.rewind()
+        ph.readRx(replay_port, device_id, payload)
+
+    encode_ns = _best_ns(lambda: ph.readTx(null_port, device_id, 0, payload))
+    decode_ns = _best_ns(_decode)
+
+    port = bus.port_handler
+    wire_us = port.tx_time_per_byte * (_INSTRUCTION_OVERHEAD[protocol_version] + len(reply)) * 1e3
+    ordered = sorted(round_trips)
+    p50 = _percentile(ordered, 50)
+    return_delay_us = return_delay * 2.0
+    return LatencyBreakdown(
+        device_id=device_id,
+        protocol_version=protocol_version,
+        baudrate=bus.baudrate,
+        latency_timer_ms=float(port.getLatencyTimer()),
+        payload=payload,
+        samples=samples,
+        failures=failures,
+        round_trip_p50_ms=p50,
+        round_trip_p99_ms=_percentile(ordered, 99),
+        encode_us=encode_ns / 1e3,
+        wire_us=wire_us,
+        return_delay_us=return_delay_us,
+        adapter_us=max(0.0, p50 * 1e3 - encode_ns / 1e3 - decode_ns / 1e3 - wire_us - return_delay_us),
+        decode_us=decode_ns / 1e3,
+        timeout_ms=timeout_ms,
+    )
+
+
+async def run(
+    bus: Bus,
+    device_ids: typing.Iterable[int],
+    payloads: typing.Iterable[int] = DEFAULT_PAYLOADS,
+    samples: int = DEFAULT_SAMPLES,
+) -> typing.List[LatencyBreakdown]:
+    """
+    :func:`measure` every payload size (up to the size of the control table) on each of ``device_ids``. Servos that do
+    not answer are logged and left out.
+    """
+    logger = logging.getLogger(__name__)
+    table_size = CONTROL_TABLES[bus.packet_handler.getProtocolVersion()].size
+    results = []
+    for device_id in device_ids:
+        for payload in sorted(set(payloads)):
+            if payload < 1 or payload > table_size:
+                continue
+            result = await measure(bus, device_id, payload, samples)
+            if result is None:
+                logger.warning("Servo {} did not answer; skipped".format(device_id))
+                break
+            results.append(result)
+    return results
+
+
+def recommend(results: typing.Sequence[LatencyBreakdown]) -> typing.List[str]:
+    """
+    Settings that would shorten the round trips in ``results``, most valuable first.
+    """
+    if not results:
+        return []
+    recommendations = []
+    largest = max(results, key=lambda r: r.payload)
+    protocol_version = largest.protocol_version
+    failures = sum(r.failures for r in results)
+    adapter_us = sorted(r.adapter_us for r in results)[len(results) // 2]
+
+    if largest.latency_timer_ms > 1.0 or adapter_us > 2000.0:
+        recommendations.append(
+            "latency timer: {:.0f} ms -> 1 ms (Bus(low_latency=True), or as root: echo 1 > "
+            "/sys/bus/usb-serial/devices/<tty>/latency_timer); the adapter holds replies for ~{:.0f} us".format(
+                largest.latency_timer_ms, adapter_us
+            )
+        )
+
+    wire_share = largest.wire_us / (largest.round_trip_p50_ms * 1e3) if largest.round_trip_p50_ms > 0 else 0.0
+    faster = [b for b in _BAUD_LADDER if b > largest.baudrate and baud.is_supported(b, protocol_version)]
+    if faster and wire_share > 0.25:
+        saved = largest.wire_us * (1.0 - largest.baudrate / faster[0])
+        recommendations.append(
+            "baud: {} -> {} (Bus.set_baudrate); the wire is {:.0f}% of a {} byte read, ~{:.0f} us saved".format(
+                largest.baudrate, faster[0], wire_share * 100.0, largest.payload, saved
+            )
+        )
+
+    delays = {r.return_delay_us for r in results}
+    if failures:
+        recommendations.append(
+            "return delay: {} of {} reads failed; use the '{}' profile ({} us) rather than a shorter delay".format(
+                failures, sum(r.samples for r in results), SAFE.name, SAFE.return_delay_us
+            )
+        )
+    elif max(delays) > MAX_THROUGHPUT.return_delay_us:
+        recommendations.append(
+            "return delay: {} us -> {} us ('{}' profile, or '{}' to keep write acknowledgements at {} us)".format(
+                "/".join("{:.0f}".format(d) for d in sorted(delays)),
+                MAX_THROUGHPUT.return_delay_us,
+                MAX_THROUGHPUT.name,
+                SAFE.name,
+                SAFE.return_delay_us,
+            )
+        )
+    return recommendations
+
+
+def report(results: typing.Iterable[LatencyBreakdown], **metadata: typing.Any) -> typing.Dict[str, typing.Any]:
+    """
+    A JSON-serializable record of a run, for :func:`compare` across stands and over time.
+    """
+    results = list(results)
+    return {
+        "dragon_stand": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        **metadata,
+        "recommendations": recommend(results),
+        "results": [r._asdict() for r in results],
+    }
+
+
+def load(path: str) -> typing.Dict[str, typing.Any]:
+    with open(path, "r") as f:
+        return typing.cast(typing.Dict[str, typing.Any], json.load(f))
+
+
+def format_result(result: LatencyBreakdown) -> str:
+    return (
+        "[ID:{device_id:03d}] {payload:>3} B  p50 {round_trip_p50_ms:>7.3f}  p99 {round_trip_p99_ms:>7.3f} ms  "
+        "encode {encode_us:>6.1f}  wire {wire_us:>7.1f}  return delay {return_delay_us:>5.0f}  "
+        "adapter {adapter_us:>7.1f}  decode {decode_us:>6.1f} us  fail {failures}"
+    ).format(**result._asdict())
+
+
+def compare(baseline: typing.Mapping[str, typing.Any], current: typing.Mapping[str, typing.Any]) -> typing.List[str]:
+    """
+    One line per servo and payload present in both :func:`report` documents giving the change in median round trip
+    and in the adapter's share of it. Negative changes are improvements.
+    """
+
+    def _keyed(document: typing.Mapping[str, typing.Any]) -> typing.Dict[typing.Tuple[int, int], LatencyBreakdown]:
+        results = (LatencyBreakdown(**r) for r in document.get("results", []))
+        return {r.key: r for r in results}
+
+    old, new = _keyed(baseline), _keyed(current)
+    lines = [
+        "{} ({}, {}) -> {} ({}, {})".format(
+            baseline.get("port"),
+            baseline.get("host"),
+            baseline.get("created"),
+            current.get("port"),
+            current.get("host"),
+            current.get("created"),
+        )
+    ]
+    for key in sorted(old.keys() & new.keys()):
+        before, after = old[key], new[key]
+        lines.append(
+            "[ID:{:03d}] {:>3} B  p50 {:7.3f} -> {:7.3f} ms ({:+7.3f})  adapter {:7.1f} -> {:7.1f} us".format(
+                key[0],
+                key[1],
+                before.round_trip_p50_ms,
+                after.round_trip_p50_ms,
+                after.round_trip_p50_ms - before.round_trip_p50_ms,
+                before.adapter_us,
+                after.adapter_us,
+            )
+        )
+    return lines
+
+
+async def _main() -> int:
+    from ..sim import BusSimulator, SimulatedServo
+
+    device_ids = [1, 2]
+    with BusSimulator([SimulatedServo(device_id) for device_id in device_ids]) as simulator:
+        async with Bus(simulator.port_name) as bus:
+            results = await run(bus, device_ids, samples=20)
+    for result in results:
+        print(format_result(result))
+    for line in recommend(results):
+        print(line)
+    return 0
+
+
+def main() -> int:
+    return asyncio.run(_main())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
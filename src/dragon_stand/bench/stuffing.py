@@ -0,0 +1,167 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+Protocol 2.0 byte stuffing: the SDK's original list-walking implementation against the pattern-search one in
+:mod:`~dragon_stand.mech.dynamixel_sdk.packet_codec`, on sync-write packets like the ones a motion loop sends.
+
+    python -m dragon_stand.bench.stuffing
+"""
+
+import sys
+import timeit
+import typing
+
+from ..mech.dynamixel_sdk import (
+    INST_SYNC_WRITE,
+    PKT_INSTRUCTION,
+    PKT_LENGTH_H,
+    PKT_LENGTH_L,
+    Protocol2Codec,
+    packValue,
+    packWordInto,
+    stuffPacket,
+    unstuffPacket,
+)
+
+_TXPACKET_MAX_LEN = 1024
+_GOAL_POSITION = 116
+
+
+def legacy_add_stuffing(packet: typing.List[int]) -> typing.List[int]:
+    """
+    ``Protocol2PacketHandler.addStuffing`` as shipped by the ROBOTIS SDK, kept for comparison.
+    """
+    packet_length_in = packet[PKT_LENGTH_L] | (packet[PKT_LENGTH_H] << 8)
+    packet_length_out = packet_length_in
+
+    temp = [0] * _TXPACKET_MAX_LEN
+    temp[0 : PKT_LENGTH_H + 1] = packet[0 : PKT_LENGTH_H + 1]
+
+    index = PKT_INSTRUCTION
+    for i in range(0, packet_length_in - 2):
+        temp[index] = packet[i + PKT_INSTRUCTION]
+        index = index + 1
+        if (
+            packet[i + PKT_INSTRUCTION] == 0xFD
+            and packet[i + PKT_INSTRUCTION - 1] == 0xFF
+            and packet[i + PKT_INSTRUCTION - 2] == 0xFF
+        ):
+            temp[index] = 0xFD
+            index = index + 1
+            packet_length_out = packet_length_out + 1
+
+    temp[index] = packet[PKT_INSTRUCTION + packet_length_in - 2]
+    temp[index + 1] = packet[PKT_INSTRUCTION + packet_length_in - 1]
+    index = index + 2
+
+    if packet_length_in != packet_length_out:
+        packet = [0] * index
+    packet[0:index] = temp[0:index]
+    packet[PKT_LENGTH_L] = packet_length_out & 0xFF
+    packet[PKT_LENGTH_H] = (packet_length_out >> 8) & 0xFF
+    return packet
+
+
+def legacy_remove_stuffing(packet: typing.List[int]) -> typing.List[int]:
+    """
+    ``Protocol2PacketHandler.removeStuffing`` as shipped by the ROBOTIS SDK, kept for comparison.
+    """
+    packet_length_in = packet[PKT_LENGTH_L] | (packet[PKT_LENGTH_H] << 8)
+    packet_length_out = packet_length_in
+
+    index = PKT_INSTRUCTION
+    for i in range(0, packet_length_in - 2):
+        if (
+            packet[i + PKT_INSTRUCTION] == 0xFD
+            and packet[i + PKT_INSTRUCTION + 1] == 0xFD
+            and packet[i + PKT_INSTRUCTION - 1] == 0xFF
+            and packet[i + PKT_INSTRUCTION - 2] == 0xFF
+        ):
+            packet_length_out = packet_length_out - 1
+        else:
+            packet[index] = packet[i + PKT_INSTRUCTION]
+            index += 1
+
+    packet[index] = packet[PKT_INSTRUCTION + packet_length_in - 2]
+    packet[index + 1] = packet[PKT_INSTRUCTION + packet_length_in - 1]
+    packet[PKT_LENGTH_L] = packet_length_out & 0xFF
+    packet[PKT_LENGTH_H] = (packet_length_out >> 8) & 0xFF
+    return packet
+
+
+def sync_write_packet(positions: typing.Sequence[int]) -> bytearray:
+    """
+    A Protocol 2.0 SYNC_WRITE of a 4-byte goal position to servos 1..n, before stuffing.
+    """
+    codec = Protocol2Codec(_TXPACKET_MAX_LEN)
+    packet = codec.instruction(0xFE, INST_SYNC_WRITE, 4 + 5 * len(positions))
+    packWordInto(packet, 8, _GOAL_POSITION)
+    packWordInto(packet, 10, 4)
+    for i, position in enumerate(positions):
+        offset = 12 + 5 * i
+        packet[offset] = i + 1
+        packet[offset + 1 : offset + 5] = packValue(position, 4)
+    packet[0:4] = b"\xff\xff\xfd\x00"
+    return bytearray(packet)
+
+
+def _time(statement: typing.Callable[[], typing.Any], number: int) -> float:
+    return min(timeit.repeat(statement, number=number, repeat=5)) / number
+
+
+def run(
+    servo_counts: typing.Iterable[int] = (2, 6, 12, 18), number: int = 20000
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    """
+    Time both implementations and return one row per case, in nanoseconds per packet.
+    """
+    rows = []
+    for servos in servo_counts:
+        cases = {
+            # mid-range positions never contain FF FF FD: the common case
+            "typical": [2048 + 10 * i for i in range(servos)],
+            # 0x00FDFFFF-style values force a stuffed byte per servo: the worst case
+            "stuffed": [0xFDFFFF] * servos,
+        }
+        for name, positions in cases.items():
+            packet = sync_write_packet(positions)
+            stuffed = stuffPacket(bytearray(packet))
+            if bytes(legacy_add_stuffing(list(packet))) != bytes(stuffed):
+                raise AssertionError("stuffing mismatch for {} servos ({})".format(servos, name))
+
+            rows.append(
+                {
+                    "servos": servos,
+                    "case": name,
+                    "length": len(packet),
+                    "legacy_add_ns": _time(lambda: legacy_add_stuffing(list(packet)), number) * 1e9,
+                    "add_ns": _time(lambda: stuffPacket(packet), number) * 1e9,
+                    "legacy_remove_ns": _time(lambda: legacy_remove_stuffing(list(stuffed)), number) * 1e9,
+                    "remove_ns": _time(lambda: unstuffPacket(bytearray(stuffed)), number) * 1e9,
+                }
+            )
+    return rows
+
+
+def main() -> int:
+    print(
+        "{:>6} {:>8} {:>6} {:>12} {:>10} {:>7} {:>12} {:>10} {:>7}".format(
+            "servos", "case", "bytes", "legacy add", "add", "gain", "legacy rm", "remove", "gain"
+        )
+    )
+    for row in run():
+        print(
+            "{servos:>6} {case:>8} {length:>6} {legacy_add_ns:>10.0f}ns {add_ns:>8.0f}ns {add_gain:>6.1f}x "
+            "{legacy_remove_ns:>10.0f}ns {remove_ns:>8.0f}ns {remove_gain:>6.1f}x".format(
+                add_gain=row["legacy_add_ns"] / row["add_ns"],
+                remove_gain=row["legacy_remove_ns"] / row["remove_ns"],
+                **row
+            )
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -12,7 +12,7 @@ import logging
 import sys
 import pathlib
 import typing
-from .runners import AsyncRunner, AsyncServoRunner
+from .runners import AsyncBenchRunner, AsyncRunner, AsyncServoRunner
 
     
 def _make_parser() -> argparse.ArgumentParser:
@@ -39,6 +39,9 @@ def _make_parser() -> argparse.ArgumentParser:
     servo_parser = AsyncServoRunner.visit_add_parser(sub_parsers)
     subcommands = AsyncServoRunner.visit_setargs(servo_parser)
     servo_parser.set_defaults(_runner=AsyncServoRunner, _sub_command_parsers=subcommands)
+    bench_parser = AsyncBenchRunner.visit_add_parser(sub_parsers)
+    bench_subcommands = AsyncBenchRunner.visit_setargs(bench_parser)
+    bench_parser.set_defaults(_runner=AsyncBenchRunner, _sub_command_parsers=bench_subcommands)
 
     return parser
 
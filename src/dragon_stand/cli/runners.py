@@ -8,10 +8,17 @@
 import abc
 import argparse
 import asyncio
+import json
+import platform
+import sys
+import time
 import typing
 import logging
 
-from .. import Servo
+from .. import Bus, Servo
+from ..bench import bus as bus_bench
+from ..bench import latency as latency_bench
+from ..mech.profiles import PROFILES
 
 
 class AsyncRunner(abc.ABC):
@@ -30,6 +37,13 @@ class AsyncServoRunner(AsyncRunner):
     def visit_add_parser(self, sub_parsers: argparse._SubParsersAction) -> argparse.ArgumentParser:
         subparser: argparse.ArgumentParser = sub_parsers.add_parser("servo", help="Commands to work with the pan/tilt servos.")
         subparser.add_argument("--port", default="/dev/ttyUSB0")
+        subparser.add_argument("--baudrate", default=Bus.DEFAULT_BAUDRATE, type=int)
+        subparser.add_argument("--capture", help="Record all bus traffic to this file.")
+        subparser.add_argument(
+            "--profile",
+            choices=sorted(PROFILES),
+            help="Set each servo's return delay and status return level to this profile when connecting.",
+        )
         return subparser
 
     @classmethod
@@ -39,36 +53,156 @@ class AsyncServoRunner(AsyncRunner):
         home = sub_parsers.add_parser("home")
         query = sub_parsers.add_parser("query")
         query.add_argument("-id", help="The servo to query.", type=int)
+        query.add_argument("--rate", help="Samples per second.", type=float, default=1.0)
+        scan = sub_parsers.add_parser("scan", help="List the servos on the bus as they answer.")
+        scan.add_argument(
+            "--expect", nargs="*", type=int, default=None, help="Stop as soon as these servo ids have been found."
+        )
+        profile = sub_parsers.add_parser(
+            "profile", help="Break down read latency for each servo and recommend bus settings."
+        )
+        profile.add_argument(
+            "--ids", nargs="+", type=int, default=None, help="Servos to profile (default: every servo a scan finds)."
+        )
+        profile.add_argument("--payloads", nargs="+", type=int, default=list(latency_bench.DEFAULT_PAYLOADS))
+        profile.add_argument("--samples", type=int, default=latency_bench.DEFAULT_SAMPLES)
+        profile.add_argument("--output", "-o", help="Write the JSON results here ('-' for stdout).")
+        profile.add_argument("--compare", help="JSON results of an earlier run (or another stand) to compare against.")
         
-        return [ping, home, query]
+        return [ping, home, query, scan, profile]
 
     async def run(self) -> int:
         
         port: str = self._args.port
+        baudrate: int = self._args.baudrate
         if not hasattr(self._args, "_sub_command"):
             setattr(self._args, "_sub_command", "<unknown>")
         sub_command: str = self._args._sub_command
         if sub_command == "ping":
-            servo_1 = Servo(port, 1)
-            servo_2 = Servo(port, 2)
-            async with servo_1 as pan_servo:
-                async with servo_2 as tilt_servo:
-                    await asyncio.gather(pan_servo.ping(), tilt_servo.ping())
+            async with Bus(port, baudrate=baudrate, capture_path=self._args.capture) as bus:
+                async with bus.servo(1, profile=self._args.profile) as pan_servo:
+                    async with bus.servo(2, profile=self._args.profile) as tilt_servo:
+                        await asyncio.gather(pan_servo.ping(), tilt_servo.ping())
         elif sub_command == "home":
-            async with Servo(port, 1) as pan_servo:
-                async with Servo(port, 2) as tilt_servo:
-                    await asyncio.gather(pan_servo.home(4082), tilt_servo.home(4082))
+            async with Bus(port, baudrate=baudrate, capture_path=self._args.capture) as bus:
+                async with bus.servo(1, profile=self._args.profile) as pan_servo:
+                    async with bus.servo(2, profile=self._args.profile) as tilt_servo:
+                        await asyncio.gather(pan_servo.home(4082), tilt_servo.home(4082))
         elif sub_command == "query":
             try:
-                async with Servo(port, self._args.id, enable_torque_on_connect=False) as servo:
-                    while True:
-                        pos = await servo.current_position()
-                        print("{}: Servo {} -> {}".format(port, self._args.id, pos))
-                        await asyncio.sleep(1)
+                bus = Bus(port, baudrate=baudrate, capture_path=self._args.capture)
+                async with Servo(
+                    bus, self._args.id, enable_torque_on_connect=False, profile=self._args.profile
+                ) as servo:
+                    async with servo.telemetry(rate_hz=self._args.rate) as stream:
+                        async for frame in stream:
+                            print("{}: Servo {} -> {}".format(port, self._args.id, frame.values(self._args.id)))
             except KeyboardInterrupt as _:
                 print("done")
+        elif sub_command == "scan":
+            async with Bus(port, baudrate=baudrate, capture_path=self._args.capture) as bus:
+                started = time.monotonic()
+                found = 0
+                async for servo in bus.scan(self._args.expect):
+                    found += 1
+                    print(
+                        "[ID:{:03d}] model {} firmware {} ({:.1f} ms)".format(
+                            servo.device_id,
+                            servo.model_number,
+                            servo.firmware_version,
+                            (time.monotonic() - started) * 1000.0,
+                        )
+                    )
+                print("{} servo(s) found in {:.1f} ms".format(found, (time.monotonic() - started) * 1000.0))
+        elif sub_command == "profile":
+            async with Bus(port, baudrate=baudrate, capture_path=self._args.capture) as bus:
+                device_ids = self._args.ids
+                if device_ids is None:
+                    device_ids = [servo.device_id async for servo in bus.scan()]
+                results = await latency_bench.run(bus, device_ids, self._args.payloads, self._args.samples)
+            for result in results:
+                print(latency_bench.format_result(result))
+            recommendations = latency_bench.recommend(results)
+            if recommendations:
+                print("Recommended:")
+                for line in recommendations:
+                    print("  {}".format(line))
+            document = latency_bench.report(results, port=port, host=platform.node(), ids=device_ids)
+            if self._args.output == "-":
+                json.dump(document, sys.stdout, indent=2)
+                print()
+            elif self._args.output is not None:
+                with open(self._args.output, "w") as f:
+                    json.dump(document, f, indent=2)
+            if self._args.compare is not None:
+                for line in latency_bench.compare(latency_bench.load(self._args.compare), document):
+                    print(line)
         else:
             self._logger.debug("Unknown sub command {}".format(sub_command))
             return -2
             
         return 0
+
+
+class AsyncBenchRunner(AsyncRunner):
+
+    @classmethod
+    def visit_add_parser(self, sub_parsers: argparse._SubParsersAction) -> argparse.ArgumentParser:
+        subparser: argparse.ArgumentParser = sub_parsers.add_parser(
+            "bench", help="Measure bus throughput and latency (see dragon_stand.bench.bus)."
+        )
+        subparser.add_argument("--port", default="/dev/ttyUSB0")
+        subparser.add_argument("--baudrate", default=Bus.DEFAULT_BAUDRATE, type=int, help="The bus's current rate.")
+        subparser.add_argument("--protocol", default=1.0, type=float, choices=(1.0, 2.0))
+        subparser.add_argument("--ids", nargs="+", type=int, default=[1, 2], help="Servos to benchmark.")
+        subparser.add_argument("--baudrates", nargs="+", type=int, help="Rates to move the bus through.")
+        subparser.add_argument("--servo-counts", nargs="+", type=int, help="Benchmark the first N servos for each N.")
+        subparser.add_argument("--operations", nargs="+", choices=bus_bench.OPERATIONS, default=bus_bench.OPERATIONS)
+        subparser.add_argument("--transactions", type=int, default=bus_bench.DEFAULT_TRANSACTIONS)
+        subparser.add_argument(
+            "--sim", action="store_true", help="Benchmark a simulated bus (dragon_stand.sim) instead of --port."
+        )
+        subparser.add_argument("--output", "-o", help="Write the JSON results here ('-' for stdout).")
+        subparser.add_argument("--compare", help="JSON results of an earlier run to compare against.")
+        return subparser
+
+    @classmethod
+    def visit_setargs(self, parser: argparse.ArgumentParser) -> typing.List[argparse.ArgumentParser]:
+        return []
+
+    async def run(self) -> int:
+        args = self._args
+        if args.sim:
+            from ..sim import MX_LAYOUT, X_LAYOUT, BusSimulator, SimulatedServo
+            from ..mech import baud
+
+            servos = [SimulatedServo(i, X_LAYOUT if args.protocol == 2.0 else MX_LAYOUT) for i in args.ids]
+            for servo in servos:
+                servo.table[servo.layout.baud_rate_address] = baud.baud_rate_register_value(
+                    args.baudrate, args.protocol
+                )
+            with BusSimulator(servos) as simulator:
+                results = await self._run(simulator.port_name)
+        else:
+            results = await self._run(args.port)
+
+        for result in results:
+            print(bus_bench.format_result(result))
+        document = bus_bench.report(results, port="sim" if args.sim else args.port, ids=args.ids)
+        if args.output == "-":
+            json.dump(document, sys.stdout, indent=2)
+            print()
+        elif args.output is not None:
+            with open(args.output, "w") as f:
+                json.dump(document, f, indent=2)
+        if args.compare is not None:
+            for line in bus_bench.compare(bus_bench.load(args.compare), document):
+                print(line)
+        return 0
+
+    async def _run(self, port: str) -> typing.List[bus_bench.BenchResult]:
+        args = self._args
+        async with Bus(port, args.protocol, args.baudrate) as bus:
+            return await bus_bench.run(
+                bus, args.ids, args.baudrates, args.servo_counts, args.operations, args.transactions
+            )
@@ -5,6 +5,7 @@
 """
 Utilities for working with the Dynamixel servos on the test stand.
 """
+
 import abc
 import asyncio
 import contextlib
@@ -14,6 +15,14 @@ import types
 from contextlib import asynccontextmanager
 
 from . import dynamixel_sdk
+from .bus import Bus, ScanResult
+from .motion import DEFAULT_TOLERANCE, MotionWaiter
+from .multibus import BusManager, ThreadedBus
+from .profiles import PROFILES, StatusProfile
+from .scheduler import Priority, TransactionDroppedError
+from .shadow import ShadowTable
+from .telemetry import DEFAULT_CAPACITY, DEFAULT_RATE_HZ, Register, TelemetryFrame, TelemetryStream
+from .trajectory import MinimumJerk, Path, Spline, Trajectory, TrajectoryReport, TrajectoryStream, Trapezoidal
 
 
 class _ServoCommunicationError(RuntimeError):
@@ -53,32 +62,63 @@ class _Servo(contextlib.AbstractAsyncContextManager):
 
 
 class _Dynamixel(_Servo):
-    DEFAULT_BAUDRATE = 57600
-    # Control table address
+    DEFAULT_BAUDRATE = Bus.DEFAULT_BAUDRATE
+    HOME_TIMEOUT = 10.0  # seconds home() waits for the servo to get there
+    # Control table addresses of the MX series (Protocol 1.0). The servo itself is driven through the fields of its
+    # shadow, which are laid out for the bus's protocol.
     ADDR_MX_TORQUE_ENABLE = 24
     ADDR_MX_GOAL_POSITION = 30
     ADDR_MX_PRESENT_POSITION = 36
 
     def __init__(
-        self, device_name: str, device_id: int, protocol_version: float = 1.0, enable_torque_on_connect: bool = True
+        self,
+        bus: typing.Union[Bus, str],
+        device_id: int,
+        protocol_version: float = 1.0,
+        enable_torque_on_connect: bool = True,
+        baudrate: int = DEFAULT_BAUDRATE,
+        profile: typing.Optional[str] = None,
     ):
+        """
+        :param profile: Name of a :mod:`~dragon_stand.mech.profiles` profile to apply (and verify) at connect.
+        """
         super().__init__()
-        self._port_handler = dynamixel_sdk.PortHandler(device_name)
+        if profile is not None and profile not in PROFILES:
+            raise ValueError("Unknown profile {}; expected one of {}".format(profile, ", ".join(PROFILES)))
+        # A device name instead of a bus gets the servo a private bus (the original one-port-per-servo behaviour).
+        self._bus = bus if isinstance(bus, Bus) else Bus(bus, protocol_version, baudrate)
         self._device_id = device_id
-        self._packet_handler = dynamixel_sdk.Protocol1PacketHandler()
+        self._packet_handler = self._bus.packet_handler
+        self._bus_open = False
         self._connected = False
         self._enable_torque_on_connect = enable_torque_on_connect
+        self._profile = None if profile is None else PROFILES[profile]
+
+    @property
+    def bus(self) -> Bus:
+        return self._bus
+
+    @property
+    def device_id(self) -> int:
+        return self._device_id
 
     @property
     def is_connected(self) -> bool:
         return self._connected
 
     async def connect(self) -> bool:
-        if not self._port_handler.openPort():
+        if not await self._bus.open():
             return False
+        self._bus_open = True
         try:
-            self._logger.debug("Connecting to servo {} on {}".format(self._device_id, self._port_handler.port_name))
-            self._connected = self._port_handler.setBaudRate(self.DEFAULT_BAUDRATE)
+            self._logger.debug("Connecting to servo {} on {}".format(self._device_id, self._bus.device_name))
+            self._connected = True
+            if self._profile is not None:
+                if not await self.apply_profile(self._profile.name):
+                    raise _ServoCommunicationError("Failed to apply the {} profile".format(self._profile.name))
+            elif await self.read_register(self.shadow.field("status_return_level").address, 1) is None:
+                # writes are sent as if acknowledged until the level is known
+                self._logger.debug("Could not read the status return level of servo {}".format(self._device_id))
             if self._enable_torque_on_connect:
                 if not await self.enable_torque(True):
                     raise _ServoCommunicationError("Failed to enable torque")
@@ -91,23 +131,126 @@ class _Dynamixel(_Servo):
 
     async def disconnect(self) -> None:
         if self._connected:
-            result, error = self._write1ByteTxRx(self.ADDR_MX_TORQUE_ENABLE, 0)
-            if self._enable_torque_on_connect:
-                if not await self.enable_torque(False):
-                    self._logger.warning("Failed to disable torque")
+            if not await self.enable_torque(False):
+                self._logger.warning("Failed to disable torque")
             self._logger.debug("Dynamixel has been successfully disconnected")
-        self._port_handler.closePort()
+        if self._bus_open:
+            self._bus_open = False
+            await self._bus.close()
         self._connected = False
 
-    async def enable_torque(self, enable: bool) -> bool:
-        result, error = self._write1ByteTxRx(self.ADDR_MX_TORQUE_ENABLE, (1 if enable else 0))
-        if result != dynamixel_sdk.COMM_SUCCESS:
+    @property
+    def shadow(self) -> ShadowTable:
+        """
+        What is known about this servo's control table (shared with every other handle to it on the bus).
+        """
+        return self._bus.shadow(self._device_id)
+
+    @property
+    def profile(self) -> typing.Optional[StatusProfile]:
+        """
+        The profile last applied, if any.
+        """
+        return self._profile
+
+    async def apply_profile(self, name: str) -> bool:
+        """
+        Set the servo's Return Delay Time and Status Return Level to the :mod:`~dragon_stand.mech.profiles` profile
+        ``name`` and read both back. Returns ``False`` if the servo did not end up with them.
+        """
+        profile = PROFILES[name]
+        return_delay = self.shadow.field("return_delay_time").address
+        status_level = self.shadow.field("status_return_level").address
+
+        # knowing the current level first tells the batcher whether the return delay write will be answered
+        current_level = await self.read_register(status_level, 1)
+        if current_level is None:
             return False
+        if not await self.write_register(return_delay, 1, profile.return_delay_time):
+            return False
+        if current_level != profile.status_return_level:
+            # whether the servo answers the write that changes whether it answers writes depends on the model, so send
+            # it without waiting and then swallow the answer if one comes
+            device_id = self._device_id
+
+            async def _write_level(port: typing.Any, ph: typing.Any) -> int:
+                result = int(ph.write1ByteTxOnly(port, device_id, status_level, profile.status_return_level))
+                if result == dynamixel_sdk.COMM_SUCCESS:
+                    port.setPacketTimeout(11 if ph.getProtocolVersion() == 2.0 else 6, device_id)
+                    await ph.rxPacketAsync(port)
+                return result
+
+            if await self._bus.transact(_write_level, Priority.CONTROL) != dynamixel_sdk.COMM_SUCCESS:
+                return False
+
+        # the verifying reads bypass the shadow
+        self.shadow.invalidate(return_delay, 1)
+        self.shadow.invalidate(status_level, 1)
+        verified = (
+            await self.read_register(return_delay, 1) == profile.return_delay_time
+            and await self.read_register(status_level, 1) == profile.status_return_level
+        )
+        # latency learned under the old return delay no longer applies
+        round_trip = self._bus.port_handler.getRoundTripEstimator()
+        if round_trip is not None:
+            round_trip.clear(self._device_id)
+        if verified:
+            self._profile = profile
         else:
-            return True
+            self._logger.warning("Servo {} did not take the {} profile".format(self._device_id, name))
+        return verified
+
+    async def enable_torque(self, enable: bool) -> bool:
+        torque_enable = self.shadow.field("torque_enable")
+        return await self.write_register(torque_enable.address, torque_enable.size, (1 if enable else 0))
+
+    async def read_register(
+        self, addr: int, length: int, max_staleness: typing.Optional[float] = None
+    ) -> typing.Optional[int]:
+        """
+        Read ``length`` bytes at ``addr``, from the shadow if it holds a fresh enough copy (see
+        :meth:`ShadowTable.get` for ``max_staleness``). ``None`` if the servo did not answer.
+        """
+        cached = self.shadow.get(addr, length, max_staleness)
+        if cached is not None:
+            return cached
+        data, result, error = await self._readTxRx(addr, length)
+        if result != dynamixel_sdk.COMM_SUCCESS or error != 0:
+            return None
+        return int(dynamixel_sdk.unpackValue(data, 0, length))
+
+    async def write_register(self, addr: int, length: int, value: int) -> bool:
+        """
+        Write ``value`` to ``length`` bytes at ``addr`` (and anything else staged) unless the servo is known to hold
+        it already.
+        """
+        self.stage(addr, length, value)
+        return await self.flush()
+
+    def stage(self, addr: int, length: int, value: int) -> bool:
+        """
+        Queue a register write for the next :meth:`flush`. Returns ``False`` if the write would change nothing.
+        """
+        return self.shadow.stage(addr, dynamixel_sdk.packValue(value, length))
+
+    async def flush(self) -> bool:
+        """
+        Write every staged register. The runs go out together, so the bus batcher can merge them with each other and
+        with writes from other handles to this servo.
+        """
+        ranges = self.shadow.dirty_ranges()
+        results = await asyncio.gather(*(self._writeTxRx(addr, data) for addr, data in ranges))
+        success = True
+        for (addr, data), (result, error) in zip(ranges, results):
+            if result != dynamixel_sdk.COMM_SUCCESS or error != 0:
+                self.shadow.discard(addr, len(data))
+                success = False
+        return success
 
     async def ping(self) -> bool:
-        dxl_model_number, dxl_comm_result, dxl_error = self._packet_handler.ping(self._port_handler, self._device_id)
+        dxl_model_number, dxl_comm_result, dxl_error = await self._bus.transact(
+            lambda port, ph: ph.pingAsync(port, self._device_id), Priority.DIAGNOSTICS
+        )
         if dxl_comm_result != dynamixel_sdk.COMM_SUCCESS:
             print("%s" % self._packet_handler.getTxRxResult(dxl_comm_result))
             return False
@@ -118,37 +261,82 @@ class _Dynamixel(_Servo):
             print("[ID:%03d] ping Succeeded. Dynamixel model number : %d" % (self._device_id, dxl_model_number))
             return True
 
-    async def current_position(self) -> int:
-        data, result, error = self._read2ByteTxRx(self.ADDR_MX_PRESENT_POSITION)
-        if result != dynamixel_sdk.COMM_SUCCESS or error != 0:
-            return -1
-        else:
-            return data
+    def telemetry(
+        self,
+        registers: typing.Optional[typing.Iterable[Register]] = None,
+        rate_hz: float = DEFAULT_RATE_HZ,
+        capacity: int = DEFAULT_CAPACITY,
+    ) -> TelemetryStream:
+        """
+        A :class:`TelemetryStream` of just this servo. See :meth:`Bus.telemetry`.
+        """
+        return self._bus.telemetry([self._device_id], registers, rate_hz, capacity)
+
+    async def current_position(self, max_staleness: typing.Optional[float] = None) -> int:
+        """
+        :param max_staleness: Accept a position the bus saw up to this many seconds ago (e.g. from a
+            :meth:`telemetry` stream) instead of reading it now.
+        """
+        present_position = self.shadow.field("present_position")
+        position = await self.read_register(present_position.address, present_position.size, max_staleness)
+        return -1 if position is None else position
 
-    async def home(self, home_override: typing.Optional[int] = None) -> bool:
+    async def home(
+        self, home_override: typing.Optional[int] = None, timeout: typing.Optional[float] = HOME_TIMEOUT
+    ) -> bool:
+        """
+        :returns: ``False`` if the servo did not settle at home within ``timeout`` seconds (``None`` waits forever).
+        """
         goal_pos = 0 if home_override is None else home_override
-        result, error = self._write2ByteTxRx(self.ADDR_MX_GOAL_POSITION, goal_pos)
-        if result != dynamixel_sdk.COMM_SUCCESS:
+        goal_position = self.shadow.field("goal_position")
+        if not await self.write_register(goal_position.address, goal_position.size, goal_pos):
             return False
+        return await self.wait_until_settled(goal_pos, timeout=timeout)
 
-        data = 0xFFFFFF
-        while True:
-            await asyncio.sleep(0.1)
-            data, result, error = self._read2ByteTxRx(self.ADDR_MX_PRESENT_POSITION)
-            if result != dynamixel_sdk.COMM_SUCCESS or error != 0:
-                return False
-            else:
-                self._logger.debug("Current position ({}): {}".format(self._device_id, data))
-            if data > goal_pos - 10 and data < goal_pos + 10:
-                break
+    async def wait_until_settled(
+        self,
+        goal: typing.Optional[int] = None,
+        tolerance: int = DEFAULT_TOLERANCE,
+        timeout: typing.Optional[float] = None,
+    ) -> bool:
+        """
+        Wait for the servo to stop moving within ``tolerance`` of ``goal`` (or anywhere, without one). Servos on the
+        same bus waiting at the same time are polled together (see :mod:`~dragon_stand.mech.motion`).
 
-        return True
+        :returns: ``False`` if ``timeout`` seconds passed first or the servo stopped answering.
+        """
+        return await self._bus.motion().settled(self._device_id, goal, tolerance, timeout)
 
-    def _read2ByteTxRx(self, addr: int) -> typing.Tuple[int, int, int]:
-        return self._packet_handler.read2ByteTxRx(self._port_handler, self._device_id, addr)
+    def _priority_of(self, addr: int) -> Priority:
+        if addr == self.shadow.field("torque_enable").address:
+            return Priority.EMERGENCY
+        elif addr == self.shadow.field("present_position").address:
+            return Priority.TELEMETRY
+        else:
+            return Priority.CONTROL
+
+    def _note_result(self, result: int, error: int) -> None:
+        if result == dynamixel_sdk.COMM_SUCCESS:
+            self.shadow.note_status(error)
+        elif result != dynamixel_sdk.COMM_PORT_BUSY:
+            self.shadow.note_lost()
 
-    def _write2ByteTxRx(self, addr: int, value: int) -> typing.Tuple[int, int]:
-        return self._packet_handler.write2ByteTxRx(self._port_handler, self._device_id, addr, value)
+    async def _readTxRx(self, addr: int, length: int) -> typing.Tuple[typing.Any, int, int]:
+        try:
+            data, result, error = await self._bus.batcher(self._device_id).read(addr, length, self._priority_of(addr))
+        except TransactionDroppedError as e:
+            self._logger.debug("Servo {}: {}".format(self._device_id, e))
+            return b"", dynamixel_sdk.COMM_PORT_BUSY, 0
+        self._note_result(result, error)
+        if result == dynamixel_sdk.COMM_SUCCESS and error == 0:
+            self.shadow.update(addr, data)
+        return data, result, error
 
-    def _write1ByteTxRx(self, addr: int, value: int) -> typing.Tuple[int, int]:
-        return self._packet_handler.write1ByteTxRx(self._port_handler, self._device_id, addr, value)
+    async def _writeTxRx(self, addr: int, data: bytes) -> typing.Tuple[int, int]:
+        result, error = await self._bus.batcher(self._device_id).write(addr, data, self._priority_of(addr))
+        self._note_result(result, error)
+        if result == dynamixel_sdk.COMM_SUCCESS and error == 0:
+            self.shadow.update(addr, data)
+        else:
+            self.shadow.invalidate(addr, len(data))
+        return result, error
@@ -0,0 +1,208 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+Merging of register accesses to one servo that are issued in the same event loop tick.
+
+Every access costs a whole instruction and status packet (and a round trip) however few bytes it moves, so a
+:class:`RegisterBatcher` holds the reads and writes it is handed until the running callbacks have had their turn, then
+sends each cluster of nearby addresses as a single ``readTxRx``/``writeTxRx`` and hands every caller its own slice of
+the result.
+
+* Reads merge when the gap between them is at most ``read_gap`` bytes (reading a few extra bytes is cheaper than
+  another round trip).
+* Writes merge when they are contiguous, or when every byte between them is host-owned RAM whose value the shadow
+  already knows (it is written back unchanged). Overlapping writes keep the last value written.
+* Writes go out before reads, so a read issued after a write in the same tick sees the written value.
+* Writes to a servo whose Status Return Level says it will not answer them are sent with ``writeTxOnly``.
+"""
+
+import asyncio
+import typing
+
+from . import dynamixel_sdk
+from .scheduler import Priority
+
+if typing.TYPE_CHECKING:
+    from .bus import Bus
+
+DEFAULT_READ_GAP = 4
+"""Largest number of unrequested bytes read to join two reads."""
+
+DEFAULT_MAX_SPAN = 128
+"""Largest merged access in bytes."""
+
+
+class _Access:
+    __slots__ = ("sequence", "address", "length", "data", "priority", "future")
+
+    def __init__(self, sequence: int, address: int, length: int, data: typing.Optional[bytes], priority: Priority):
+        self.sequence = sequence
+        self.address = address
+        self.length = length
+        self.data = data
+        self.priority = priority
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class RegisterBatcher:
+    """
+    Batches register accesses to servo ``device_id`` on ``bus``.
+    """
+
+    def __init__(self, bus: "Bus", device_id: int, read_gap: int = DEFAULT_READ_GAP, max_span: int = DEFAULT_MAX_SPAN):
+        self._bus = bus
+        self._device_id = device_id
+        self._read_gap = read_gap
+        self._max_span = max_span
+        self._reads: typing.List[_Access] = []
+        self._writes: typing.List[_Access] = []
+        self._scheduled = False
+        self.requests = 0
+        """Accesses handed to the batcher."""
+        self.transactions = 0
+        """Bus transactions they were sent as."""
+
+    async def read(
+        self, address: int, length: int, priority: Priority = Priority.CONTROL
+    ) -> typing.Tuple[bytes, int, int]:
+        """
+        ``(data, result, error)`` like ``readTxRx``.
+
+        :raises TransactionDroppedError: if the merged read was dropped by the bus scheduler.
+        """
+        access = _Access(self.requests, address, length, None, priority)
+        self._reads.append(access)
+        self._schedule()
+        return typing.cast(typing.Tuple[bytes, int, int], await access.future)
+
+    async def write(self, address: int, data: bytes, priority: Priority = Priority.CONTROL) -> typing.Tuple[int, int]:
+        """
+        ``(result, error)`` like ``writeTxRx``.
+        """
+        access = _Access(self.requests, address, len(data), bytes(data), priority)
+        self._writes.append(access)
+        self._schedule()
+        return typing.cast(typing.Tuple[int, int], await access.future)
+
+    def _schedule(self) -> None:
+        self.requests += 1
+        if not self._scheduled:
+            self._scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    def _flush(self) -> None:
+        self._scheduled = False
+        writes, self._writes = self._writes, []
+        reads, self._reads = self._reads, []
+        for group in self._merge_writes(writes):
+            asyncio.ensure_future(self._send_write(group))
+        for group in self._merge_reads(reads):
+            asyncio.ensure_future(self._send_read(group))
+
+    def _merge_reads(self, reads: typing.List[_Access]) -> typing.List[typing.List[_Access]]:
+        groups: typing.List[typing.List[_Access]] = []
+        end = 0
+        for access in sorted(reads, key=lambda a: a.address):
+            if groups:
+                start = groups[-1][0].address
+                if (
+                    access.address <= end + self._read_gap
+                    and max(end, access.address + access.length) - start <= self._max_span
+                ):
+                    groups[-1].append(access)
+                    end = max(end, access.address + access.length)
+                    continue
+            groups.append([access])
+            end = access.address + access.length
+        return groups
+
+    def _merge_writes(self, writes: typing.List[_Access]) -> typing.List[typing.List[_Access]]:
+        groups: typing.List[typing.List[_Access]] = []
+        shadow = self._bus.shadow(self._device_id)
+        end = 0
+        for access in sorted(writes, key=lambda a: a.address):
+            if groups:
+                start = groups[-1][0].address
+                joined = max(end, access.address + access.length) - start <= self._max_span
+                if joined and access.address > end:
+                    joined = shadow.get_known_ram(end, access.address - end) is not None
+                if joined:
+                    groups[-1].append(access)
+                    end = max(end, access.address + access.length)
+                    continue
+            groups.append([access])
+            end = access.address + access.length
+        return groups
+
+    async def _send_read(self, group: typing.List[_Access]) -> None:
+        start = group[0].address
+        length = max(a.address + a.length for a in group) - start
+        device_id = self._device_id
+        self.transactions += 1
+        try:
+            data, result, error = await self._bus.transact(
+                lambda port, ph: ph.readTxRxAsync(port, device_id, start, length),
+                min(a.priority for a in group),
+                coalesce_key=(device_id, start, length),
+            )
+        except Exception as e:
+            for access in group:
+                if not access.future.done():
+                    access.future.set_exception(e)
+            return
+        for access in group:
+            if not access.future.done():
+                offset = access.address - start
+                value = bytes(data[offset : offset + access.length]) if result == dynamixel_sdk.COMM_SUCCESS else b""
+                access.future.set_result((value, result, error))
+
+    async def _send_write(self, group: typing.List[_Access]) -> None:
+        start = group[0].address
+        end = max(a.address + a.length for a in group)
+        shadow = self._bus.shadow(self._device_id)
+        data = bytearray(end - start)
+        covered = bytearray(end - start)
+        # in submission order so the last write to a byte wins
+        for access in sorted(group, key=lambda a: a.sequence):
+            offset = access.address - start
+            data[offset : offset + access.length] = typing.cast(bytes, access.data)
+            covered[offset : offset + access.length] = b"\x01" * access.length
+        # fill the gaps merging allowed with what the servo already holds
+        offset = 0
+        while offset < len(covered):
+            if covered[offset]:
+                offset += 1
+                continue
+            gap_end = covered.find(b"\x01", offset)
+            known = shadow.get_known_ram(start + offset, gap_end - offset)
+            if known is None:
+                # the shadow changed since the merge; fall back to separate writes
+                for access in group:
+                    asyncio.ensure_future(self._send_write([access]))
+                return
+            data[offset:gap_end] = known
+            offset = gap_end
+
+        device_id = self._device_id
+        payload = bytes(data)
+        transaction: typing.Callable[[typing.Any, typing.Any], typing.Awaitable[typing.Tuple[int, int]]]
+        if shadow.acknowledges_writes():
+            transaction = lambda port, ph: ph.writeTxRxAsync(port, device_id, start, len(payload), payload)
+        else:
+            # the servo will not answer, so do not wait for it to (see dragon_stand.mech.profiles)
+            async def transaction(port: typing.Any, ph: typing.Any) -> typing.Tuple[int, int]:
+                return ph.writeTxOnly(port, device_id, start, len(payload), payload), 0
+
+        self.transactions += 1
+        try:
+            result = await self._bus.transact(transaction, min(a.priority for a in group))
+        except Exception as e:
+            for access in group:
+                if not access.future.done():
+                    access.future.set_exception(e)
+            return
+        for access in group:
+            if not access.future.done():
+                access.future.set_result(result)
@@ -0,0 +1,171 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+Moving a bus to another baud rate and finding the rate a servo is listening at.
+
+Everything here is written as a bus :data:`~dragon_stand.mech.bus.Transaction` so it runs with the port to itself;
+:class:`~dragon_stand.mech.bus.Bus` wraps them as :meth:`~dragon_stand.mech.bus.Bus.set_baudrate` and
+:meth:`~dragon_stand.mech.bus.Bus.discover_baudrates`.
+"""
+import asyncio
+import typing
+
+from . import dynamixel_sdk
+
+ADDR_MX_BAUD_RATE = 4
+"""Protocol 1.0 (MX/AX) baud rate register."""
+
+ADDR_X_BAUD_RATE = 8
+"""Protocol 2.0 (X series) baud rate register."""
+
+BAUD_TOLERANCE = 0.03
+"""Largest relative error between a requested rate and what the servo's divider produces that still communicates."""
+
+# Protocol 1.0 servos run at 2 Mbaud / (value + 1) except for these
+_MX_SPECIAL_RATES = {250: 2250000, 251: 2500000, 252: 3000000}
+
+_X_RATES = {0: 9600, 1: 57600, 2: 115200, 3: 1000000, 4: 2000000, 5: 3000000, 6: 4000000, 7: 4500000}
+
+DISCOVERY_CANDIDATES: typing.Tuple[int, ...] = (
+    57600,
+    1000000,
+    115200,
+    2000000,
+    3000000,
+    2500000,
+    2250000,
+    4000000,
+    500000,
+    400000,
+    250000,
+    200000,
+    19200,
+    9600,
+)
+"""Baud rates tried by discovery, most likely first. Rates a protocol cannot express are skipped."""
+
+SWITCH_SETTLE_SECONDS = 0.05
+"""Time allowed for the servos to store the new rate (EEPROM) and switch over."""
+
+
+def register_baud_rate(value: int, protocol_version: float = 1.0) -> int:
+    """
+    The baud rate a baud rate register ``value`` selects.
+    """
+    if protocol_version == 2.0:
+        if value not in _X_RATES:
+            raise ValueError("{} is not a Protocol 2.0 baud rate setting".format(value))
+        return _X_RATES[value]
+    if value in _MX_SPECIAL_RATES:
+        return _MX_SPECIAL_RATES[value]
+    if value < 0 or value > 249:
+        raise ValueError("{} is not a Protocol 1.0 baud rate setting".format(value))
+    return int(round(2000000.0 / (value + 1)))
+
+
+def baud_rate_register_value(baudrate: int, protocol_version: float = 1.0) -> int:
+    """
+    The baud rate register value that selects ``baudrate``.
+
+    :raises ValueError: if no setting comes within :data:`BAUD_TOLERANCE` of ``baudrate``.
+    """
+    if protocol_version == 2.0:
+        candidates: typing.Iterable[int] = _X_RATES.keys()
+    else:
+        divider = int(round(2000000.0 / baudrate)) - 1
+        candidates = [v for v in (divider - 1, divider, divider + 1) if 0 <= v <= 249] + list(_MX_SPECIAL_RATES)
+    best = min(candidates, key=lambda v: abs(register_baud_rate(v, protocol_version) - baudrate))
+    if abs(register_baud_rate(best, protocol_version) - baudrate) > baudrate * BAUD_TOLERANCE:
+        raise ValueError("Protocol {} servos cannot run at {} baud".format(protocol_version, baudrate))
+    return best
+
+
+def is_supported(baudrate: int, protocol_version: float = 1.0) -> bool:
+    try:
+        baud_rate_register_value(baudrate, protocol_version)
+    except ValueError:
+        return False
+    return True
+
+
+def _baud_rate_address(protocol_version: float) -> int:
+    return ADDR_X_BAUD_RATE if protocol_version == 2.0 else ADDR_MX_BAUD_RATE
+
+
+async def _answers(port: typing.Any, ph: typing.Any, device_id: int, attempts: int = 3) -> bool:
+    for _ in range(attempts):
+        _, result, _ = await ph.pingAsync(port, device_id)
+        if result == dynamixel_sdk.COMM_SUCCESS:
+            return True
+    return False
+
+
+async def _broadcast_baud_rate(port: typing.Any, ph: typing.Any, value: int) -> bool:
+    result = ph.write1ByteTxOnly(port, dynamixel_sdk.BROADCAST_ID, _baud_rate_address(ph.getProtocolVersion()), value)
+    # the instruction must be fully on the wire before the port changes rate
+    port.clearPort()
+    await asyncio.sleep(SWITCH_SETTLE_SECONDS)
+    return bool(result == dynamixel_sdk.COMM_SUCCESS)
+
+
+async def change_baud_rate(port: typing.Any, ph: typing.Any, baudrate: int, device_ids: typing.Sequence[int]) -> bool:
+    """
+    Move every servo on the bus and then the port to ``baudrate``.
+
+    The new setting is broadcast so the bus can never be left split across two rates. ``device_ids`` must all answer
+    at the current rate before anything is changed and at the new rate afterwards; if any of them goes missing the
+    bus is moved back to where it was and ``False`` is returned.
+    """
+    protocol_version = ph.getProtocolVersion()
+    old_baudrate = port.getBaudRate()
+    value = baud_rate_register_value(baudrate, protocol_version)
+    old_value = baud_rate_register_value(old_baudrate, protocol_version)
+
+    for device_id in device_ids:
+        if not await _answers(port, ph, device_id):
+            return False
+
+    if not await _broadcast_baud_rate(port, ph, value):
+        return False
+    if port.setBaudRate(baudrate):
+        for device_id in device_ids:
+            if not await _answers(port, ph, device_id):
+                break
+        else:
+            return True
+        # roll back: whoever did switch is listening at the new rate
+        await _broadcast_baud_rate(port, ph, old_value)
+    port.setBaudRate(old_baudrate)
+    return False
+
+
+async def find_baud_rates(
+    port: typing.Any,
+    ph: typing.Any,
+    device_ids: typing.Iterable[int],
+    candidates: typing.Optional[typing.Iterable[int]] = None,
+) -> typing.Dict[int, int]:
+    """
+    Ping ``device_ids`` at each candidate rate (the port's current rate first) and return ``{device_id: baudrate}`` for
+    every servo that answered. Stops as soon as all of them have been found; the port is left at its original rate.
+    """
+    protocol_version = ph.getProtocolVersion()
+    original = port.getBaudRate()
+    rates = [original] + [b for b in (candidates or DISCOVERY_CANDIDATES) if b != original]
+    missing = sorted(set(device_ids))
+    found: typing.Dict[int, int] = {}
+    try:
+        for baudrate in rates:
+            if not missing:
+                break
+            if not is_supported(baudrate, protocol_version) or not port.setBaudRate(baudrate):
+                continue
+            for device_id in missing:
+                if await _answers(port, ph, device_id, attempts=1):
+                    found[device_id] = baudrate
+            missing = [i for i in missing if i not in found]
+    finally:
+        port.setBaudRate(original)
+    return found
@@ -0,0 +1,367 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+A single half-duplex Dynamixel bus shared by every servo attached to it.
+"""
+
+import asyncio
+import contextlib
+import functools
+import logging
+import types
+import typing
+
+from . import baud, dynamixel_sdk
+from .batching import RegisterBatcher
+from .motion import DEFAULT_TOLERANCE, MotionWaiter
+from .scheduler import Priority, TransactionScheduler
+from .shadow import CONTROL_TABLES, ShadowTable
+from .telemetry import DEFAULT_CAPACITY, DEFAULT_RATE_HZ, Register, TelemetryStream
+from .trajectory import Trajectory, TrajectoryStream
+
+if typing.TYPE_CHECKING:
+    from . import _Dynamixel
+
+T = typing.TypeVar("T")
+
+Transaction = typing.Callable[[typing.Any, typing.Any], typing.Awaitable[T]]
+"""
+A coroutine function taking ``(port_handler, packet_handler)`` and performing exactly one exchange on the bus. It
+returns what it read and leaves updating the bus's shadows to its caller, since on a
+:class:`~dragon_stand.mech.multibus.ThreadedBus` it runs on another thread.
+"""
+
+
+class ScanResult(typing.NamedTuple):
+    """
+    A servo found by :meth:`Bus.scan`.
+    """
+
+    device_id: int
+    model_number: int
+    firmware_version: int
+
+
+class Bus(contextlib.AbstractAsyncContextManager):
+    """
+    Owns one :class:`dynamixel_sdk.PortHandler` and serializes every transaction on it through an async queue so any
+    number of servo handles can share the port without tripping over each other (or over ``port.is_using``). The queue
+    is a :class:`~dragon_stand.mech.scheduler.TransactionScheduler` so control traffic is never stuck behind telemetry.
+
+    The port is opened by the first :meth:`open` and closed by the matching last :meth:`close` so servos created with
+    :meth:`servo` can connect and disconnect independently.
+    """
+
+    DEFAULT_BAUDRATE = 57600
+
+    def __init__(
+        self,
+        device_name: str,
+        protocol_version: float = 1.0,
+        baudrate: int = DEFAULT_BAUDRATE,
+        deadlines: typing.Optional[typing.Mapping[Priority, typing.Optional[float]]] = None,
+        adaptive_timeout_percentile: typing.Optional[float] = None,
+        low_latency: bool = True,
+        capture_path: typing.Optional[str] = None,
+        port_handler: typing.Optional[typing.Any] = None,
+    ):
+        """
+        :param low_latency: Put the USB-serial adapter in low-latency mode when the port opens (see
+            :func:`dynamixel_sdk.applyLowLatency`). Failures, e.g. no write access to sysfs, are logged and ignored.
+        :param adaptive_timeout_percentile: If set, each servo's reply timeout is learned from this percentile of its
+            observed round trips instead of the SDK's fixed ~34 ms allowance (see
+            :class:`dynamixel_sdk.RoundTripEstimator`).
+        :param capture_path: Record all traffic to this file while the bus is open (see
+            :mod:`dynamixel_sdk.capture`). Reopening the bus appends to it.
+        :param port_handler: Use this port instead of a :class:`dynamixel_sdk.PortHandler` for ``device_name``, e.g. a
+            :class:`dynamixel_sdk.ReplayPortHandler` to run the stack against a capture.
+        """
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._port_handler = dynamixel_sdk.PortHandler(device_name) if port_handler is None else port_handler
+        if adaptive_timeout_percentile is not None:
+            self._port_handler.enableAdaptiveTimeout(percentile=adaptive_timeout_percentile)
+        self._packet_handler = dynamixel_sdk.PacketHandler(protocol_version)
+        self._baudrate = baudrate
+        self._low_latency = low_latency
+        self._capture_path = capture_path
+        self._shadows: typing.Dict[int, ShadowTable] = {}
+        self._batchers: typing.Dict[int, RegisterBatcher] = {}
+        self._motion: typing.Optional[MotionWaiter] = None
+        self._latency_report: typing.Optional[typing.Any] = None
+        self._open_count = 0
+        self._deadlines = deadlines
+        self._queue: typing.Optional[TransactionScheduler] = None
+        self._worker: typing.Optional[asyncio.Task] = None
+
+    async def __aenter__(self) -> "Bus":
+        if not await self.open():
+            raise IOError("Could not open bus {} at {} baud".format(self.device_name, self._baudrate))
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: typing.Optional[typing.Type[BaseException]],
+        exc: typing.Optional[BaseException],
+        exc_trace: typing.Optional[types.TracebackType],
+    ) -> None:
+        await self.close()
+
+    @property
+    def device_name(self) -> str:
+        return str(self._port_handler.getPortName())
+
+    @property
+    def port_handler(self) -> typing.Any:
+        return self._port_handler
+
+    @property
+    def packet_handler(self) -> typing.Any:
+        return self._packet_handler
+
+    @property
+    def baudrate(self) -> int:
+        return self._baudrate
+
+    @property
+    def is_open(self) -> bool:
+        return self._open_count > 0
+
+    @property
+    def latency_report(self) -> typing.Optional[typing.Any]:
+        """
+        What :meth:`open` managed to apply to the adapter, or ``None`` if low-latency mode was not requested.
+        """
+        return self._latency_report
+
+    @property
+    def scheduler(self) -> typing.Optional[TransactionScheduler]:
+        return self._queue
+
+    async def open(self) -> bool:
+        if self._open_count == 0:
+            self._logger.debug("Opening bus {} at {} baud".format(self.device_name, self._baudrate))
+            if self._capture_path is not None:
+                self._port_handler.startCapture(self._capture_path)
+                self._logger.info("Capturing bus traffic to {}".format(self._capture_path))
+            # setBaudRate opens the port so there is exactly one open per bus.
+            if not self._port_handler.setBaudRate(self._baudrate):
+                self._port_handler.stopCapture()
+                return False
+            if self._low_latency:
+                self._latency_report = self._port_handler.setLowLatency()
+                self._logger.info("Low-latency mode: {}".format(self._latency_report))
+            # the servos may have been power cycled since the bus was last open
+            for shadow in self._shadows.values():
+                shadow.invalidate(keep_static=True)
+            await self._start_worker()
+        self._open_count += 1
+        return True
+
+    async def close(self) -> None:
+        if self._open_count == 0:
+            return
+        self._open_count -= 1
+        if self._open_count > 0:
+            return
+        self._logger.debug("Closing bus {}".format(self.device_name))
+        if self._motion is not None:
+            await self._motion.close()
+        await self._stop_worker()
+        self._port_handler.closePort()
+        self._port_handler.stopCapture()
+
+    def servo(
+        self, device_id: int, enable_torque_on_connect: bool = True, profile: typing.Optional[str] = None
+    ) -> "_Dynamixel":
+        """
+        Hand out a servo handle for ``device_id`` on this bus. The handle is not connected yet.
+
+        :param profile: A :mod:`~dragon_stand.mech.profiles` profile to apply when the handle connects.
+        """
+        from . import _Dynamixel
+
+        if device_id < 0 or device_id > dynamixel_sdk.MAX_ID:
+            raise ValueError("Servo id {} is outside of 0-{}".format(device_id, dynamixel_sdk.MAX_ID))
+        return _Dynamixel(self, device_id, enable_torque_on_connect=enable_torque_on_connect, profile=profile)
+
+    async def set_baudrate(self, baudrate: int, device_ids: typing.Iterable[int]) -> bool:
+        """
+        Reconfigure every servo on the (open) bus, and the port, to ``baudrate``. See :func:`baud.change_baud_rate`
+        for how this stays safe. ``device_ids`` are the servos that must answer before and after the change.
+
+        :raises ValueError: if the servos cannot be set to ``baudrate``.
+        """
+        baud.baud_rate_register_value(baudrate, self._packet_handler.getProtocolVersion())
+        changed = await self.transact(
+            functools.partial(baud.change_baud_rate, baudrate=baudrate, device_ids=list(device_ids)),
+            Priority.EMERGENCY,
+        )
+        if changed:
+            self._baudrate = baudrate
+            for shadow in self._shadows.values():
+                shadow.invalidate()
+        return bool(changed)
+
+    async def discover_baudrates(
+        self, device_ids: typing.Iterable[int], candidates: typing.Optional[typing.Iterable[int]] = None
+    ) -> typing.Dict[int, int]:
+        """
+        Find the baud rate each of ``device_ids`` is listening at. Servos that never answered are left out. The bus
+        stays at its own rate.
+        """
+        return typing.cast(
+            typing.Dict[int, int],
+            await self.transact(
+                functools.partial(baud.find_baud_rates, device_ids=list(device_ids), candidates=candidates),
+                Priority.DIAGNOSTICS,
+            ),
+        )
+
+    async def scan(
+        self, expected_ids: typing.Optional[typing.Iterable[int]] = None
+    ) -> typing.AsyncIterator[ScanResult]:
+        """
+        Yield every servo on the bus as its reply arrives. With ``expected_ids`` the scan ends as soon as all of them
+        have answered (Protocol 2.0 stops listening to the broadcast ping; Protocol 1.0, which has no broadcast ping,
+        pings those IDs first and stops there).
+        """
+        found: "asyncio.Queue[typing.Optional[ScanResult]]" = asyncio.Queue()
+        ids = None if expected_ids is None else list(expected_ids)
+        # the transaction may run on another thread's loop (see ThreadedBus)
+        loop = asyncio.get_running_loop()
+
+        async def _scan(port: typing.Any, ph: typing.Any) -> typing.Any:
+            try:
+                return await ph.broadcastPingAsync(
+                    port, ids, lambda *servo: loop.call_soon_threadsafe(found.put_nowait, ScanResult(*servo))
+                )
+            finally:
+                loop.call_soon_threadsafe(found.put_nowait, None)
+
+        scan = asyncio.ensure_future(self.transact(_scan, Priority.DIAGNOSTICS))
+        try:
+            while True:
+                servo = await found.get()
+                if servo is None:
+                    break
+                yield servo
+        finally:
+            # also when the caller stops early: the ping cannot be cut short, and this surfaces anything it raised
+            await scan
+
+    def shadow(self, device_id: int) -> ShadowTable:
+        """
+        The :class:`~dragon_stand.mech.shadow.ShadowTable` of servo ``device_id``, shared by everything on this bus
+        that talks to it.
+        """
+        shadow = self._shadows.get(device_id)
+        if shadow is None:
+            shadow = self._shadows[device_id] = ShadowTable(CONTROL_TABLES[self._packet_handler.getProtocolVersion()])
+        return shadow
+
+    def batcher(self, device_id: int) -> RegisterBatcher:
+        """
+        The :class:`~dragon_stand.mech.batching.RegisterBatcher` that merges register accesses to servo ``device_id``
+        issued in the same event loop tick.
+        """
+        batcher = self._batchers.get(device_id)
+        if batcher is None:
+            batcher = self._batchers[device_id] = RegisterBatcher(self, device_id)
+        return batcher
+
+    def motion(self) -> MotionWaiter:
+        """
+        The :class:`~dragon_stand.mech.motion.MotionWaiter` polling this bus's servos for the end of their moves.
+        """
+        if self._motion is None:
+            self._motion = MotionWaiter(self)
+        return self._motion
+
+    async def wait_for_motion(
+        self,
+        goals: typing.Mapping[int, typing.Optional[int]],
+        tolerance: int = DEFAULT_TOLERANCE,
+        timeout: typing.Optional[float] = None,
+    ) -> typing.Dict[int, bool]:
+        """
+        Wait for each servo in ``goals`` to stop within ``tolerance`` of its goal position (or just to stop, for a
+        ``None`` goal). Returns, by ID, whether it did before ``timeout`` seconds. See
+        :meth:`~dragon_stand.mech.motion.MotionWaiter.wait`.
+        """
+        return await self.motion().wait(goals, tolerance, timeout)
+
+    def telemetry(
+        self,
+        device_ids: typing.Iterable[int],
+        registers: typing.Optional[typing.Iterable[Register]] = None,
+        rate_hz: float = DEFAULT_RATE_HZ,
+        capacity: int = DEFAULT_CAPACITY,
+    ) -> TelemetryStream:
+        """
+        A stream sampling ``registers`` (present position, speed and load by default) from ``device_ids`` at
+        ``rate_hz`` into a ring of ``capacity`` frames. Sampling runs while the stream is entered (or between its
+        :meth:`~TelemetryStream.start` and :meth:`~TelemetryStream.stop`); the bus must be open.
+        """
+        return TelemetryStream(self, device_ids, registers, rate_hz, capacity)
+
+    def play(self, trajectory: Trajectory, tolerance: typing.Optional[float] = None) -> TrajectoryStream:
+        """
+        A stream sending ``trajectory``'s setpoints to its servos' goal positions, one SYNC WRITE per tick. Call
+        :meth:`~TrajectoryStream.run` to play it through (or enter the stream and :meth:`~TrajectoryStream.wait`); the
+        bus must be open and the servos' torque on.
+
+        :param tolerance: Seconds after its deadline a tick may go out and still be on time (half a tick by default).
+        """
+        return TrajectoryStream(self, trajectory, tolerance)
+
+    async def transact(
+        self,
+        transaction: "Transaction[T]",
+        priority: Priority = Priority.CONTROL,
+        coalesce_key: typing.Optional[typing.Hashable] = None,
+    ) -> T:
+        """
+        Queue a transaction and wait for its result. Transactions run one at a time, most urgent
+        :class:`~dragon_stand.mech.scheduler.Priority` first and in submission order within a class.
+
+        :param coalesce_key: Identifies requests that are interchangeable (e.g. the same register read on the same
+            servo). A request whose key matches one still waiting shares its result instead of queueing again.
+        :raises TransactionDroppedError: if the transaction outlived its class deadline before it could be sent.
+        """
+        if self._queue is None:
+            raise RuntimeError("Bus {} is not open".format(self.device_name))
+        future = self._queue.submit(transaction, priority, coalesce_key)
+        # shielded because a coalesced future is shared; one caller giving up must not cancel it for the others.
+        return typing.cast(T, await asyncio.shield(future))
+
+    async def _start_worker(self) -> None:
+        self._queue = TransactionScheduler(self._deadlines)
+        self._worker = asyncio.create_task(self._run())
+
+    async def _stop_worker(self) -> None:
+        if self._queue is not None:
+            await self._queue.join()
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+        self._queue = None
+        self._worker = None
+
+    async def _run(self) -> None:
+        queue = typing.cast(TransactionScheduler, self._queue)
+        while True:
+            transaction, future = await queue.get()
+            try:
+                if not future.cancelled():
+                    result = await transaction(self._port_handler, self._packet_handler)
+                    if not future.cancelled():
+                        future.set_result(result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                queue.task_done()
@@ -25,3 +25,11 @@ from .group_sync_read import *
 from .group_sync_write import *
 from .group_bulk_read import *
 from .group_bulk_write import *
+from .packet_codec import *
+from .checksum import *
+from .packet_parser import *
+from .exchange import *
+from .round_trip import *
+from .usb_latency import *
+from .capture import *
+from .replay import *
@@ -0,0 +1,159 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+Append-only binary log of what crossed the wire.
+
+A capture file starts with a header, ``b"DXLT"`` | version (u8) | 3 reserved bytes | wall clock at creation (u64 ns
+since the epoch) | monotonic clock at creation (u64 ns), followed by one record per chunk: monotonic timestamp (u64 ns)
+| direction (u8, ``CAPTURE_TX``, ``CAPTURE_RX`` or ``CAPTURE_BAUD``) | length (u16) | bytes, all little endian. A
+``CAPTURE_BAUD`` record holds the new rate as a u32. Writes go through a large buffer so recording costs a couple of
+``struct.pack`` calls per chunk; files rotate like ``logging.handlers.RotatingFileHandler`` (``bus.cap``,
+``bus.cap.1``, ...).
+"""
+
+import collections
+import mmap
+import os
+import struct
+import time
+
+CAPTURE_MAGIC = b'DXLT'
+CAPTURE_VERSION = 1
+CAPTURE_TX = 0
+CAPTURE_RX = 1
+CAPTURE_BAUD = 2
+
+CAPTURE_MAX_BYTES = 16 * 1024 * 1024
+CAPTURE_BACKUP_COUNT = 4
+CAPTURE_BUFFER_SIZE = 64 * 1024
+
+_FILE_HEADER = struct.Struct('<4sB3xQQ')
+_RECORD_HEADER = struct.Struct('<QBH')
+_BAUD = struct.Struct('<I')
+
+CaptureRecord = collections.namedtuple('CaptureRecord', ['timestamp_ns', 'direction', 'data'])
+
+
+class CaptureWriter(object):
+    def __init__(self, path, max_bytes=CAPTURE_MAX_BYTES, backup_count=CAPTURE_BACKUP_COUNT,
+                 buffer_size=CAPTURE_BUFFER_SIZE):
+        # max_bytes of 0 never rotates
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.buffer_size = buffer_size
+        self.file = None
+        self.size = 0
+        self.open()
+
+    def open(self):
+        self.file = open(self.path, 'ab', buffering=self.buffer_size)
+        self.size = self.file.tell()
+        if self.size == 0:
+            self.size = self.file.write(
+                _FILE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, time.time_ns(), time.monotonic_ns()))
+
+    def record(self, direction, data, timestamp_ns=None):
+        # chunks over 64 KiB are split; nothing the SDK reads or writes comes close
+        if timestamp_ns is None:
+            timestamp_ns = time.monotonic_ns()
+        for offset in range(0, len(data), 0xFFFF):
+            chunk = data[offset: offset + 0xFFFF]
+            if self.max_bytes and self.size + _RECORD_HEADER.size + len(chunk) > self.max_bytes:
+                self.rotate()
+            self.file.write(_RECORD_HEADER.pack(timestamp_ns, direction, len(chunk)))
+            self.file.write(chunk)
+            self.size += _RECORD_HEADER.size + len(chunk)
+
+    def recordBaudRate(self, baudrate):
+        self.record(CAPTURE_BAUD, _BAUD.pack(baudrate))
+
+    def rotate(self):
+        self.file.close()
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                source = '{}.{}'.format(self.path, i)
+                if os.path.exists(source):
+                    os.replace(source, '{}.{}'.format(self.path, i + 1))
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class CaptureReader(object):
+    # records are read straight out of a read-only mapping of the file, so opening a large capture costs nothing
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < _FILE_HEADER.size:
+            self.close()
+            raise ValueError('{} is too short to be a capture file'.format(path))
+        magic, version, self.wall_clock_ns, self.monotonic_ns = _FILE_HEADER.unpack_from(self.map, 0)
+        if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+            self.close()
+            raise ValueError('{} is not a version {} capture file'.format(path, CAPTURE_VERSION))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        data = self.map
+        offset = _FILE_HEADER.size
+        end = len(data)
+        while offset + _RECORD_HEADER.size <= end:
+            timestamp_ns, direction, length = _RECORD_HEADER.unpack_from(data, offset)
+            offset += _RECORD_HEADER.size
+            if offset + length > end:
+                break  # torn final record: the writer died mid-flush
+            yield CaptureRecord(timestamp_ns, direction, data[offset: offset + length])
+            offset += length
+
+    def toWallClock(self, timestamp_ns):
+        # record timestamps are monotonic; this maps them onto the wall clock the file was created at
+        return self.wall_clock_ns + (timestamp_ns - self.monotonic_ns)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+def getCaptureFiles(path):
+    # a capture and its rotated backups, oldest first
+    backups = []
+    i = 1
+    while os.path.exists('{}.{}'.format(path, i)):
+        backups.append('{}.{}'.format(path, i))
+        i += 1
+    files = list(reversed(backups))
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def readCapture(path):
+    # every record of a capture, across its rotated files, in order
+    for name in getCaptureFiles(path):
+        with CaptureReader(name) as reader:
+            for record in reader:
+                yield record
+
+
+def getCaptureBaudRate(record):
+    return _BAUD.unpack_from(record.data, 0)[0]
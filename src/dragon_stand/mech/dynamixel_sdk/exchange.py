@@ -0,0 +1,33 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+Blocking and event-loop drivers for the packet handlers' exchanges.
+
+Each exchange with the servos (build and send the instruction, frame the status packets, map them to a result) is
+written once, as a generator that yields ``(length, minimum)`` whenever it needs bytes from the port and is sent back
+what was read. :func:`runExchange` feeds it from ``readPort`` and :func:`runExchangeAsync` from ``readPortAsync``;
+that is all a handler method and its ``...Async`` twin differ by. ``minimum`` is how many bytes are worth waking for
+on the event loop (``None`` for all ``length`` of them); ``readPort`` never waits for more than it finds.
+"""
+
+
+def runExchange(port, exchange):
+    # drive exchange to completion with readPort; returns whatever it returns
+    try:
+        wanted = next(exchange)
+        while True:
+            wanted = exchange.send(port.readPort(wanted[0]))
+    except StopIteration as done:
+        return done.value
+
+
+async def runExchangeAsync(port, exchange):
+    # drive exchange to completion with readPortAsync, waiting on the event loop between reads
+    try:
+        wanted = next(exchange)
+        while True:
+            wanted = exchange.send(await port.readPortAsync(wanted[0], wanted[1]))
+    except StopIteration as done:
+        return done.value
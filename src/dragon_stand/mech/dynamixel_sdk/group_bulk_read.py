@@ -20,6 +20,7 @@
 # Author: Ryu Woon Jung (Leon)
 
 from .robotis_def import *
+from .packet_codec import *
 
 PARAM_NUM_DATA = 0
 PARAM_NUM_ADDRESS = 1
@@ -35,6 +36,7 @@ class GroupBulkRead:
         self.is_param_changed = False
         self.param = []
         self.data_dict = {}
+        self.status_dict = {}
 
         self.clearParam()
 
@@ -42,7 +44,7 @@ class GroupBulkRead:
         if not self.data_dict:
             return
 
-        self.param = []
+        self.param = bytearray()
 
         for dxl_id in self.data_dict:
             if self.ph.getProtocolVersion() == 1.0:
@@ -51,10 +53,8 @@ class GroupBulkRead:
                 self.param.append(self.data_dict[dxl_id][1])  # ADDR
             else:
                 self.param.append(dxl_id)  # ID
-                self.param.append(DXL_LOBYTE(self.data_dict[dxl_id][1]))  # ADDR_L
-                self.param.append(DXL_HIBYTE(self.data_dict[dxl_id][1]))  # ADDR_H
-                self.param.append(DXL_LOBYTE(self.data_dict[dxl_id][2]))  # LEN_L
-                self.param.append(DXL_HIBYTE(self.data_dict[dxl_id][2]))  # LEN_H
+                self.param += packValue(self.data_dict[dxl_id][1], 2)  # ADDR_L ADDR_H
+                self.param += packValue(self.data_dict[dxl_id][2], 2)  # LEN_L LEN_H
 
     def addParam(self, dxl_id, start_address, data_length):
         if dxl_id in self.data_dict:  # dxl_id already exist
@@ -71,11 +71,13 @@ class GroupBulkRead:
             return
 
         del self.data_dict[dxl_id]
+        self.status_dict.pop(dxl_id, None)
 
         self.is_param_changed = True
 
     def clearParam(self):
         self.data_dict.clear()
+        self.status_dict.clear()
         return
 
     def txPacket(self):
@@ -91,18 +93,39 @@ class GroupBulkRead:
             return self.ph.bulkReadTx(self.port, self.param, len(self.data_dict.keys()) * 5)
 
     def rxPacket(self):
+        # every ID that answered gets its data even when others did not; the result is the first failure, if any
         self.last_result = False
 
-        result = COMM_RX_FAIL
+        if len(self.data_dict.keys()) == 0:
+            return COMM_NOT_AVAILABLE
+
+        self.status_dict = self.ph.readRxGroup(self.port, self._lengths())
+
+        return self._takeStatus()
+
+    async def rxPacketAsync(self):
+        # rxPacket, waiting on the event loop instead of polling the port
+        self.last_result = False
 
         if len(self.data_dict.keys()) == 0:
             return COMM_NOT_AVAILABLE
 
+        self.status_dict = await self.ph.readRxGroupAsync(self.port, self._lengths())
+
+        return self._takeStatus()
+
+    def _lengths(self):
+        lengths = {}
+        for dxl_id in self.data_dict:
+            lengths[dxl_id] = self.data_dict[dxl_id][PARAM_NUM_LENGTH]
+        return lengths
+
+    def _takeStatus(self):
+        result = COMM_SUCCESS
         for dxl_id in self.data_dict:
-            self.data_dict[dxl_id][PARAM_NUM_DATA], result, _ = self.ph.readRx(self.port, dxl_id,
-                                                                               self.data_dict[dxl_id][PARAM_NUM_LENGTH])
-            if result != COMM_SUCCESS:
-                return result
+            self.data_dict[dxl_id][PARAM_NUM_DATA], id_result, _ = self.status_dict[dxl_id]
+            if result == COMM_SUCCESS:
+                result = id_result
 
         if result == COMM_SUCCESS:
             self.last_result = True
@@ -116,8 +139,26 @@ class GroupBulkRead:
 
         return self.rxPacket()
 
+    async def txRxPacketAsync(self):
+        result = self.txPacket()
+        if result != COMM_SUCCESS:
+            return result
+
+        return await self.rxPacketAsync()
+
+    def getResult(self, dxl_id):
+        # COMM_* result of dxl_id's status packet in the last rxPacket
+        if dxl_id not in self.status_dict:
+            return COMM_NOT_AVAILABLE
+        return self.status_dict[dxl_id][1]
+
+    def getError(self, dxl_id):
+        if dxl_id not in self.status_dict:
+            return 0
+        return self.status_dict[dxl_id][2]
+
     def isAvailable(self, dxl_id, address, data_length):
-        if self.last_result is False or dxl_id not in self.data_dict:
+        if self.getResult(dxl_id) != COMM_SUCCESS or dxl_id not in self.data_dict:
             return False
 
         start_addr = self.data_dict[dxl_id][PARAM_NUM_ADDRESS]
@@ -133,15 +174,4 @@ class GroupBulkRead:
 
         start_addr = self.data_dict[dxl_id][PARAM_NUM_ADDRESS]
 
-        if data_length == 1:
-            return self.data_dict[dxl_id][PARAM_NUM_DATA][address - start_addr]
-        elif data_length == 2:
-            return DXL_MAKEWORD(self.data_dict[dxl_id][PARAM_NUM_DATA][address - start_addr],
-                                self.data_dict[dxl_id][PARAM_NUM_DATA][address - start_addr + 1])
-        elif data_length == 4:
-            return DXL_MAKEDWORD(DXL_MAKEWORD(self.data_dict[dxl_id][PARAM_NUM_DATA][address - start_addr + 0],
-                                              self.data_dict[dxl_id][PARAM_NUM_DATA][address - start_addr + 1]),
-                                 DXL_MAKEWORD(self.data_dict[dxl_id][PARAM_NUM_DATA][address - start_addr + 2],
-                                              self.data_dict[dxl_id][PARAM_NUM_DATA][address - start_addr + 3]))
-        else:
-            return 0
+        return unpackValue(self.data_dict[dxl_id][PARAM_NUM_DATA], address - start_addr, data_length)
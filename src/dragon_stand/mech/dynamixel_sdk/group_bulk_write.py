@@ -20,6 +20,7 @@
 # Author: Ryu Woon Jung (Leon)
 
 from .robotis_def import *
+from .packet_codec import *
 
 
 class GroupBulkWrite:
@@ -37,19 +38,17 @@ class GroupBulkWrite:
         if self.ph.getProtocolVersion() == 1.0 or not self.data_list:
             return
 
-        self.param = []
+        self.param = bytearray()
 
         for dxl_id in self.data_list:
             if not self.data_list[dxl_id]:
                 return
 
             self.param.append(dxl_id)
-            self.param.append(DXL_LOBYTE(self.data_list[dxl_id][1]))
-            self.param.append(DXL_HIBYTE(self.data_list[dxl_id][1]))
-            self.param.append(DXL_LOBYTE(self.data_list[dxl_id][2]))
-            self.param.append(DXL_HIBYTE(self.data_list[dxl_id][2]))
+            self.param += packValue(self.data_list[dxl_id][1], 2)
+            self.param += packValue(self.data_list[dxl_id][2], 2)
 
-            self.param.extend(self.data_list[dxl_id][0])
+            self.param += asBytes(self.data_list[dxl_id][0], self.data_list[dxl_id][2])
 
     def addParam(self, dxl_id, start_address, data_length, data):
         if self.ph.getProtocolVersion() == 1.0:
@@ -20,9 +20,12 @@
 # Author: Ryu Woon Jung (Leon)
 
 from .robotis_def import *
+from .packet_codec import *
 
 
 class GroupSyncRead:
+    # Protocol 1.0 has no SYNC_READ instruction, so there the group is sent as a BULK_READ asking every ID for the
+    # same address and length. The servos answer in parameter order either way, so rxPacket does not care which.
     def __init__(self, port, ph, start_address, data_length):
         self.port = port
         self.ph = ph
@@ -33,25 +36,24 @@ class GroupSyncRead:
         self.is_param_changed = False
         self.param = []
         self.data_dict = {}
+        self.status_dict = {}
 
         self.clearParam()
 
     def makeParam(self):
-        if self.ph.getProtocolVersion() == 1.0:
-            return
-
         if not self.data_dict:  # len(self.data_dict.keys()) == 0:
             return
 
-        self.param = []
+        if self.ph.getProtocolVersion() == 1.0:
+            self.param = bytearray()
+            for dxl_id in self.data_dict:
+                self.param += bytes((self.data_length, dxl_id, self.start_address))  # LEN ID ADDR
+        else:
+            self.param = bytearray(self.data_dict.keys())
 
-        for dxl_id in self.data_dict:
-            self.param.append(dxl_id)
+        self.is_param_changed = False
 
     def addParam(self, dxl_id):
-        if self.ph.getProtocolVersion() == 1.0:
-            return False
-
         if dxl_id in self.data_dict:  # dxl_id already exist
             return False
 
@@ -61,47 +63,59 @@ class GroupSyncRead:
         return True
 
     def removeParam(self, dxl_id):
-        if self.ph.getProtocolVersion() == 1.0:
-            return
-
         if dxl_id not in self.data_dict:  # NOT exist
             return
 
         del self.data_dict[dxl_id]
+        self.status_dict.pop(dxl_id, None)
 
         self.is_param_changed = True
 
     def clearParam(self):
-        if self.ph.getProtocolVersion() == 1.0:
-            return
-
         self.data_dict.clear()
+        self.status_dict.clear()
 
     def txPacket(self):
-        if self.ph.getProtocolVersion() == 1.0 or len(self.data_dict.keys()) == 0:
+        if len(self.data_dict.keys()) == 0:
             return COMM_NOT_AVAILABLE
 
         if self.is_param_changed is True or not self.param:
             self.makeParam()
 
+        if self.ph.getProtocolVersion() == 1.0:
+            return self.ph.bulkReadTx(self.port, self.param, len(self.param))
+
         return self.ph.syncReadTx(self.port, self.start_address, self.data_length, self.param,
                                   len(self.data_dict.keys()) * 1)
 
     def rxPacket(self):
+        # every ID that answered gets its data even when others did not; the result is the first failure, if any
         self.last_result = False
 
-        if self.ph.getProtocolVersion() == 1.0:
+        if len(self.data_dict.keys()) == 0:
             return COMM_NOT_AVAILABLE
 
-        result = COMM_RX_FAIL
+        self.status_dict = self.ph.readRxGroup(self.port, dict.fromkeys(self.data_dict, self.data_length))
+
+        return self._takeStatus()
+
+    async def rxPacketAsync(self):
+        # rxPacket, waiting on the event loop instead of polling the port
+        self.last_result = False
 
         if len(self.data_dict.keys()) == 0:
             return COMM_NOT_AVAILABLE
 
+        self.status_dict = await self.ph.readRxGroupAsync(self.port, dict.fromkeys(self.data_dict, self.data_length))
+
+        return self._takeStatus()
+
+    def _takeStatus(self):
+        result = COMM_SUCCESS
         for dxl_id in self.data_dict:
-            self.data_dict[dxl_id], result, _ = self.ph.readRx(self.port, dxl_id, self.data_length)
-            if result != COMM_SUCCESS:
-                return result
+            self.data_dict[dxl_id], id_result, _ = self.status_dict[dxl_id]
+            if result == COMM_SUCCESS:
+                result = id_result
 
         if result == COMM_SUCCESS:
             self.last_result = True
@@ -109,17 +123,32 @@ class GroupSyncRead:
         return result
 
     def txRxPacket(self):
-        if self.ph.getProtocolVersion() == 1.0:
-            return COMM_NOT_AVAILABLE
-
         result = self.txPacket()
         if result != COMM_SUCCESS:
             return result
 
         return self.rxPacket()
 
+    async def txRxPacketAsync(self):
+        result = self.txPacket()
+        if result != COMM_SUCCESS:
+            return result
+
+        return await self.rxPacketAsync()
+
+    def getResult(self, dxl_id):
+        # COMM_* result of dxl_id's status packet in the last rxPacket
+        if dxl_id not in self.status_dict:
+            return COMM_NOT_AVAILABLE
+        return self.status_dict[dxl_id][1]
+
+    def getError(self, dxl_id):
+        if dxl_id not in self.status_dict:
+            return 0
+        return self.status_dict[dxl_id][2]
+
     def isAvailable(self, dxl_id, address, data_length):
-        if self.ph.getProtocolVersion() == 1.0 or self.last_result is False or dxl_id not in self.data_dict:
+        if self.getResult(dxl_id) != COMM_SUCCESS or dxl_id not in self.data_dict:
             return False
 
         if (address < self.start_address) or (self.start_address + self.data_length - data_length < address):
@@ -131,15 +160,4 @@ class GroupSyncRead:
         if not self.isAvailable(dxl_id, address, data_length):
             return 0
 
-        if data_length == 1:
-            return self.data_dict[dxl_id][address - self.start_address]
-        elif data_length == 2:
-            return DXL_MAKEWORD(self.data_dict[dxl_id][address - self.start_address],
-                                self.data_dict[dxl_id][address - self.start_address + 1])
-        elif data_length == 4:
-            return DXL_MAKEDWORD(DXL_MAKEWORD(self.data_dict[dxl_id][address - self.start_address + 0],
-                                              self.data_dict[dxl_id][address - self.start_address + 1]),
-                                 DXL_MAKEWORD(self.data_dict[dxl_id][address - self.start_address + 2],
-                                              self.data_dict[dxl_id][address - self.start_address + 3]))
-        else:
-            return 0
+        return unpackValue(self.data_dict[dxl_id], address - self.start_address, data_length)
@@ -20,6 +20,7 @@
 # Author: Ryu Woon Jung (Leon)
 
 from .robotis_def import *
+from .packet_codec import *
 
 
 class GroupSyncWrite:
@@ -39,14 +40,14 @@ class GroupSyncWrite:
         if not self.data_dict:
             return
 
-        self.param = []
+        self.param = bytearray()
 
         for dxl_id in self.data_dict:
             if not self.data_dict[dxl_id]:
                 return
 
             self.param.append(dxl_id)
-            self.param.extend(self.data_dict[dxl_id])
+            self.param += asBytes(self.data_dict[dxl_id], self.data_length)
 
     def addParam(self, dxl_id, data):
         if dxl_id in self.data_dict:  # dxl_id already exist
@@ -0,0 +1,157 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+Byte-level packet encoding shared by the packet handlers and the Group* classes.
+
+Instruction packets are assembled in a buffer preallocated once per handler and handed to the port as a
+``memoryview`` so nothing is converted int-by-int on the way out. A packet that is too long, or a value that does not
+fit its field, is refused before anything is written to the buffer (the handlers report ``COMM_TX_ERROR``). Status packets are received into a ``bytearray``
+and register values are pulled out of them with ``struct.unpack_from``.
+
+Protocol 2.0 byte stuffing is done with native pattern searches; a packet that contains no ``FF FF FD`` (nearly all of
+them) is passed through without being copied.
+"""
+
+import re
+import struct
+
+from .robotis_def import *
+
+_BYTE = struct.Struct('<B')
+_WORD = struct.Struct('<H')
+_DWORD = struct.Struct('<I')
+
+_VALUE_FORMATS = {1: _BYTE, 2: _WORD, 4: _DWORD}
+
+# re rather than bytes.find so the search also works on the codec's memoryviews
+_HEADER_PATTERN = re.compile(b'\xff\xff\xfd')
+_STUFFED_PATTERN = re.compile(b'\xff\xff\xfd\xfd')
+
+
+def packValue(value, length):
+    # little-endian encoding of a 1, 2 or 4 byte control table value
+    return _VALUE_FORMATS[length].pack(value & ((1 << (8 * length)) - 1))
+
+
+def unpackValue(data, offset, length):
+    # decode a 1, 2 or 4 byte control table value; 0 for any other length (matches the SDK's getData)
+    value_format = _VALUE_FORMATS.get(length)
+    if value_format is None:
+        return 0
+    return value_format.unpack_from(data, offset)[0]
+
+
+def unpackWord(data, offset):
+    return _WORD.unpack_from(data, offset)[0]
+
+
+def packWordInto(buffer, offset, value):
+    _WORD.pack_into(buffer, offset, value & 0xFFFF)
+
+
+def asBytes(data, length):
+    # first length bytes of data without copying when it is already bytes-like
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return data[0: length]
+    return bytes(data[0: length])
+
+
+def toBytes(data, length):
+    # asBytes, or None if data has fewer than length values or one of them is not a byte
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        try:
+            data = bytes(data[0: length])
+        except (TypeError, ValueError):
+            return None
+    if len(data) < length:
+        return None
+    return data[0: length]
+
+
+def fitsValues(values, length):
+    # whether every one of values fits an unsigned length byte field
+    limit = 1 << (8 * length)
+    for value in values:
+        if not 0 <= value < limit:
+            return False
+    return True
+
+
+class PacketCodec(object):
+    """
+    One preallocated transmit buffer. Each :meth:`instruction` call reuses it, so a packet must be sent before the
+    next one is built (true for a single port driven by one handler).
+    """
+
+    def __init__(self, max_length):
+        self.max_length = max_length
+        self.txbuffer = bytearray(max_length)
+        self.txview = memoryview(self.txbuffer)
+
+    def instruction(self, packet_length):
+        # zero-copy window onto the transmit buffer, or None for a packet longer than the handler may send (which it
+        # answers with COMM_TX_ERROR)
+        if packet_length > self.max_length:
+            return None
+        return self.txview[0: packet_length]
+
+
+class Protocol1Codec(PacketCodec):
+    # FF FF ID LEN INST PARAM... CHKSUM
+    def instruction(self, dxl_id, instruction, param_length):
+        packet = PacketCodec.instruction(self, param_length + 6)
+        if packet is None or not 0 <= dxl_id <= 0xFF:
+            return None
+        packet[2] = dxl_id
+        packet[3] = param_length + 2
+        packet[4] = instruction
+        return packet
+
+
+class Protocol2Codec(PacketCodec):
+    # FF FF FD 00 ID LEN_L LEN_H INST PARAM... CRC_L CRC_H
+    def instruction(self, dxl_id, instruction, param_length):
+        packet = PacketCodec.instruction(self, param_length + 10)
+        if packet is None or not 0 <= dxl_id <= 0xFF:
+            return None
+        packet[4] = dxl_id
+        packWordInto(packet, 5, param_length + 3)
+        packet[7] = instruction
+        return packet
+
+
+def stuffPacket(packet):
+    """
+    Protocol 2.0 byte stuffing: every ``FF FF FD`` between LENGTH and the CRC gets an extra ``FD`` and LENGTH is
+    updated. Returns ``packet`` itself when nothing needs stuffing, otherwise a new, longer ``bytearray``. The CRC bytes
+    are carried over unchanged since they are computed after stuffing.
+    """
+    if isinstance(packet, list):
+        packet = bytearray(packet)
+    # the pattern may start in LENGTH but its FD must lie between INSTRUCTION and the CRC
+    end = 5 + unpackWord(packet, 5)
+    if _HEADER_PATTERN.search(packet, 5, end) is None:
+        return packet
+
+    stuffed = bytearray(packet[0: 5])
+    stuffed += _HEADER_PATTERN.sub(b'\xff\xff\xfd\xfd', packet[5: end])
+    stuffed += packet[end: end + 2]
+    packWordInto(stuffed, 5, len(stuffed) - 7)
+    return stuffed
+
+
+def unstuffPacket(packet):
+    """
+    Undo :func:`stuffPacket` on a received ``bytearray`` in place and return it.
+    """
+    if isinstance(packet, list):
+        packet = bytearray(packet)
+    end = 6 + unpackWord(packet, 5)
+    if _STUFFED_PATTERN.search(packet, 5, end) is None:
+        return packet
+
+    packet[5: end] = _STUFFED_PATTERN.sub(b'\xff\xff\xfd', packet[5: end])
+    packWordInto(packet, 5, len(packet) - 7)
+    return packet
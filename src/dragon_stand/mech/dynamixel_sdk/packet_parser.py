@@ -0,0 +1,158 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+Incremental framing of status packets.
+
+Bytes are fed in as they arrive and land in a fixed-size buffer that is never reallocated. The parser keeps a read
+index instead of deleting consumed bytes, looks for headers with ``bytearray.find`` and, when a candidate header turns
+out to be bogus, resynchronizes by advancing the read index one byte. Noise therefore costs time proportional to the
+number of noisy bytes rather than the old ``del rxpacket[0]`` + rescan-from-zero behaviour, which was quadratic.
+A packet that fails its checksum is reported and then skipped by one byte too, so a garbled length cannot hide the
+status packets that follow it (which matters when several servos answer one sync or bulk read).
+"""
+
+from .robotis_def import *
+from .checksum import *
+
+RX_BUFFER_LEN = 4096
+
+
+class StatusPacketParser(object):
+    HEADER = b''
+    MIN_LENGTH = 0
+
+    def __init__(self, max_packet_length, capacity=RX_BUFFER_LEN):
+        self.max_packet_length = max_packet_length
+        self.capacity = capacity
+        self.buffer = bytearray(capacity)
+        self.start = 0  # first byte not yet consumed
+        self.end = 0  # one past the last byte received
+        self.frame_length = 0  # length of the packet at start once its header has been validated
+
+    def reset(self):
+        self.start = 0
+        self.end = 0
+        self.frame_length = 0
+
+    def available(self):
+        return self.end - self.start
+
+    def wanted(self):
+        # bytes still missing before the next packet can possibly be complete
+        needed = (self.frame_length or self.MIN_LENGTH) - (self.end - self.start)
+        return needed if needed > 0 else 0
+
+    def pending(self):
+        return self.buffer[self.start: self.end]
+
+    def feed(self, data):
+        length = len(data)
+        if length == 0:
+            return
+
+        if self.end + length > self.capacity:
+            # slide the unparsed tail (normally less than one packet) back to the front of the buffer
+            unparsed = self.end - self.start
+            if unparsed + length > self.capacity:
+                # more than the buffer can hold: keep the newest bytes and resynchronize on them
+                keep = max(self.capacity - length, 0)
+                self.start = self.end - keep
+                unparsed = keep
+                self.frame_length = 0
+                if length > self.capacity:
+                    data = data[length - self.capacity:]
+                    length = self.capacity
+            self.buffer[0: unparsed] = self.buffer[self.start: self.end]
+            self.start = 0
+            self.end = unparsed
+
+        self.buffer[self.end: self.end + length] = data
+        self.end += length
+
+    def nextFrame(self):
+        """
+        Returns ``(packet, result)`` for the next complete packet, where ``result`` is COMM_SUCCESS or
+        COMM_RX_CORRUPT (checksum mismatch), or ``None`` if more bytes are needed.
+        """
+        buffer = self.buffer
+        header = self.HEADER
+
+        while self.frame_length == 0:
+            index = buffer.find(header, self.start, self.end)
+            if index < 0:
+                # keep a possible partial header at the very end
+                self.start = max(self.start, self.end - (len(header) - 1))
+                return None
+            self.start = index
+            if self.end - index < self.MIN_LENGTH:
+                return None
+            frame_length = self.checkHeader(buffer, index)
+            if frame_length == 0:
+                # not a real header; resynchronize one byte further on
+                self.start = index + 1
+            else:
+                self.frame_length = frame_length
+
+        if self.end - self.start < self.frame_length:
+            return None
+
+        packet = buffer[self.start: self.start + self.frame_length]
+        self.frame_length = 0
+        if self.checkPacket(packet):
+            self.start += len(packet)
+            return packet, COMM_SUCCESS
+
+        # a corrupt length field may have swallowed the packets after it, so only the header is skipped
+        self.start += 1
+        return packet, COMM_RX_CORRUPT
+
+    def skipFrame(self):
+        # give up waiting for the rest of the packet at the read index (its length field was probably garbled) and
+        # resynchronize on the byte after its header; False if no packet was being waited for
+        if self.frame_length == 0:
+            return False
+        self.frame_length = 0
+        self.start += 1
+        return True
+
+    def checkHeader(self, buffer, index):
+        # length of the packet starting at index, or 0 when the header fields are implausible
+        raise NotImplementedError
+
+    def checkPacket(self, packet):
+        raise NotImplementedError
+
+
+class Protocol1StatusParser(StatusPacketParser):
+    # FF FF ID LEN ERROR PARAM... CHKSUM
+    HEADER = b'\xff\xff'
+    MIN_LENGTH = 6
+
+    def checkHeader(self, buffer, index):
+        if buffer[index + 2] > 0xFD or buffer[index + 3] > self.max_packet_length or buffer[index + 4] > 0x7F:
+            # unavailable ID or unavailable Length or unavailable Error
+            return 0
+        return buffer[index + 3] + 4
+
+    def checkPacket(self, packet):
+        length = len(packet)
+        return packet[length - 1] == calcChecksum(packet, length)
+
+
+class Protocol2StatusParser(StatusPacketParser):
+    # FF FF FD 00 ID LEN_L LEN_H INST(0x55) ERROR PARAM... CRC_L CRC_H
+    HEADER = b'\xff\xff\xfd'
+    MIN_LENGTH = 11
+
+    def checkHeader(self, buffer, index):
+        length = buffer[index + 5] | (buffer[index + 6] << 8)
+        if buffer[index + 3] != 0x00 or buffer[index + 4] > 0xFC or length > self.max_packet_length or \
+                buffer[index + 7] != 0x55:
+            return 0
+        return length + 7
+
+    def checkPacket(self, packet):
+        length = len(packet)
+        return updateCRC(0, packet, length - 2) == (packet[length - 2] | (packet[length - 1] << 8))
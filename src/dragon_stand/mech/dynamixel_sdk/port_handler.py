@@ -19,11 +19,17 @@
 
 # Author: Ryu Woon Jung (Leon)
 
+import asyncio
+import select
 import time
 import serial
 import sys
 import platform
 
+from .round_trip import *
+from .usb_latency import *
+from .capture import *
+
 LATENCY_TIMER = 16
 DEFAULT_BAUDRATE = 1000000
 
@@ -35,6 +41,12 @@ class PortHandler(object):
         self.packet_start_time = 0.0
         self.packet_timeout = 0.0
         self.tx_time_per_byte = 0.0
+        self.packet_id = None  # servo the pending timeout waits on, if known
+        self.round_trip = None
+        self.latency_timer = LATENCY_TIMER  # ms the adapter may sit on received bytes
+        self.low_latency_timer = None  # requested by setLowLatency, re-applied whenever the port is reopened
+        self.capture = None  # CaptureWriter recording traffic, if startCapture was called
+        self.blocking_reads = False  # see setBlockingReads
 
         self.is_using = False
         self.port_name = port_name
@@ -46,9 +58,14 @@ class PortHandler(object):
     def closePort(self):
         self.ser.close()
         self.is_open = False
+        if self.capture is not None:
+            self.capture.flush()
 
     def clearPort(self):
+        # called before every instruction: finish sending, and drop whatever is waiting to be read, e.g. an answer
+        # that arrived after its timeout, so it cannot be taken for the answer to this one
         self.ser.flush()
+        self.ser.reset_input_buffer()
 
     def setPortName(self, port_name):
         self.port_name = port_name
@@ -60,12 +77,15 @@ class PortHandler(object):
         baud = self.getCFlagBaud(baudrate)
 
         if baud <= 0:
-            # self.setupPort(38400)
-            # self.baudrate = baudrate
-            return False  # TODO: setCustomBaudrate(baudrate)
+            return self.setCustomBaudrate(baudrate)
         else:
-            self.baudrate = baudrate
-            return self.setupPort(baud)
+            return self.setupPort(baud, baudrate)
+
+    def setCustomBaudrate(self, baudrate):
+        # pyserial programs rates missing from the termios table through termios2/BOTHER, which only Linux has
+        if baudrate <= 0 or not sys.platform.startswith('linux'):
+            return False
+        return self.setupPort(baudrate, baudrate)
 
     def getBaudRate(self):
         return self.baudrate
@@ -73,57 +93,175 @@ class PortHandler(object):
     def getBytesAvailable(self):
         return self.ser.in_waiting
 
+    def setBlockingReads(self, enabled):
+        # when enabled, a readPort that finds nothing sleeps in select() until bytes arrive or the packet times out,
+        # instead of returning at once to the SDK's polling loops. Those loops then stop spinning (and holding the GIL),
+        # which is what lets buses on separate threads run side by side. Needs a port with a file descriptor (POSIX).
+        self.blocking_reads = enabled
+
     def readPort(self, length):
+        data = self.readAvailable(length)
+        if data or not self.blocking_reads:
+            return data
+        remaining = self.packet_timeout - self.getTimeSinceStart()
+        if remaining > 0:
+            select.select([self.ser.fileno()], [], [], remaining / 1000.0)
+            data = self.readAvailable(length)
+        return data
+
+    def readAvailable(self, length):
+        # never waits
+        data = self.ser.read(length)
+        if self.capture is not None and data:
+            self.capture.record(CAPTURE_RX, data)
         if (sys.version_info > (3, 0)):
-            return self.ser.read(length)
+            return data
         else:
-            return [ord(ch) for ch in self.ser.read(length)]
+            return [ord(ch) for ch in data]
+
+    async def readPortAsync(self, length, minimum=None):
+        # wait on the event loop (fd reader + timer, no polling) until length bytes (or at least minimum, when given)
+        # arrive or the packet times out
+        if minimum is None:
+            minimum = length
+        data = self.readAvailable(length)
+        if len(data) >= minimum:
+            return data
+
+        loop = asyncio.get_running_loop()
+        fd = self.ser.fileno()
+        buffer = bytearray(data)
+
+        while len(buffer) < minimum:
+            remaining = self.packet_timeout - self.getTimeSinceStart()
+            if remaining <= 0:
+                break
+
+            waiter = loop.create_future()
+            loop.add_reader(fd, _wake, waiter)
+            timer = loop.call_later(remaining / 1000.0, _wake, waiter)
+            try:
+                await waiter
+            finally:
+                timer.cancel()
+                loop.remove_reader(fd)
+
+            buffer.extend(self.readAvailable(length - len(buffer)))
+
+        return bytes(buffer)
 
     def writePort(self, packet):
+        if self.capture is not None:
+            self.capture.record(CAPTURE_TX, bytes(packet))
         return self.ser.write(packet)
 
-    def setPacketTimeout(self, packet_length):
+    def startCapture(self, path, max_bytes=CAPTURE_MAX_BYTES, backup_count=CAPTURE_BACKUP_COUNT):
+        # record every chunk written to and read from the port (see capture.py); returns the CaptureWriter
+        self.stopCapture()
+        self.capture = CaptureWriter(path, max_bytes, backup_count)
+        if self.is_open:
+            self.capture.recordBaudRate(self.baudrate)
+        return self.capture
+
+    def stopCapture(self):
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+
+    def setPacketTimeout(self, packet_length, dxl_id=None):
         self.packet_start_time = self.getCurrentTime()
-        self.packet_timeout = (self.tx_time_per_byte * packet_length) + (LATENCY_TIMER * 2.0) + 2.0
+        self.packet_id = dxl_id
+        tx_time = self.tx_time_per_byte * packet_length
+        self.packet_timeout = None
+        if self.round_trip is not None and dxl_id is not None:
+            self.packet_timeout = self.round_trip.getTimeout(dxl_id, tx_time)
+        if self.packet_timeout is None:
+            self.packet_timeout = tx_time + (self.latency_timer * 2.0) + 2.0
 
     def setPacketTimeoutMillis(self, msec):
         self.packet_start_time = self.getCurrentTime()
+        self.packet_id = None
         self.packet_timeout = msec
 
+    def enableAdaptiveTimeout(self, percentile=DEFAULT_PERCENTILE, min_samples=DEFAULT_MIN_SAMPLES,
+                              window=DEFAULT_WINDOW, margin_ms=DEFAULT_MARGIN_MS, max_margin_ms=DEFAULT_MAX_MARGIN_MS,
+                              probe_every=DEFAULT_PROBE_EVERY):
+        # learn per-servo latency and time out unicast replies at its percentile instead of the fixed formula
+        self.round_trip = RoundTripEstimator(percentile, min_samples, window, margin_ms, max_margin_ms, probe_every)
+        return self.round_trip
+
+    def disableAdaptiveTimeout(self):
+        self.round_trip = None
+
+    def getRoundTripEstimator(self):
+        return self.round_trip
+
+    def recordRoundTrip(self, dxl_id, packet_length):
+        # called by the packet handlers for each good status packet; only replies to a timeout set for that servo
+        # are a clean round trip
+        if self.round_trip is not None and dxl_id == self.packet_id:
+            self.round_trip.addSample(dxl_id, self.getTimeSinceStart() - self.tx_time_per_byte * packet_length)
+
+    def setLowLatency(self, latency_ms=LOW_LATENCY_TIMER):
+        # shorten the USB adapter's latency timer and set ASYNC_LOW_LATENCY; returns a LatencyReport
+        self.low_latency_timer = latency_ms
+        report = applyLowLatency(self.ser, self.port_name, latency_ms)
+        if report.latency_timer_after is not None:
+            self.latency_timer = report.latency_timer_after
+        return report
+
+    def getLatencyTimer(self):
+        return self.latency_timer
+
     def isPacketTimeout(self):
         if self.getTimeSinceStart() > self.packet_timeout:
             self.packet_timeout = 0
+            if self.round_trip is not None and self.packet_id is not None:
+                # the learned timeout was too short (or the servo is gone): wait longer next time, keeping the samples
+                self.round_trip.addTimeout(self.packet_id)
             return True
 
         return False
 
     def getCurrentTime(self):
-        return round(time.time() * 1000000000) / 1000000.0
+        # milliseconds on the monotonic clock; wall-clock steps (NTP) must not fire or stretch timeouts
+        return time.monotonic_ns() / 1000000.0
 
     def getTimeSinceStart(self):
-        time_since = self.getCurrentTime() - self.packet_start_time
-        if time_since < 0.0:
-            self.packet_start_time = self.getCurrentTime()
+        return self.getCurrentTime() - self.packet_start_time
 
-        return time_since
+    def setupPort(self, cflag_baud, baudrate=None):
+        if baudrate is None:
+            baudrate = self.baudrate
 
-    def setupPort(self, cflag_baud):
         if self.is_open:
-            self.closePort()
+            # retune the open port rather than reopening it: faster, and the adapter keeps its low-latency setup
+            try:
+                self.ser.baudrate = baudrate
+            except (ValueError, serial.SerialException):
+                return False
+            self.baudrate = baudrate
+        else:
+            self.baudrate = baudrate
+            self.ser = serial.Serial(
+                port=self.port_name,
+                baudrate=self.baudrate,
+                # parity = serial.PARITY_ODD,
+                # stopbits = serial.STOPBITS_TWO,
+                bytesize=serial.EIGHTBITS,
+                timeout=0
+            )
 
-        self.ser = serial.Serial(
-            port=self.port_name,
-            baudrate=self.baudrate,
-            # parity = serial.PARITY_ODD,
-            # stopbits = serial.STOPBITS_TWO,
-            bytesize=serial.EIGHTBITS,
-            timeout=0
-        )
+            self.is_open = True
 
-        self.is_open = True
+            if self.low_latency_timer is not None:
+                self.setLowLatency(self.low_latency_timer)
 
         self.ser.reset_input_buffer()
 
+        if self.capture is not None:
+            self.capture.recordBaudRate(self.baudrate)
+
         self.tx_time_per_byte = (1000.0 / self.baudrate) * 10.0
 
         return True
@@ -133,4 +271,9 @@ class PortHandler(object):
                         2000000, 2500000, 3000000, 3500000, 4000000]:
             return baudrate
         else:
-            return -1            
+            return -1
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
@@ -20,10 +20,16 @@
 # Author: Ryu Woon Jung (Leon)
 
 from .robotis_def import *
+from .packet_codec import *
+from .checksum import *
+from .packet_parser import *
+from .exchange import *
 
 TXPACKET_MAX_LEN = 250
 RXPACKET_MAX_LEN = 250
 
+SCAN_RESPONSE_MARGIN = 1.0  # ms; covers the default 0.5 ms return delay of MX servos
+
 # for Protocol 1.0 Packet
 PKT_HEADER0 = 0
 PKT_HEADER1 = 1
@@ -44,6 +50,10 @@ ERRBIT_INSTRUCTION = 64  # Undefined instruction or delivering the action comman
 
 
 class Protocol1PacketHandler(object):
+    def __init__(self):
+        self._codec = Protocol1Codec(TXPACKET_MAX_LEN)
+        self._parser = Protocol1StatusParser(RXPACKET_MAX_LEN)
+
     def getProtocolVersion(self):
         return 1.0
 
@@ -93,8 +103,24 @@ class Protocol1PacketHandler(object):
 
         return ""
 
+    def getDataLength(self, rxpacket):
+        # parameter bytes in a status packet: LENGTH counts ERROR and CHECKSUM too
+        return rxpacket[PKT_LENGTH] - 2
+
+    def _instruction(self, dxl_id, instruction, params=(), data=b'', length=0):
+        # instruction packet with params (a byte each) and then length bytes of data; None if it is too long or any
+        # of it does not fit, which the callers report as COMM_TX_ERROR
+        data = toBytes(data, length)
+        if data is None or not fitsValues(params, 1):
+            return None
+        txpacket = self._codec.instruction(dxl_id, instruction, len(params) + length)
+        if txpacket is not None:
+            start = PKT_PARAMETER0 + len(params)
+            txpacket[PKT_PARAMETER0: start] = bytes(params)
+            txpacket[start: start + length] = data
+        return txpacket
+
     def txPacket(self, port, txpacket):
-        checksum = 0
         total_packet_length = txpacket[PKT_LENGTH] + 4  # 4: HEADER0 HEADER1 ID LENGTH
 
         if port.is_using:
@@ -111,10 +137,7 @@ class Protocol1PacketHandler(object):
         txpacket[PKT_HEADER1] = 0xFF
 
         # add a checksum to the packet
-        for idx in range(2, total_packet_length - 1):  # except header, checksum
-            checksum += txpacket[idx]
-
-        txpacket[total_packet_length - 1] = ~checksum & 0xFF
+        txpacket[total_packet_length - 1] = calcChecksum(txpacket, total_packet_length)
 
         #print "[TxPacket] %r" % txpacket
 
@@ -128,72 +151,32 @@ class Protocol1PacketHandler(object):
         return COMM_SUCCESS
 
     def rxPacket(self, port):
-        rxpacket = []
+        return runExchange(port, self._rxPacket(port))
 
-        result = COMM_TX_FAIL
-        checksum = 0
-        rx_length = 0
-        wait_length = 6  # minimum length (HEADER0 HEADER1 ID LENGTH ERROR CHKSUM)
+    async def rxPacketAsync(self, port):
+        return await runExchangeAsync(port, self._rxPacket(port))
+
+    def _rxPacket(self, port):
+        parser = self._parser
+        parser.reset()
 
         while True:
-            rxpacket.extend(port.readPort(wait_length - rx_length))
-            rx_length = len(rxpacket)
-            if rx_length >= wait_length:
-                # find packet header
-                for idx in range(0, (rx_length - 1)):
-                    if (rxpacket[idx] == 0xFF) and (rxpacket[idx + 1] == 0xFF):
-                        break
-
-                if idx == 0:  # found at the beginning of the packet
-                    if (rxpacket[PKT_ID] > 0xFD) or (rxpacket[PKT_LENGTH] > RXPACKET_MAX_LEN) or (
-                            rxpacket[PKT_ERROR] > 0x7F):
-                        # unavailable ID or unavailable Length or unavailable Error
-                        # remove the first byte in the packet
-                        del rxpacket[0]
-                        rx_length -= 1
-                        continue
-
-                    # re-calculate the exact length of the rx packet
-                    if wait_length != (rxpacket[PKT_LENGTH] + PKT_LENGTH + 1):
-                        wait_length = rxpacket[PKT_LENGTH] + PKT_LENGTH + 1
-                        continue
-
-                    if rx_length < wait_length:
-                        # check timeout
-                        if port.isPacketTimeout():
-                            if rx_length == 0:
-                                result = COMM_RX_TIMEOUT
-                            else:
-                                result = COMM_RX_CORRUPT
-                            break
-                        else:
-                            continue
-
-                    # calculate checksum
-                    for i in range(2, wait_length - 1):  # except header, checksum
-                        checksum += rxpacket[i]
-                    checksum = ~checksum & 0xFF
-
-                    # verify checksum
-                    if rxpacket[wait_length - 1] == checksum:
-                        result = COMM_SUCCESS
-                    else:
-                        result = COMM_RX_CORRUPT
-                    break
+            parser.feed((yield parser.wanted(), None))
+            frame = parser.nextFrame()
+            if frame is not None:
+                rxpacket, result = frame
+                if result == COMM_SUCCESS:
+                    port.recordRoundTrip(rxpacket[PKT_ID], len(rxpacket))
+                break
 
+            # check timeout
+            if port.isPacketTimeout():
+                if parser.available() == 0:
+                    result = COMM_RX_TIMEOUT
                 else:
-                    # remove unnecessary packets
-                    del rxpacket[0: idx]
-                    rx_length -= idx
-
-            else:
-                # check timeout
-                if port.isPacketTimeout():
-                    if rx_length == 0:
-                        result = COMM_RX_TIMEOUT
-                    else:
-                        result = COMM_RX_CORRUPT
-                    break
+                    result = COMM_RX_CORRUPT
+                rxpacket = parser.pending()
+                break
 
         port.is_using = False
 
@@ -203,6 +186,12 @@ class Protocol1PacketHandler(object):
 
     # NOT for BulkRead
     def txRxPacket(self, port, txpacket):
+        return runExchange(port, self._txRxPacket(port, txpacket))
+
+    async def txRxPacketAsync(self, port, txpacket):
+        return await runExchangeAsync(port, self._txRxPacket(port, txpacket))
+
+    def _txRxPacket(self, port, txpacket):
         rxpacket = None
         error = 0
 
@@ -222,13 +211,13 @@ class Protocol1PacketHandler(object):
 
         # set packet timeout
         if txpacket[PKT_INSTRUCTION] == INST_READ:
-            port.setPacketTimeout(txpacket[PKT_PARAMETER0 + 1] + 6)
+            port.setPacketTimeout(txpacket[PKT_PARAMETER0 + 1] + 6, txpacket[PKT_ID])
         else:
-            port.setPacketTimeout(6)  # HEADER0 HEADER1 ID LENGTH ERROR CHECKSUM
+            port.setPacketTimeout(6, txpacket[PKT_ID])  # HEADER0 HEADER1 ID LENGTH ERROR CHECKSUM
 
         # rx packet
         while True:
-            rxpacket, result = self.rxPacket(port)
+            rxpacket, result = yield from self._rxPacket(port)
             if result != COMM_SUCCESS or txpacket[PKT_ID] == rxpacket[PKT_ID]:
                 break
 
@@ -238,37 +227,88 @@ class Protocol1PacketHandler(object):
         return rxpacket, result, error
 
     def ping(self, port, dxl_id):
+        return runExchange(port, self._ping(port, dxl_id))
+
+    async def pingAsync(self, port, dxl_id):
+        return await runExchangeAsync(port, self._ping(port, dxl_id))
+
+    def _ping(self, port, dxl_id):
         model_number = 0
         error = 0
 
-        txpacket = [0] * 6
-
         if dxl_id >= BROADCAST_ID:
             return model_number, COMM_NOT_AVAILABLE, error
 
-        txpacket[PKT_ID] = dxl_id
-        txpacket[PKT_LENGTH] = 2
-        txpacket[PKT_INSTRUCTION] = INST_PING
+        txpacket = self._instruction(dxl_id, INST_PING)
+        if txpacket is None:
+            return model_number, COMM_TX_ERROR, error
 
-        rxpacket, result, error = self.txRxPacket(port, txpacket)
+        rxpacket, result, error = yield from self._txRxPacket(port, txpacket)
 
         if result == COMM_SUCCESS:
-            data_read, result, error = self.readTxRx(port, dxl_id, 0, 2)  # Address 0 : Model Number
+            data_read, result, error = yield from self._readTxRx(port, dxl_id, 0, 2)  # Address 0 : Model Number
             if result == COMM_SUCCESS:
-                model_number = DXL_MAKEWORD(data_read[0], data_read[1])
+                model_number = unpackWord(data_read, 0)
 
         return model_number, result, error
 
-    def broadcastPing(self, port):
-        data_list = None
-        return data_list, COMM_NOT_AVAILABLE
+    def broadcastPing(self, port, expected_ids=None, callback=None):
+        return runExchange(port, self._broadcastPing(port, expected_ids, callback))
+
+    async def broadcastPingAsync(self, port, expected_ids=None, callback=None):
+        return await runExchangeAsync(port, self._broadcastPing(port, expected_ids, callback))
+
+    def _broadcastPing(self, port, expected_ids, callback):
+        # Protocol 1.0 has no broadcast ping. It is emulated with a unicast ping per ID, each waiting only as long as a
+        # present servo could take to answer (see _scanTimeout). expected_ids are pinged first and the scan stops once
+        # they have all answered. callback(dxl_id, model_number, firmware_version) is called for each servo found.
+        data_list = {}
+        result = COMM_RX_TIMEOUT
+
+        expected = None if expected_ids is None else set(expected_ids)
+        for dxl_id in self._scanOrder(expected):
+            txpacket = self._codec.instruction(dxl_id, INST_PING, 0)
+            ping_result = self.txPacket(port, txpacket)
+            if ping_result != COMM_SUCCESS:
+                return data_list, ping_result
+            port.setPacketTimeoutMillis(self._scanTimeout(port))
+
+            while True:
+                rxpacket, ping_result = yield from self._rxPacket(port)
+                if ping_result != COMM_SUCCESS or rxpacket[PKT_ID] == dxl_id:
+                    break
 
-    def action(self, port, dxl_id):
-        txpacket = [0] * 6
+            if ping_result == COMM_SUCCESS:
+                result = COMM_SUCCESS
+                data_read, read_result, _ = yield from self._readTxRx(port, dxl_id, 0, 3)  # model number, firmware
+                self._addScanResult(data_list, callback, dxl_id, data_read, read_result)
+                if expected is not None and expected.issubset(data_list):
+                    break
 
-        txpacket[PKT_ID] = dxl_id
-        txpacket[PKT_LENGTH] = 2
-        txpacket[PKT_INSTRUCTION] = INST_ACTION
+        return data_list, result
+
+    def _scanOrder(self, expected):
+        first = [] if expected is None else sorted(i for i in expected if 0 <= i < BROADCAST_ID)
+        return first + [i for i in range(0, BROADCAST_ID) if i not in first]
+
+    def _scanTimeout(self, port):
+        # ping (6 bytes) + status (6 bytes), then the adapter latency and the return delay margin
+        return port.tx_time_per_byte * 12 + port.getLatencyTimer() + SCAN_RESPONSE_MARGIN
+
+    def _addScanResult(self, data_list, callback, dxl_id, data_read, read_result):
+        model_number = 0
+        firmware_version = 0
+        if read_result == COMM_SUCCESS:
+            model_number = unpackWord(data_read, 0)
+            firmware_version = data_read[2]
+        data_list[dxl_id] = [model_number, firmware_version]
+        if callback is not None:
+            callback(dxl_id, model_number, firmware_version)
+
+    def action(self, port, dxl_id):
+        txpacket = self._instruction(dxl_id, INST_ACTION)
+        if txpacket is None:
+            return COMM_TX_ERROR
 
         _, result, _ = self.txRxPacket(port, txpacket)
 
@@ -278,11 +318,9 @@ class Protocol1PacketHandler(object):
         return COMM_NOT_AVAILABLE, 0
 
     def factoryReset(self, port, dxl_id):
-        txpacket = [0] * 6
-
-        txpacket[PKT_ID] = dxl_id
-        txpacket[PKT_LENGTH] = 2
-        txpacket[PKT_INSTRUCTION] = INST_FACTORY_RESET
+        txpacket = self._instruction(dxl_id, INST_FACTORY_RESET)
+        if txpacket is None:
+            return COMM_TX_ERROR, 0
 
         _, result, error = self.txRxPacket(port, txpacket)
 
@@ -290,26 +328,28 @@ class Protocol1PacketHandler(object):
 
     def readTx(self, port, dxl_id, address, length):
 
-        txpacket = [0] * 8
-
         if dxl_id >= BROADCAST_ID:
             return COMM_NOT_AVAILABLE
 
-        txpacket[PKT_ID] = dxl_id
-        txpacket[PKT_LENGTH] = 4
-        txpacket[PKT_INSTRUCTION] = INST_READ
-        txpacket[PKT_PARAMETER0 + 0] = address
-        txpacket[PKT_PARAMETER0 + 1] = length
+        txpacket = self._instruction(dxl_id, INST_READ, (address, length))
+        if txpacket is None:
+            return COMM_TX_ERROR
 
         result = self.txPacket(port, txpacket)
 
         # set packet timeout
         if result == COMM_SUCCESS:
-            port.setPacketTimeout(length + 6)
+            port.setPacketTimeout(length + 6, dxl_id)
 
         return result
 
     def readRx(self, port, dxl_id, length):
+        return runExchange(port, self._readRx(port, dxl_id, length))
+
+    async def readRxAsync(self, port, dxl_id, length):
+        return await runExchangeAsync(port, self._readRx(port, dxl_id, length))
+
+    def _readRx(self, port, dxl_id, length):
         result = COMM_TX_FAIL
         error = 0
 
@@ -317,39 +357,123 @@ class Protocol1PacketHandler(object):
         data = []
 
         while True:
-            rxpacket, result = self.rxPacket(port)
+            rxpacket, result = yield from self._rxPacket(port)
 
             if result != COMM_SUCCESS or rxpacket[PKT_ID] == dxl_id:
                 break
 
         if result == COMM_SUCCESS and rxpacket[PKT_ID] == dxl_id:
             error = rxpacket[PKT_ERROR]
+            if self.getDataLength(rxpacket) != length:
+                # the answer to some other read, e.g. one that arrived after its timeout
+                return [], COMM_RX_CORRUPT, 0
 
-            data.extend(rxpacket[PKT_PARAMETER0: PKT_PARAMETER0 + length])
+            data = rxpacket[PKT_PARAMETER0: PKT_PARAMETER0 + length]
 
         return data, result, error
 
+    def readRxGroup(self, port, lengths):
+        return runExchange(port, self._readRxGroup(port, lengths))
+
+    async def readRxGroupAsync(self, port, lengths):
+        return await runExchangeAsync(port, self._readRxGroup(port, lengths))
+
+    def _readRxGroup(self, port, lengths):
+        # Receives every status packet a sync or bulk read asked for in one pass over the reply burst. lengths maps
+        # each ID to the number of data bytes it was asked for. Packets are matched by ID in whatever order they
+        # arrive and a servo that is late or garbled only costs its own entry: the result is
+        # {dxl_id: [data, result, error]} with COMM_RX_TIMEOUT (or COMM_RX_CORRUPT if bytes arrived that did not frame)
+        # for IDs that did not answer.
+        self._parser.reset()
+        status = {}
+        corrupt = False
+        while True:
+            # wake for every burst so the servos that have answered are framed while the rest are still talking
+            received = yield self._groupWaitLength(lengths, status), 1
+            corrupt = self._collectGroupStatus(port, received, lengths, status) or corrupt
+            if len(status) == len(lengths) or port.isPacketTimeout():
+                break
+
+        port.is_using = False
+
+        return self._groupRxResult(port, lengths, status, corrupt)
+
+    def _groupWaitLength(self, lengths, status):
+        # bytes still owed by the servos that have not answered, less what is already buffered
+        owed = 0
+        for dxl_id in lengths:
+            if dxl_id not in status:
+                owed += lengths[dxl_id] + 6
+        return max(owed - self._parser.available(), 1)
+
+    def _collectGroupStatus(self, port, received, lengths, status):
+        # frames what has arrived so far; True if any of it was a corrupt packet
+        parser = self._parser
+        parser.feed(received)
+
+        corrupt = False
+        while True:
+            frame = parser.nextFrame()
+            if frame is None:
+                return corrupt
+            rxpacket, frame_result = frame
+            if frame_result != COMM_SUCCESS:
+                corrupt = True
+                continue
+            dxl_id = rxpacket[PKT_ID]
+            if dxl_id not in lengths or dxl_id in status:
+                continue
+            if self.getDataLength(rxpacket) != lengths[dxl_id]:
+                corrupt = True
+                continue
+            port.recordRoundTrip(dxl_id, len(rxpacket))
+            data = rxpacket[PKT_PARAMETER0: PKT_PARAMETER0 + lengths[dxl_id]]
+            status[dxl_id] = [data, COMM_SUCCESS, rxpacket[PKT_ERROR]]
+
+    def _groupRxResult(self, port, lengths, status, corrupt):
+        # a packet still short of bytes at the timeout probably had a garbled length; look for answers behind it
+        while len(status) < len(lengths) and self._parser.skipFrame():
+            corrupt = True
+            self._collectGroupStatus(port, b'', lengths, status)
+
+        missing = COMM_RX_CORRUPT if corrupt or self._parser.available() else COMM_RX_TIMEOUT
+        for dxl_id in lengths:
+            if dxl_id not in status:
+                status[dxl_id] = [[], missing, 0]
+        return status
+
     def readTxRx(self, port, dxl_id, address, length):
-        txpacket = [0] * 8
+        return runExchange(port, self._readTxRx(port, dxl_id, address, length))
+
+    async def readTxRxAsync(self, port, dxl_id, address, length):
+        return await runExchangeAsync(port, self._readTxRx(port, dxl_id, address, length))
+
+    def _readTxRx(self, port, dxl_id, address, length):
         data = []
 
         if dxl_id >= BROADCAST_ID:
             return data, COMM_NOT_AVAILABLE, 0
 
-        txpacket[PKT_ID] = dxl_id
-        txpacket[PKT_LENGTH] = 4
-        txpacket[PKT_INSTRUCTION] = INST_READ
-        txpacket[PKT_PARAMETER0 + 0] = address
-        txpacket[PKT_PARAMETER0 + 1] = length
+        txpacket = self._instruction(dxl_id, INST_READ, (address, length))
+        if txpacket is None:
+            return data, COMM_TX_ERROR, 0
 
-        rxpacket, result, error = self.txRxPacket(port, txpacket)
+        rxpacket, result, error = yield from self._txRxPacket(port, txpacket)
         if result == COMM_SUCCESS:
             error = rxpacket[PKT_ERROR]
+            if self.getDataLength(rxpacket) != length:
+                # the answer to some other read, e.g. one that arrived after its timeout
+                return [], COMM_RX_CORRUPT, 0
 
-            data.extend(rxpacket[PKT_PARAMETER0: PKT_PARAMETER0 + length])
+            data = rxpacket[PKT_PARAMETER0: PKT_PARAMETER0 + length]
 
         return data, result, error
 
+    def _readValueTxRx(self, port, dxl_id, address, length):
+        data, result, error = yield from self._readTxRx(port, dxl_id, address, length)
+        data_read = unpackValue(data, 0, length) if (result == COMM_SUCCESS) else 0
+        return data_read, result, error
+
     def read1ByteTx(self, port, dxl_id, address):
         return self.readTx(port, dxl_id, address, 1)
 
@@ -359,47 +483,43 @@ class Protocol1PacketHandler(object):
         return data_read, result, error
 
     def read1ByteTxRx(self, port, dxl_id, address):
-        data, result, error = self.readTxRx(port, dxl_id, address, 1)
-        data_read = data[0] if (result == COMM_SUCCESS) else 0
-        return data_read, result, error
+        return runExchange(port, self._readValueTxRx(port, dxl_id, address, 1))
+
+    async def read1ByteTxRxAsync(self, port, dxl_id, address):
+        return await runExchangeAsync(port, self._readValueTxRx(port, dxl_id, address, 1))
 
     def read2ByteTx(self, port, dxl_id, address):
         return self.readTx(port, dxl_id, address, 2)
 
     def read2ByteRx(self, port, dxl_id):
         data, result, error = self.readRx(port, dxl_id, 2)
-        data_read = DXL_MAKEWORD(data[0], data[1]) if (result == COMM_SUCCESS) else 0
+        data_read = unpackValue(data, 0, 2) if (result == COMM_SUCCESS) else 0
         return data_read, result, error
 
     def read2ByteTxRx(self, port, dxl_id, address):
-        data, result, error = self.readTxRx(port, dxl_id, address, 2)
-        data_read = DXL_MAKEWORD(data[0], data[1]) if (result == COMM_SUCCESS) else 0
-        return data_read, result, error
+        return runExchange(port, self._readValueTxRx(port, dxl_id, address, 2))
+
+    async def read2ByteTxRxAsync(self, port, dxl_id, address):
+        return await runExchangeAsync(port, self._readValueTxRx(port, dxl_id, address, 2))
 
     def read4ByteTx(self, port, dxl_id, address):
         return self.readTx(port, dxl_id, address, 4)
 
     def read4ByteRx(self, port, dxl_id):
         data, result, error = self.readRx(port, dxl_id, 4)
-        data_read = DXL_MAKEDWORD(DXL_MAKEWORD(data[0], data[1]),
-                                  DXL_MAKEWORD(data[2], data[3])) if (result == COMM_SUCCESS) else 0
+        data_read = unpackValue(data, 0, 4) if (result == COMM_SUCCESS) else 0
         return data_read, result, error
 
     def read4ByteTxRx(self, port, dxl_id, address):
-        data, result, error = self.readTxRx(port, dxl_id, address, 4)
-        data_read = DXL_MAKEDWORD(DXL_MAKEWORD(data[0], data[1]),
-                                  DXL_MAKEWORD(data[2], data[3])) if (result == COMM_SUCCESS) else 0
-        return data_read, result, error
-
-    def writeTxOnly(self, port, dxl_id, address, length, data):
-        txpacket = [0] * (length + 7)
+        return runExchange(port, self._readValueTxRx(port, dxl_id, address, 4))
 
-        txpacket[PKT_ID] = dxl_id
-        txpacket[PKT_LENGTH] = length + 3
-        txpacket[PKT_INSTRUCTION] = INST_WRITE
-        txpacket[PKT_PARAMETER0] = address
+    async def read4ByteTxRxAsync(self, port, dxl_id, address):
+        return await runExchangeAsync(port, self._readValueTxRx(port, dxl_id, address, 4))
 
-        txpacket[PKT_PARAMETER0 + 1: PKT_PARAMETER0 + 1 + length] = data[0: length]
+    def writeTxOnly(self, port, dxl_id, address, length, data):
+        txpacket = self._instruction(dxl_id, INST_WRITE, (address,), data, length)
+        if txpacket is None:
+            return COMM_TX_ERROR
 
         result = self.txPacket(port, txpacket)
         port.is_using = False
@@ -407,57 +527,54 @@ class Protocol1PacketHandler(object):
         return result
 
     def writeTxRx(self, port, dxl_id, address, length, data):
-        txpacket = [0] * (length + 7)
+        return runExchange(port, self._writeTxRx(port, dxl_id, address, length, data))
+
+    async def writeTxRxAsync(self, port, dxl_id, address, length, data):
+        return await runExchangeAsync(port, self._writeTxRx(port, dxl_id, address, length, data))
 
-        txpacket[PKT_ID] = dxl_id
-        txpacket[PKT_LENGTH] = length + 3
-        txpacket[PKT_INSTRUCTION] = INST_WRITE
-        txpacket[PKT_PARAMETER0] = address
+    def _writeTxRx(self, port, dxl_id, address, length, data):
+        txpacket = self._instruction(dxl_id, INST_WRITE, (address,), data, length)
+        if txpacket is None:
+            return COMM_TX_ERROR, 0
 
-        txpacket[PKT_PARAMETER0 + 1: PKT_PARAMETER0 + 1 + length] = data[0: length]
-        rxpacket, result, error = self.txRxPacket(port, txpacket)
+        rxpacket, result, error = yield from self._txRxPacket(port, txpacket)
 
         return result, error
 
     def write1ByteTxOnly(self, port, dxl_id, address, data):
-        data_write = [data]
+        data_write = packValue(data, 1)
         return self.writeTxOnly(port, dxl_id, address, 1, data_write)
 
     def write1ByteTxRx(self, port, dxl_id, address, data):
-        data_write = [data]
-        return self.writeTxRx(port, dxl_id, address, 1, data_write)
+        return runExchange(port, self._writeTxRx(port, dxl_id, address, 1, packValue(data, 1)))
+
+    async def write1ByteTxRxAsync(self, port, dxl_id, address, data):
+        return await runExchangeAsync(port, self._writeTxRx(port, dxl_id, address, 1, packValue(data, 1)))
 
     def write2ByteTxOnly(self, port, dxl_id, address, data):
-        data_write = [DXL_LOBYTE(data), DXL_HIBYTE(data)]
+        data_write = packValue(data, 2)
         return self.writeTxOnly(port, dxl_id, address, 2, data_write)
 
     def write2ByteTxRx(self, port, dxl_id, address, data):
-        data_write = [DXL_LOBYTE(data), DXL_HIBYTE(data)]
-        return self.writeTxRx(port, dxl_id, address, 2, data_write)
+        return runExchange(port, self._writeTxRx(port, dxl_id, address, 2, packValue(data, 2)))
+
+    async def write2ByteTxRxAsync(self, port, dxl_id, address, data):
+        return await runExchangeAsync(port, self._writeTxRx(port, dxl_id, address, 2, packValue(data, 2)))
 
     def write4ByteTxOnly(self, port, dxl_id, address, data):
-        data_write = [DXL_LOBYTE(DXL_LOWORD(data)),
-                      DXL_HIBYTE(DXL_LOWORD(data)),
-                      DXL_LOBYTE(DXL_HIWORD(data)),
-                      DXL_HIBYTE(DXL_HIWORD(data))]
+        data_write = packValue(data, 4)
         return self.writeTxOnly(port, dxl_id, address, 4, data_write)
 
     def write4ByteTxRx(self, port, dxl_id, address, data):
-        data_write = [DXL_LOBYTE(DXL_LOWORD(data)),
-                      DXL_HIBYTE(DXL_LOWORD(data)),
-                      DXL_LOBYTE(DXL_HIWORD(data)),
-                      DXL_HIBYTE(DXL_HIWORD(data))]
-        return self.writeTxRx(port, dxl_id, address, 4, data_write)
+        return runExchange(port, self._writeTxRx(port, dxl_id, address, 4, packValue(data, 4)))
 
-    def regWriteTxOnly(self, port, dxl_id, address, length, data):
-        txpacket = [0] * (length + 7)
-
-        txpacket[PKT_ID] = dxl_id
-        txpacket[PKT_LENGTH] = length + 3
-        txpacket[PKT_INSTRUCTION] = INST_REG_WRITE
-        txpacket[PKT_PARAMETER0] = address
+    async def write4ByteTxRxAsync(self, port, dxl_id, address, data):
+        return await runExchangeAsync(port, self._writeTxRx(port, dxl_id, address, 4, packValue(data, 4)))
 
-        txpacket[PKT_PARAMETER0 + 1: PKT_PARAMETER0 + 1 + length] = data[0: length]
+    def regWriteTxOnly(self, port, dxl_id, address, length, data):
+        txpacket = self._instruction(dxl_id, INST_REG_WRITE, (address,), data, length)
+        if txpacket is None:
+            return COMM_TX_ERROR
 
         result = self.txPacket(port, txpacket)
         port.is_using = False
@@ -465,14 +582,9 @@ class Protocol1PacketHandler(object):
         return result
 
     def regWriteTxRx(self, port, dxl_id, address, length, data):
-        txpacket = [0] * (length + 7)
-
-        txpacket[PKT_ID] = dxl_id
-        txpacket[PKT_LENGTH] = length + 3
-        txpacket[PKT_INSTRUCTION] = INST_REG_WRITE
-        txpacket[PKT_PARAMETER0] = address
-
-        txpacket[PKT_PARAMETER0 + 1: PKT_PARAMETER0 + 1 + length] = data[0: length]
+        txpacket = self._instruction(dxl_id, INST_REG_WRITE, (address,), data, length)
+        if txpacket is None:
+            return COMM_TX_ERROR, 0
 
         _, result, error = self.txRxPacket(port, txpacket)
 
@@ -482,31 +594,20 @@ class Protocol1PacketHandler(object):
         return COMM_NOT_AVAILABLE
 
     def syncWriteTxOnly(self, port, start_address, data_length, param, param_length):
-        txpacket = [0] * (param_length + 8)
         # 8: HEADER0 HEADER1 ID LEN INST START_ADDR DATA_LEN ... CHKSUM
-
-        txpacket[PKT_ID] = BROADCAST_ID
-        txpacket[PKT_LENGTH] = param_length + 4  # 4: INST START_ADDR DATA_LEN ... CHKSUM
-        txpacket[PKT_INSTRUCTION] = INST_SYNC_WRITE
-        txpacket[PKT_PARAMETER0 + 0] = start_address
-        txpacket[PKT_PARAMETER0 + 1] = data_length
-
-        txpacket[PKT_PARAMETER0 + 2: PKT_PARAMETER0 + 2 + param_length] = param[0: param_length]
+        txpacket = self._instruction(BROADCAST_ID, INST_SYNC_WRITE, (start_address, data_length), param, param_length)
+        if txpacket is None:
+            return COMM_TX_ERROR
 
         _, result, _ = self.txRxPacket(port, txpacket)
 
         return result
 
     def bulkReadTx(self, port, param, param_length):
-        txpacket = [0] * (param_length + 7)
         # 7: HEADER0 HEADER1 ID LEN INST 0x00 ... CHKSUM
-
-        txpacket[PKT_ID] = BROADCAST_ID
-        txpacket[PKT_LENGTH] = param_length + 3  # 3: INST 0x00 ... CHKSUM
-        txpacket[PKT_INSTRUCTION] = INST_BULK_READ
-        txpacket[PKT_PARAMETER0 + 0] = 0x00
-
-        txpacket[PKT_PARAMETER0 + 1: PKT_PARAMETER0 + 1 + param_length] = param[0: param_length]
+        txpacket = self._instruction(BROADCAST_ID, INST_BULK_READ, (0x00,), param, param_length)
+        if txpacket is None:
+            return COMM_TX_ERROR
 
         result = self.txPacket(port, txpacket)
         if result == COMM_SUCCESS:
@@ -0,0 +1,157 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+A port that plays a capture back to the packet handlers.
+
+Each ``writePort`` is matched to the next recorded TX chunk and the RX chunks recorded after it become readable at the
+same offsets they originally arrived at, divided by ``speed``. The port's clock runs on the recording's timeline, so
+packet timeouts fire exactly where they did on the stand however fast the replay runs. With ``speed=None`` nothing
+waits: recorded replies are available at once and the packet times out as soon as they run out.
+"""
+
+import asyncio
+import time
+
+from .capture import *
+from .port_handler import *
+
+
+class ReplayPortHandler(PortHandler):
+    def __init__(self, capture, speed=1.0, port_name='replay'):
+        # capture: a capture file path (rotated backups included) or an iterable of CaptureRecord
+        super().__init__(port_name)
+        if isinstance(capture, str):
+            capture = readCapture(capture)
+        self.records = list(capture)
+        if speed is not None and speed <= 0:
+            raise ValueError('speed must be positive or None, got {}'.format(speed))
+        self.speed = speed
+        self.cursor = 0  # next record to deliver
+        self.offset = 0  # bytes of records[cursor] already read
+        self.mismatches = 0  # writes that differed from the recorded TX chunk
+        self.anchor_ns = self.records[0].timestamp_ns if self.records else 0  # recorded time of the last TX
+        self.anchor_real_ns = time.monotonic_ns()
+
+    def openPort(self):
+        self.is_open = True
+        self.cursor = 0
+        self.offset = 0
+        self.skipBaudRecords()
+        self.anchor_real_ns = time.monotonic_ns()
+        return True
+
+    def closePort(self):
+        self.is_open = False
+
+    def clearPort(self):
+        pass
+
+    def setBaudRate(self, baudrate):
+        self.baudrate = baudrate
+        self.tx_time_per_byte = (1000.0 / self.baudrate) * 10.0
+        return True
+
+    def setLowLatency(self, latency_ms=LOW_LATENCY_TIMER):
+        return LatencyReport(self.port_name)
+
+    def getBytesAvailable(self):
+        now_ns = self.getRecordedTime()
+        available = 0
+        for index in range(self.cursor, len(self.records)):
+            record = self.records[index]
+            if record.direction == CAPTURE_TX or (now_ns is not None and record.timestamp_ns > now_ns):
+                break
+            if record.direction == CAPTURE_RX:
+                available += len(record.data) - (self.offset if index == self.cursor else 0)
+        return available
+
+    def readPort(self, length):
+        now_ns = self.getRecordedTime()
+        data = bytearray()
+        records = self.records
+        while len(data) < length and self.cursor < len(records):
+            record = records[self.cursor]
+            if record.direction == CAPTURE_TX:
+                break
+            if record.direction == CAPTURE_BAUD:
+                self.skipBaudRecords()
+                continue
+            if now_ns is not None and record.timestamp_ns > now_ns:
+                break
+            chunk = record.data[self.offset: self.offset + length - len(data)]
+            data += chunk
+            self.offset += len(chunk)
+            if self.offset >= len(record.data):
+                self.cursor += 1
+                self.offset = 0
+        return bytes(data)
+
+    async def readPortAsync(self, length, minimum=None):
+        if minimum is None:
+            minimum = length
+        data = bytearray(self.readPort(length))
+        while len(data) < minimum:
+            remaining = self.packet_timeout - self.getTimeSinceStart()
+            if self.speed is None or remaining <= 0:
+                break
+            delay = remaining
+            due_ns = self.getNextRxTime()
+            if due_ns is not None:
+                delay = min(delay, (due_ns - self.getRecordedTime()) / 1000000.0)
+            await asyncio.sleep(max(0.0, delay) / self.speed / 1000.0)
+            data += self.readPort(length - len(data))
+        return bytes(data)
+
+    def writePort(self, packet):
+        # 0 (a TX failure to the packet handler) once the recording has no more writes
+        while self.cursor < len(self.records) and self.records[self.cursor].direction != CAPTURE_TX:
+            if self.records[self.cursor].direction == CAPTURE_BAUD:
+                self.skipBaudRecords()
+            else:
+                self.cursor += 1
+        if self.cursor >= len(self.records):
+            return 0
+        record = self.records[self.cursor]
+        if bytes(record.data) != bytes(packet):
+            self.mismatches += 1
+        self.cursor += 1
+        self.offset = 0
+        self.anchor_ns = record.timestamp_ns
+        self.anchor_real_ns = time.monotonic_ns()
+        return len(packet)
+
+    def isPacketTimeout(self):
+        if self.speed is None:
+            return self.getNextRxTime() is None
+        return super().isPacketTimeout()
+
+    def getCurrentTime(self):
+        now_ns = self.getRecordedTime()
+        if now_ns is None:
+            # no waiting: the clock stands still at the last write
+            now_ns = self.anchor_ns
+        return now_ns / 1000000.0
+
+    def getRecordedTime(self):
+        # the recording's monotonic clock in ns, None when replaying without waiting
+        if self.speed is None:
+            return None
+        return self.anchor_ns + int((time.monotonic_ns() - self.anchor_real_ns) * self.speed)
+
+    def getNextRxTime(self):
+        # recorded time of the next unread RX chunk before the next write, or None
+        for index in range(self.cursor, len(self.records)):
+            record = self.records[index]
+            if record.direction == CAPTURE_TX:
+                return None
+            if record.direction == CAPTURE_RX:
+                return record.timestamp_ns
+        return None
+
+    def skipBaudRecords(self):
+        while self.cursor < len(self.records) and self.records[self.cursor].direction == CAPTURE_BAUD:
+            self.setBaudRate(getCaptureBaudRate(self.records[self.cursor]))
+            self.cursor += 1
+            self.offset = 0
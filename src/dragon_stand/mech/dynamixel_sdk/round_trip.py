@@ -0,0 +1,96 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+Per-servo round trip statistics used to size packet timeouts.
+
+The SDK's fixed timeout (transmit time + ``LATENCY_TIMER * 2 + 2`` ms) is sized for the worst USB adapter, so every
+servo that fails to answer costs over 30 ms. Once enough replies from a servo have been seen its timeout is taken from
+a percentile of its observed latency instead, plus the transmit time of the expected reply.
+
+A reply that misses its timeout does not throw what was learned away: the margin doubles for each timeout in a row (up
+to ``max_margin_ms``) and drops back with the next reply. While a servo keeps timing out, every ``probe_every``-th try
+waits the fixed timeout instead, so a servo that has really got slower is heard again and relearned.
+"""
+
+import collections
+
+DEFAULT_PERCENTILE = 99.0
+DEFAULT_MIN_SAMPLES = 20
+DEFAULT_WINDOW = 64
+DEFAULT_MARGIN_MS = 1.0
+DEFAULT_MAX_MARGIN_MS = 8.0
+DEFAULT_PROBE_EVERY = 8
+
+
+class RoundTripEstimator(object):
+    def __init__(self, percentile=DEFAULT_PERCENTILE, min_samples=DEFAULT_MIN_SAMPLES, window=DEFAULT_WINDOW,
+                 margin_ms=DEFAULT_MARGIN_MS, max_margin_ms=DEFAULT_MAX_MARGIN_MS, probe_every=DEFAULT_PROBE_EVERY):
+        if not 0.0 < percentile <= 100.0:
+            raise ValueError("percentile must be in (0, 100], got {}".format(percentile))
+        if min_samples < 1 or window < min_samples:
+            raise ValueError("need 1 <= min_samples <= window, got {} and {}".format(min_samples, window))
+        if max_margin_ms < margin_ms or probe_every < 1:
+            raise ValueError("need margin_ms <= max_margin_ms and probe_every >= 1, got {}, {} and {}".format(
+                margin_ms, max_margin_ms, probe_every))
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window = window
+        self.margin_ms = margin_ms
+        self.max_margin_ms = max_margin_ms
+        self.probe_every = probe_every
+        self.samples = {}
+        self.estimates = {}  # cached percentile per ID, invalidated by each new sample
+        self.timeouts = {}  # timeouts in a row per ID since its last reply
+
+    def addSample(self, dxl_id, latency_ms):
+        # latency_ms: time from the end of the instruction to the end of the status packet, minus the status
+        # packet's own transmit time
+        samples = self.samples.get(dxl_id)
+        if samples is None:
+            samples = self.samples[dxl_id] = collections.deque(maxlen=self.window)
+        samples.append(latency_ms if latency_ms > 0.0 else 0.0)
+        self.estimates.pop(dxl_id, None)
+        self.timeouts.pop(dxl_id, None)
+
+    def addTimeout(self, dxl_id):
+        # no reply came within the timeout: widen the margin of the next one rather than forgetting the samples
+        self.timeouts[dxl_id] = self.timeouts.get(dxl_id, 0) + 1
+
+    def getLatency(self, dxl_id):
+        # percentile latency in ms, or None until min_samples replies have been seen
+        estimate = self.estimates.get(dxl_id)
+        if estimate is None:
+            samples = self.samples.get(dxl_id)
+            if samples is None or len(samples) < self.min_samples:
+                return None
+            ordered = sorted(samples)
+            index = min(len(ordered) - 1, int(round(self.percentile / 100.0 * (len(ordered) - 1))))
+            estimate = self.estimates[dxl_id] = ordered[index]
+        return estimate
+
+    def getTimeout(self, dxl_id, tx_time_ms):
+        # None when the caller should wait the fixed timeout: too few samples yet, or a probe after repeated timeouts
+        latency = self.getLatency(dxl_id)
+        if latency is None:
+            return None
+        timeouts = self.timeouts.get(dxl_id, 0)
+        if timeouts and timeouts % self.probe_every == 0:
+            return None
+        margin = self.margin_ms * (1 << min(timeouts, 16))
+        return latency + tx_time_ms + (margin if margin < self.max_margin_ms else self.max_margin_ms)
+
+    def getSampleCount(self, dxl_id):
+        samples = self.samples.get(dxl_id)
+        return 0 if samples is None else len(samples)
+
+    def clear(self, dxl_id=None):
+        if dxl_id is None:
+            self.samples.clear()
+            self.estimates.clear()
+            self.timeouts.clear()
+        else:
+            self.samples.pop(dxl_id, None)
+            self.estimates.pop(dxl_id, None)
+            self.timeouts.pop(dxl_id, None)
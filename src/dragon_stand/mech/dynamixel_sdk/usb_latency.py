@@ -0,0 +1,108 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+Low-latency configuration of USB-serial adapters on Linux.
+
+FTDI chips (the U2D2 included) hold received bytes for up to ``latency_timer`` ms, 16 by default, before sending
+them to the host. That one setting dominates every round trip on the bus. The kernel exposes it as
+``/sys/bus/usb-serial/devices/<tty>/latency_timer``. Setting ``ASYNC_LOW_LATENCY`` on the tty also makes ``ftdi_sio``
+drop it to 1 ms and disables buffering in the tty layer for other drivers (CH34x, CP210x, ...).
+"""
+
+import os
+import sys
+
+USB_SERIAL_DEVICES = '/sys/bus/usb-serial/devices'
+LOW_LATENCY_TIMER = 1
+
+
+class LatencyReport(object):
+    def __init__(self, port_name):
+        self.port_name = port_name
+        self.tty = None
+        self.driver = None
+        self.latency_timer_before = None  # ms, None if the adapter has no latency timer
+        self.latency_timer_after = None
+        self.low_latency_flag = False
+        self.errors = []
+
+    def __str__(self):
+        if self.tty is None:
+            lines = ["{}: not a USB-serial adapter".format(self.port_name)]
+        else:
+            lines = ["{} ({}, driver {})".format(self.port_name, self.tty, self.driver or "unknown")]
+            if self.latency_timer_before is None:
+                lines.append("  latency timer: not available")
+            else:
+                lines.append("  latency timer: {} ms -> {} ms".format(self.latency_timer_before,
+                                                                     self.latency_timer_after))
+        lines.append("  ASYNC_LOW_LATENCY: {}".format("set" if self.low_latency_flag else "not set"))
+        for error in self.errors:
+            lines.append("  ! {}".format(error))
+        return "\n".join(lines)
+
+
+def getUsbSerialDevice(port_name):
+    # sysfs directory of the adapter behind port_name (symlinks such as /dev/serial/by-id/... are followed), or None
+    if not sys.platform.startswith('linux'):
+        return None
+    tty = os.path.basename(os.path.realpath(port_name))
+    device = os.path.join(USB_SERIAL_DEVICES, tty)
+    if not os.path.isdir(device):
+        return None
+    return device
+
+
+def getUsbSerialDriver(device):
+    driver = os.path.join(device, 'driver')
+    if not os.path.islink(driver):
+        return None
+    return os.path.basename(os.readlink(driver))
+
+
+def readLatencyTimer(device):
+    try:
+        with open(os.path.join(device, 'latency_timer')) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def writeLatencyTimer(device, latency_ms):
+    # needs write access to sysfs (root, or a udev rule granting it)
+    with open(os.path.join(device, 'latency_timer'), 'w') as f:
+        f.write(str(int(latency_ms)))
+
+
+def applyLowLatency(ser, port_name, latency_ms=LOW_LATENCY_TIMER):
+    # best effort: every step that fails is recorded in the report instead of raising
+    report = LatencyReport(port_name)
+
+    device = getUsbSerialDevice(port_name)
+    if device is not None:
+        report.tty = os.path.basename(device)
+        report.driver = getUsbSerialDriver(device)
+        report.latency_timer_before = readLatencyTimer(device)
+        if report.latency_timer_before is not None and report.latency_timer_before > latency_ms:
+            try:
+                writeLatencyTimer(device, latency_ms)
+            except OSError as e:
+                report.errors.append("could not write latency_timer: {}".format(e))
+
+    set_low_latency_mode = getattr(ser, 'set_low_latency_mode', None)
+    if set_low_latency_mode is not None:
+        try:
+            set_low_latency_mode(True)
+            report.low_latency_flag = True
+        except (ValueError, OSError) as e:
+            report.errors.append(str(e))
+    else:
+        report.errors.append("ASYNC_LOW_LATENCY is not supported on this platform")
+
+    if device is not None:
+        # read back: ASYNC_LOW_LATENCY may have changed the timer too
+        report.latency_timer_after = readLatencyTimer(device)
+
+    return report
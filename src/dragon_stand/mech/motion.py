@@ -0,0 +1,260 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+Waiting for servos to finish moving.
+
+Every servo waited on through a bus's :class:`MotionWaiter` (see :meth:`Bus.motion`) is polled by the same task: each
+tick reads Moving and Present Position from all of them with one GroupSyncRead (a bulk read on Protocol 1.0), and a
+servo's future resolves as soon as a tick finds it settled, without waiting for the others::
+
+    await asyncio.gather(pan.write_register(30, 2, 1024), tilt.write_register(30, 2, 3072))
+    settled = await bus.wait_for_motion({1: 1024, 2: 3072})
+
+The poll rate follows the motion: each servo's speed is estimated from its last two positions, and the next tick is
+scheduled at half the shortest predicted time to arrival, between ``min_interval`` and ``max_interval``. A long move
+is sampled sparsely and the end of it closely. A servo that has stopped short of its goal (stalled, or never sent
+there) is read half as often each tick it stays put, down to once per ``max_interval``.
+"""
+
+import asyncio
+import functools
+import logging
+import time
+import typing
+
+from . import dynamixel_sdk
+from .scheduler import Priority, TransactionDroppedError
+
+if typing.TYPE_CHECKING:
+    from .bus import Bus
+
+DEFAULT_TOLERANCE = 10
+"""How far (in position units) from its goal a servo may stop and still count as there."""
+
+DEFAULT_MIN_INTERVAL = 0.005
+DEFAULT_MAX_INTERVAL = 0.1
+
+_MAX_FAILURES = 3  # consecutive unanswered reads after which a servo is given up on
+_MIN_SPEED = 1.0  # position units per second below which a servo is not moving towards anything
+
+
+class _Watch:
+    __slots__ = ("goal", "tolerance", "deadline", "future")
+
+    def __init__(
+        self, goal: typing.Optional[int], tolerance: int, deadline: typing.Optional[float], future: asyncio.Future
+    ):
+        self.goal = goal
+        self.tolerance = tolerance
+        self.deadline = deadline
+        self.future = future
+
+
+class _Track:
+    # what the poller knows about one servo between ticks
+    __slots__ = ("watches", "position", "timestamp", "speed", "idle", "failures")
+
+    def __init__(self) -> None:
+        self.watches: typing.List[_Watch] = []
+        self.position: typing.Optional[int] = None
+        self.timestamp = 0.0
+        self.speed: typing.Optional[float] = None  # unknown until two positions are in
+        self.idle = 0.0  # poll interval while not moving, doubled every poll it stays that way
+        self.failures = 0
+
+
+class MotionWaiter:
+    """
+    Resolves futures as the servos of one bus come to rest. Use :meth:`Bus.motion` rather than creating one.
+    """
+
+    def __init__(
+        self, bus: "Bus", min_interval: float = DEFAULT_MIN_INTERVAL, max_interval: float = DEFAULT_MAX_INTERVAL
+    ):
+        if not 0 < min_interval <= max_interval:
+            raise ValueError("Need 0 < min_interval <= max_interval, got {} and {}".format(min_interval, max_interval))
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._bus = bus
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._tracks: typing.Dict[int, _Track] = {}
+        self._task: typing.Optional[asyncio.Task] = None
+        self.polls = 0
+        """Group reads sent."""
+
+    @property
+    def waiting(self) -> typing.List[int]:
+        """
+        Servos with a wait outstanding.
+        """
+        return list(self._tracks)
+
+    def settled(
+        self,
+        device_id: int,
+        goal: typing.Optional[int] = None,
+        tolerance: int = DEFAULT_TOLERANCE,
+        timeout: typing.Optional[float] = None,
+    ) -> "asyncio.Future[bool]":
+        """
+        A future that becomes ``True`` once servo ``device_id`` reports it is not moving (and, given a ``goal``, is
+        within ``tolerance`` of it), or ``False`` if ``timeout`` seconds pass first or the servo stops answering.
+        Cancelling the future just stops the wait.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        future = loop.create_future()
+        track = self._tracks.get(device_id)
+        if track is None:
+            track = self._tracks[device_id] = _Track()
+        track.watches.append(_Watch(goal, tolerance, deadline, future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return future
+
+    async def wait(
+        self,
+        goals: typing.Mapping[int, typing.Optional[int]],
+        tolerance: int = DEFAULT_TOLERANCE,
+        timeout: typing.Optional[float] = None,
+    ) -> typing.Dict[int, bool]:
+        """
+        Wait for every servo in ``goals`` (ID to goal position, or ``None`` to wait on the Moving flag alone) to
+        settle. Returns whether each did; see :meth:`settled`.
+        """
+        futures = {device_id: self.settled(device_id, goal, tolerance, timeout) for device_id, goal in goals.items()}
+        try:
+            results = await asyncio.gather(*futures.values())
+        finally:
+            for future in futures.values():
+                future.cancel()
+        return dict(zip(futures, results))
+
+    async def close(self) -> None:
+        """
+        Stop polling. Every outstanding wait resolves ``False``.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _span(self) -> typing.Tuple[int, int, int, int, int]:
+        # start and length of the read covering Moving and Present Position, and where each is in it
+        shadow = self._bus.shadow(next(iter(self._tracks)))
+        moving = shadow.field("moving")
+        position = shadow.field("present_position")
+        start = min(moving.address, position.address)
+        length = max(moving.address + moving.size, position.address + position.size) - start
+        return start, length, moving.address - start, position.address - start, position.size
+
+    async def _poll(
+        self, device_ids: typing.List[int], start: int, length: int, port: typing.Any, ph: typing.Any
+    ) -> typing.Any:
+        group = dynamixel_sdk.GroupSyncRead(port, ph, start, length)
+        for device_id in device_ids:
+            group.addParam(device_id)
+        await group.txRxPacketAsync()
+        return group
+
+    async def _run(self) -> None:
+        try:
+            while self._tracks:
+                await asyncio.sleep(self._next_interval())
+                self._expire(time.monotonic())
+                if not self._tracks:
+                    break
+                device_ids = list(self._tracks)
+                span = self._span()
+                try:
+                    group = await self._bus.transact(
+                        functools.partial(self._poll, device_ids, span[0], span[1]), Priority.TELEMETRY
+                    )
+                except TransactionDroppedError as e:
+                    # the poll comes round again next tick
+                    self._logger.debug("Motion poll dropped: {}".format(e))
+                    continue
+                self.polls += 1
+                self._update(group, device_ids, span, time.monotonic())
+        finally:
+            tracks, self._tracks = self._tracks, {}
+            for track in tracks.values():
+                for watch in track.watches:
+                    if not watch.future.done():
+                        watch.future.set_result(False)
+
+    def _update(
+        self, group: typing.Any, device_ids: typing.List[int], span: typing.Tuple[int, int, int, int, int], now: float
+    ) -> None:
+        start, length, moving_offset, position_offset, position_size = span
+        for device_id in device_ids:
+            track = self._tracks.get(device_id)
+            if track is None:
+                continue
+            result = group.getResult(device_id)
+            shadow = self._bus.shadow(device_id)
+            if result != dynamixel_sdk.COMM_SUCCESS or group.getError(device_id) != 0:
+                if result == dynamixel_sdk.COMM_SUCCESS:
+                    shadow.note_status(group.getError(device_id))
+                else:
+                    shadow.note_lost()
+                track.failures += 1
+                if track.failures >= _MAX_FAILURES:
+                    self._logger.debug("Servo {} stopped answering while moving".format(device_id))
+                    self._resolve(device_id, track.watches, False)
+                continue
+            data = bytes(group.data_dict[device_id][:length])
+            shadow.update(start, data)
+            track.failures = 0
+            moving = dynamixel_sdk.unpackValue(data, moving_offset, 1) != 0
+            position = int(dynamixel_sdk.unpackValue(data, position_offset, position_size))
+            if track.position is not None and now > track.timestamp:
+                track.speed = abs(position - track.position) / (now - track.timestamp)
+                if track.speed < _MIN_SPEED:
+                    track.idle = min(max(2.0 * track.idle, self._min_interval), self._max_interval)
+                else:
+                    track.idle = 0.0
+            track.position = position
+            track.timestamp = now
+            if not moving:
+                self._resolve(
+                    device_id,
+                    [w for w in track.watches if w.goal is None or abs(position - w.goal) <= w.tolerance],
+                    True,
+                )
+
+    def _expire(self, now: float) -> None:
+        for device_id, track in list(self._tracks.items()):
+            self._resolve(device_id, [w for w in track.watches if w.future.done()], False)
+            self._resolve(device_id, [w for w in track.watches if w.deadline is not None and now >= w.deadline], False)
+
+    def _resolve(self, device_id: int, watches: typing.List[_Watch], settled: bool) -> None:
+        track = self._tracks.get(device_id)
+        if track is None or not watches:
+            return
+        for watch in watches:
+            if not watch.future.done():
+                watch.future.set_result(settled)
+        track.watches = [w for w in track.watches if w not in watches]
+        if not track.watches:
+            del self._tracks[device_id]
+
+    def _next_interval(self) -> float:
+        # half the shortest predicted time to arrival, so a servo is read about twice more on its way in
+        interval = self._max_interval
+        now = time.monotonic()
+        for track in self._tracks.values():
+            for watch in track.watches:
+                if watch.deadline is not None:
+                    interval = min(interval, watch.deadline - now)
+                if track.position is None or track.speed is None:
+                    interval = min(interval, self._min_interval)
+                elif track.speed < _MIN_SPEED:
+                    interval = min(interval, track.idle)
+                elif watch.goal is None:
+                    interval = min(interval, self._min_interval)
+                else:
+                    interval = min(interval, abs(watch.goal - track.position) / track.speed / 2.0)
+        return max(interval, self._min_interval if interval > 0 else 0.0)
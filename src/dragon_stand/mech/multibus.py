@@ -0,0 +1,210 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+Several buses (one per USB-serial adapter) driven side by side, each from a thread of its own.
+
+A :class:`ThreadedBus` is a :class:`~dragon_stand.mech.bus.Bus` whose transaction queue and worker live on a private
+event loop in a dedicated I/O thread. Everything that touches its port (including the SDK's blocking calls) runs
+there, and the port's reads sleep in ``select()`` rather than polling, so a slow or stalled adapter holds up only its
+own bus and the caller's loop stays free.
+Transactions are handed over and results handed back with ``call_soon_threadsafe``. That needs no locks only because
+a transaction touches nothing but the port and packet handler it is given: everything else a bus shares between its
+users, the :class:`~dragon_stand.mech.shadow.ShadowTable` in particular, belongs to the caller's loop and is updated
+there from the transaction's result once it has been handed back.
+
+:class:`BusManager` opens, closes and addresses a set of them by name::
+
+    async with BusManager() as buses:
+        buses.add("pan_tilt", "/dev/ttyUSB0")
+        buses.add("aux", "/dev/ttyUSB1", baudrate=1000000)
+        await buses.open()
+        async with buses["pan_tilt"].servo(1) as pan, buses["aux"].servo(5) as aux:
+            await asyncio.gather(pan.home(), aux.home())
+
+A transaction runs on the bus's thread, so it must not touch the caller's asyncio objects or the bus's shadows
+directly: hand what it read back through its result (or ``loop.call_soon_threadsafe``).
+"""
+
+import asyncio
+import contextlib
+import functools
+import threading
+import types
+import typing
+
+from . import dynamixel_sdk
+from .bus import Bus, T, Transaction
+from .scheduler import Priority
+
+
+def _hand_back(caller: asyncio.AbstractEventLoop, result: asyncio.Future, inner: asyncio.Future) -> None:
+    # on the bus thread: inner is done; get its outcome to the caller's future on the caller's loop
+    caller.call_soon_threadsafe(_copy_outcome, inner, result)
+
+
+def _copy_outcome(inner: asyncio.Future, result: asyncio.Future) -> None:
+    if result.done():
+        return
+    if inner.cancelled():
+        result.cancel()
+    elif inner.exception() is not None:
+        _fail(result, typing.cast(BaseException, inner.exception()))
+    else:
+        result.set_result(inner.result())
+
+
+def _fail(result: asyncio.Future, error: BaseException) -> None:
+    if not result.done():
+        result.set_exception(error)
+
+
+class ThreadedBus(Bus):
+    """
+    A :class:`~dragon_stand.mech.bus.Bus` that runs its transactions on an I/O thread of its own (started by the first
+    :meth:`open`, stopped by the last :meth:`close`). Use it exactly like a :class:`Bus`.
+    """
+
+    def __init__(self, *args: typing.Any, **kwargs: typing.Any):
+        super().__init__(*args, **kwargs)
+        self._io_loop: typing.Optional[asyncio.AbstractEventLoop] = None
+        self._io_thread: typing.Optional[threading.Thread] = None
+
+    @property
+    def io_thread(self) -> typing.Optional[threading.Thread]:
+        return self._io_thread
+
+    async def transact(
+        self,
+        transaction: Transaction[T],
+        priority: Priority = Priority.CONTROL,
+        coalesce_key: typing.Optional[typing.Hashable] = None,
+    ) -> T:
+        io_loop = self._io_loop
+        if io_loop is None:
+            raise RuntimeError("Bus {} is not open".format(self.device_name))
+        caller = asyncio.get_running_loop()
+        result = caller.create_future()
+        io_loop.call_soon_threadsafe(self._submit, transaction, priority, coalesce_key, caller, result)
+        # not cancelled with the caller, as for Bus: a coalesced transaction may be shared
+        return typing.cast(T, await asyncio.shield(result))
+
+    def _submit(
+        self,
+        transaction: Transaction[T],
+        priority: Priority,
+        coalesce_key: typing.Optional[typing.Hashable],
+        caller: asyncio.AbstractEventLoop,
+        result: asyncio.Future,
+    ) -> None:
+        # on the bus thread
+        if self._queue is None:
+            error = RuntimeError("Bus {} is not open".format(self.device_name))
+            caller.call_soon_threadsafe(_fail, result, error)
+            return
+        inner = self._queue.submit(transaction, priority, coalesce_key)
+        inner.add_done_callback(functools.partial(_hand_back, caller, result))
+
+    async def _start_worker(self) -> None:
+        io_loop = asyncio.new_event_loop()
+        self._io_thread = threading.Thread(
+            target=io_loop.run_forever, name="bus {}".format(self.device_name), daemon=True
+        )
+        self._io_thread.start()
+        self._io_loop = io_loop
+        if isinstance(self._port_handler, dynamixel_sdk.PortHandler) and hasattr(self._port_handler.ser, "fileno"):
+            # the SDK's blocking calls wait in select() on this thread rather than spinning on the GIL
+            self._port_handler.setBlockingReads(True)
+        await self._on_io_loop(super()._start_worker())
+
+    async def _stop_worker(self) -> None:
+        io_loop, io_thread = self._io_loop, self._io_thread
+        if io_loop is None or io_thread is None:
+            return
+        try:
+            await self._on_io_loop(super()._stop_worker())
+        finally:
+            self._io_loop = None
+            self._io_thread = None
+            io_loop.call_soon_threadsafe(io_loop.stop)
+            await asyncio.get_running_loop().run_in_executor(None, io_thread.join)
+            io_loop.close()
+
+    async def _on_io_loop(self, coroutine: typing.Coroutine[typing.Any, typing.Any, T]) -> T:
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(coroutine, typing.cast(asyncio.AbstractEventLoop, self._io_loop))
+        )
+
+
+class BusManager(contextlib.AbstractAsyncContextManager):
+    """
+    A named set of :class:`ThreadedBus`. Buses can be added before or after :meth:`open`; :meth:`close` (or leaving
+    the ``async with``) closes every bus this manager opened.
+    """
+
+    def __init__(self) -> None:
+        self._buses: typing.Dict[str, ThreadedBus] = {}
+        self._opened: typing.List[ThreadedBus] = []
+
+    async def __aenter__(self) -> "BusManager":
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: typing.Optional[typing.Type[BaseException]],
+        exc: typing.Optional[BaseException],
+        exc_trace: typing.Optional[types.TracebackType],
+    ) -> None:
+        await self.close()
+
+    def __getitem__(self, name: str) -> ThreadedBus:
+        return self._buses[name]
+
+    def __iter__(self) -> typing.Iterator[str]:
+        return iter(self._buses)
+
+    def __len__(self) -> int:
+        return len(self._buses)
+
+    def items(self) -> typing.ItemsView[str, ThreadedBus]:
+        return self._buses.items()
+
+    def add(self, name: str, device_name: str, *args: typing.Any, **kwargs: typing.Any) -> ThreadedBus:
+        """
+        Create a bus for ``device_name`` (the remaining arguments are :class:`~dragon_stand.mech.bus.Bus`'s).
+
+        :raises ValueError: if ``name`` is taken or another bus already has ``device_name``.
+        """
+        if name in self._buses:
+            raise ValueError("There is already a bus called {}".format(name))
+        for other, bus in self._buses.items():
+            if bus.device_name == device_name:
+                raise ValueError("{} is already on the bus {}".format(device_name, other))
+        bus = self._buses[name] = ThreadedBus(device_name, *args, **kwargs)
+        return bus
+
+    async def open(self) -> bool:
+        """
+        Open every bus not yet open, concurrently. Returns ``False`` if any failed to open; the others stay open.
+        """
+        pending = [bus for bus in self._buses.values() if bus not in self._opened]
+        results = await asyncio.gather(*(bus.open() for bus in pending))
+        for bus, opened in zip(pending, results):
+            if opened:
+                self._opened.append(bus)
+        return all(results)
+
+    async def close(self) -> None:
+        opened, self._opened = self._opened, []
+        await asyncio.gather(*(bus.close() for bus in opened))
+
+    async def transact_all(
+        self, transactions: typing.Mapping[str, Transaction[T]], priority: Priority = Priority.CONTROL
+    ) -> typing.Dict[str, T]:
+        """
+        Run one transaction on each named bus at the same time and return their results by bus name.
+        """
+        names = list(transactions)
+        results = await asyncio.gather(*(self._buses[n].transact(transactions[n], priority) for n in names))
+        return dict(zip(names, results))
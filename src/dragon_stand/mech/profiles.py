@@ -0,0 +1,56 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+How much a servo talks back, as named profiles.
+
+Two control table fields decide what a transaction costs beyond the bytes it moves:
+
+* Return Delay Time (2 µs units) is how long the servo waits before it answers. The factory value of 250 (500 µs)
+  is more than most adapters need to turn the half-duplex line around, and it is paid on every read.
+* Status Return Level decides which instructions get a status packet at all. Below :data:`STATUS_RETURN_ALL` a write
+  is sent without waiting for an answer (``writeTxOnly``), which is fire and forget: the host only finds out whether
+  it took by reading it back.
+
+Profiles are applied by :meth:`~dragon_stand.mech._Dynamixel.apply_profile` (or at connect). Return Delay Time is in
+EEPROM on both MX and X servos, so apply a profile with torque off.
+"""
+
+import typing
+
+STATUS_RETURN_PING = 0
+"""Only PING is answered."""
+
+STATUS_RETURN_READ = 1
+"""PING and READ are answered; writes are not."""
+
+STATUS_RETURN_ALL = 2
+"""Every instruction is answered (the factory setting)."""
+
+
+class StatusProfile(typing.NamedTuple):
+    name: str
+    return_delay_time: int
+    """Return Delay Time register value, in units of 2 µs."""
+    status_return_level: int
+
+    @property
+    def return_delay_us(self) -> int:
+        return self.return_delay_time * 2
+
+    @property
+    def acknowledges_writes(self) -> bool:
+        return self.status_return_level >= STATUS_RETURN_ALL
+
+
+MAX_THROUGHPUT = StatusProfile("max-throughput", 0, STATUS_RETURN_READ)
+"""Answer immediately and only to reads. Writes cost just their own transmit time."""
+
+SAFE = StatusProfile("safe", 25, STATUS_RETURN_ALL)
+"""Every write acknowledged, with a 50 µs turnaround that suits common USB adapters."""
+
+DEBUG = StatusProfile("debug", 250, STATUS_RETURN_ALL)
+"""The factory settings: every instruction acknowledged, with wide gaps between packets for a bus analyser."""
+
+PROFILES: typing.Dict[str, StatusProfile] = {p.name: p for p in (MAX_THROUGHPUT, SAFE, DEBUG)}
@@ -0,0 +1,177 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+Priority scheduling of transactions waiting for a :class:`~dragon_stand.mech.bus.Bus`.
+"""
+import asyncio
+import collections
+import enum
+import time
+import typing
+
+
+class Priority(enum.IntEnum):
+    """
+    Transaction classes, most urgent first.
+    """
+
+    EMERGENCY = 0
+    """Torque enable/disable and anything else that must preempt motion."""
+
+    CONTROL = 1
+    """Goal position and other motion commands."""
+
+    TELEMETRY = 2
+    """Periodic state reads (e.g. present position)."""
+
+    DIAGNOSTICS = 3
+    """Pings, scans, and other best-effort traffic."""
+
+
+DEFAULT_DEADLINES: typing.Dict[Priority, typing.Optional[float]] = {
+    Priority.EMERGENCY: None,
+    Priority.CONTROL: None,
+    Priority.TELEMETRY: 0.25,
+    Priority.DIAGNOSTICS: None,
+}
+"""
+Seconds a transaction of each class may wait in the queue before it is dropped as stale. ``None`` never drops.
+"""
+
+
+class TransactionDroppedError(RuntimeError):
+    """
+    Raised to the submitter of a transaction that waited past its class deadline and was never sent.
+    """
+
+
+class _Entry:
+    __slots__ = ("transaction", "future", "enqueued", "coalesce_key")
+
+    def __init__(
+        self,
+        transaction: typing.Any,
+        future: asyncio.Future,
+        enqueued: float,
+        coalesce_key: typing.Optional[typing.Hashable],
+    ):
+        self.transaction = transaction
+        self.future = future
+        self.enqueued = enqueued
+        self.coalesce_key = coalesce_key
+
+
+class TransactionScheduler:
+    """
+    A queue of pending transactions ordered by :class:`Priority` then by submission order.
+
+    * Each class has a deadline; entries that waited longer are failed with :class:`TransactionDroppedError` instead
+      of being sent, so stale telemetry never delays fresher work.
+    * Entries submitted with a ``coalesce_key`` that matches one already waiting share that entry's future, so a burst
+      of identical reads costs one bus transaction.
+    """
+
+    def __init__(self, deadlines: typing.Optional[typing.Mapping[Priority, typing.Optional[float]]] = None):
+        self._deadlines = dict(DEFAULT_DEADLINES)
+        if deadlines is not None:
+            self._deadlines.update(deadlines)
+        self._queues: typing.List[typing.Deque[_Entry]] = [collections.deque() for _ in Priority]
+        self._pending: typing.Dict[typing.Hashable, _Entry] = {}
+        self._not_empty = asyncio.Event()
+        self._unfinished = 0
+        self._finished = asyncio.Event()
+        self._finished.set()
+        self._dropped = 0
+        self._coalesced = 0
+
+    def __len__(self) -> int:
+        return sum(len(q) for q in self._queues)
+
+    @property
+    def dropped(self) -> int:
+        """
+        Number of transactions dropped for missing their deadline.
+        """
+        return self._dropped
+
+    @property
+    def coalesced(self) -> int:
+        """
+        Number of submissions that were folded into an identical pending transaction.
+        """
+        return self._coalesced
+
+    def submit(
+        self,
+        transaction: typing.Any,
+        priority: Priority = Priority.CONTROL,
+        coalesce_key: typing.Optional[typing.Hashable] = None,
+    ) -> asyncio.Future:
+        """
+        Queue ``transaction`` and return the future its result will be delivered through.
+        """
+        if coalesce_key is not None:
+            pending = self._pending.get(coalesce_key)
+            if pending is not None and not pending.future.done():
+                self._coalesced += 1
+                return pending.future
+
+        entry = _Entry(transaction, asyncio.get_running_loop().create_future(), time.monotonic(), coalesce_key)
+        self._queues[priority].append(entry)
+        if coalesce_key is not None:
+            self._pending[coalesce_key] = entry
+        self._unfinished += 1
+        self._finished.clear()
+        self._not_empty.set()
+        return entry.future
+
+    async def get(self) -> typing.Tuple[typing.Any, asyncio.Future]:
+        """
+        Wait for the most urgent live transaction. Call :meth:`task_done` once it has run.
+        """
+        while True:
+            entry = self._pop()
+            if entry is not None:
+                return entry.transaction, entry.future
+            self._not_empty.clear()
+            await self._not_empty.wait()
+
+    def task_done(self) -> None:
+        self._unfinished -= 1
+        if self._unfinished <= 0:
+            self._unfinished = 0
+            self._finished.set()
+
+    async def join(self) -> None:
+        """
+        Wait until every submitted transaction has been run or dropped.
+        """
+        await self._finished.wait()
+
+    def _pop(self) -> typing.Optional[_Entry]:
+        now = time.monotonic()
+        for priority, queue in zip(Priority, self._queues):
+            deadline = self._deadlines.get(priority)
+            while queue:
+                entry = queue.popleft()
+                if entry.coalesce_key is not None and self._pending.get(entry.coalesce_key) is entry:
+                    del self._pending[entry.coalesce_key]
+                if entry.future.done():
+                    # cancelled by the submitter while waiting
+                    self.task_done()
+                    continue
+                if deadline is not None and now - entry.enqueued > deadline:
+                    self._dropped += 1
+                    entry.future.set_exception(
+                        TransactionDroppedError(
+                            "{} transaction dropped after waiting {:.1f} ms".format(
+                                priority.name, (now - entry.enqueued) * 1000.0
+                            )
+                        )
+                    )
+                    self.task_done()
+                    continue
+                return entry
+        return None
@@ -0,0 +1,334 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+A host-side copy of each servo's control table so the bus only carries traffic that tells us or the servo something
+new.
+
+Every byte of the shadow remembers when it was last confirmed by the servo (a read, or an acknowledged write).
+What a cached byte is good for depends on who can change the field:
+
+* :attr:`FieldKind.STATIC` fields (EEPROM: model, limits, ...) are read once and then served from the cache.
+* :attr:`FieldKind.RAM` fields are only changed by the host (goal position, torque enable, ...), so after a
+  confirmed write the shadow knows the value and writing it again is suppressed.
+* :attr:`FieldKind.VOLATILE` fields are changed by the servo itself (present position, moving, ...) and are only served
+  from the cache when the caller says how stale a value it accepts.
+
+The servo can also change "host-owned" RAM behind our back: an alarm shutdown clears torque enable and a power cycle
+resets everything. So a status packet with an alarm bit set, or a servo that stops answering, throws away everything
+but the STATIC fields.
+"""
+
+import array
+import enum
+import math
+import time
+import typing
+
+
+class FieldKind(enum.Enum):
+    STATIC = 0
+    """Stored in EEPROM; only changes when the host writes it."""
+
+    RAM = 1
+    """Volatile memory written only by the host."""
+
+    VOLATILE = 2
+    """Updated by the servo on its own."""
+
+
+class Field(typing.NamedTuple):
+    name: str
+    address: int
+    size: int
+    kind: FieldKind
+
+
+class ControlTable(typing.NamedTuple):
+    size: int
+    fields: typing.Tuple[Field, ...]
+    alarm_mask: int
+    """Status packet error bits after which the servo may have switched its torque off."""
+
+
+_S, _R, _V = FieldKind.STATIC, FieldKind.RAM, FieldKind.VOLATILE
+
+MX_CONTROL_TABLE = ControlTable(
+    74,
+    (
+        Field("model_number", 0, 2, _S),
+        Field("firmware_version", 2, 1, _S),
+        Field("id", 3, 1, _S),
+        Field("baud_rate", 4, 1, _S),
+        Field("return_delay_time", 5, 1, _S),
+        Field("cw_angle_limit", 6, 2, _S),
+        Field("ccw_angle_limit", 8, 2, _S),
+        Field("temperature_limit", 11, 1, _S),
+        Field("min_voltage_limit", 12, 1, _S),
+        Field("max_voltage_limit", 13, 1, _S),
+        Field("max_torque", 14, 2, _S),
+        Field("status_return_level", 16, 1, _S),
+        Field("alarm_led", 17, 1, _S),
+        Field("shutdown", 18, 1, _S),
+        Field("multi_turn_offset", 20, 2, _S),
+        Field("resolution_divider", 22, 1, _S),
+        Field("torque_enable", 24, 1, _R),
+        Field("led", 25, 1, _R),
+        Field("d_gain", 26, 1, _R),
+        Field("i_gain", 27, 1, _R),
+        Field("p_gain", 28, 1, _R),
+        Field("goal_position", 30, 2, _R),
+        Field("moving_speed", 32, 2, _R),
+        Field("torque_limit", 34, 2, _R),
+        Field("present_position", 36, 2, _V),
+        Field("present_speed", 38, 2, _V),
+        Field("present_load", 40, 2, _V),
+        Field("present_voltage", 42, 1, _V),
+        Field("present_temperature", 43, 1, _V),
+        Field("registered", 44, 1, _V),
+        Field("moving", 46, 1, _V),
+        Field("lock", 47, 1, _R),
+        Field("punch", 48, 2, _R),
+        Field("current", 68, 2, _V),
+        Field("torque_control_mode", 70, 1, _R),
+        Field("goal_torque", 71, 2, _R),
+        Field("goal_acceleration", 73, 1, _R),
+    ),
+    # input voltage, overheating, overload: the default alarm shutdown conditions
+    0x01 | 0x04 | 0x20,
+)
+
+X_CONTROL_TABLE = ControlTable(
+    147,
+    (
+        Field("model_number", 0, 2, _S),
+        Field("model_information", 2, 4, _S),
+        Field("firmware_version", 6, 1, _S),
+        Field("id", 7, 1, _S),
+        Field("baud_rate", 8, 1, _S),
+        Field("return_delay_time", 9, 1, _S),
+        Field("drive_mode", 10, 1, _S),
+        Field("operating_mode", 11, 1, _S),
+        Field("secondary_id", 12, 1, _S),
+        Field("protocol_type", 13, 1, _S),
+        Field("homing_offset", 20, 4, _S),
+        Field("moving_threshold", 24, 4, _S),
+        Field("temperature_limit", 31, 1, _S),
+        Field("max_voltage_limit", 32, 2, _S),
+        Field("min_voltage_limit", 34, 2, _S),
+        Field("pwm_limit", 36, 2, _S),
+        Field("current_limit", 38, 2, _S),
+        Field("velocity_limit", 44, 4, _S),
+        Field("max_position_limit", 48, 4, _S),
+        Field("min_position_limit", 52, 4, _S),
+        Field("shutdown", 63, 1, _S),
+        Field("torque_enable", 64, 1, _R),
+        Field("led", 65, 1, _R),
+        Field("status_return_level", 68, 1, _R),
+        Field("registered_instruction", 69, 1, _V),
+        Field("hardware_error_status", 70, 1, _V),
+        Field("velocity_i_gain", 76, 2, _R),
+        Field("velocity_p_gain", 78, 2, _R),
+        Field("position_d_gain", 80, 2, _R),
+        Field("position_i_gain", 82, 2, _R),
+        Field("position_p_gain", 84, 2, _R),
+        Field("feedforward_2nd_gain", 88, 2, _R),
+        Field("feedforward_1st_gain", 90, 2, _R),
+        Field("bus_watchdog", 98, 1, _R),
+        Field("goal_pwm", 100, 2, _R),
+        Field("goal_current", 102, 2, _R),
+        Field("goal_velocity", 104, 4, _R),
+        Field("profile_acceleration", 108, 4, _R),
+        Field("profile_velocity", 112, 4, _R),
+        Field("goal_position", 116, 4, _R),
+        Field("realtime_tick", 120, 2, _V),
+        Field("moving", 122, 1, _V),
+        Field("moving_status", 123, 1, _V),
+        Field("present_pwm", 124, 2, _V),
+        Field("present_current", 126, 2, _V),
+        Field("present_velocity", 128, 4, _V),
+        Field("present_position", 132, 4, _V),
+        Field("velocity_trajectory", 136, 4, _V),
+        Field("position_trajectory", 140, 4, _V),
+        Field("present_input_voltage", 144, 2, _V),
+        Field("present_temperature", 146, 1, _V),
+    ),
+    # Protocol 2.0 reports any hardware error with the alert bit
+    0x80,
+)
+
+CONTROL_TABLES: typing.Dict[float, ControlTable] = {1.0: MX_CONTROL_TABLE, 2.0: X_CONTROL_TABLE}
+
+
+class ShadowTable:
+    """
+    The shadow of one servo's control table. Addresses outside any known field are treated as
+    :attr:`FieldKind.VOLATILE`.
+    """
+
+    def __init__(self, control_table: ControlTable):
+        self._control_table = control_table
+        self._image = bytearray(control_table.size)
+        self._confirmed = array.array("d", [math.nan]) * control_table.size
+        self._kinds = [FieldKind.VOLATILE] * control_table.size
+        for field in control_table.fields:
+            for address in range(field.address, field.address + field.size):
+                self._kinds[address] = field.kind
+        self._dirty: typing.Dict[int, int] = {}
+        self.hits = 0
+        """Reads answered from the shadow."""
+        self.suppressed_writes = 0
+        """Writes dropped because the servo already held the value."""
+
+    @property
+    def control_table(self) -> ControlTable:
+        return self._control_table
+
+    def field(self, name: str) -> Field:
+        for field in self._control_table.fields:
+            if field.name == name:
+                return field
+        raise KeyError(name)
+
+    def get(self, address: int, size: int, max_staleness: typing.Optional[float] = None) -> typing.Optional[int]:
+        """
+        The cached value of ``size`` bytes at ``address``, or ``None`` if the bus has to be asked.
+
+        :param max_staleness: Seconds since the servo last confirmed every byte beyond which the cache is not trusted.
+            ``None`` trusts STATIC and RAM fields indefinitely and VOLATILE fields never.
+        """
+        data = self.get_bytes(address, size, max_staleness)
+        if data is None:
+            return None
+        return int.from_bytes(data, "little")
+
+    def get_bytes(
+        self, address: int, size: int, max_staleness: typing.Optional[float] = None
+    ) -> typing.Optional[bytes]:
+        self._check_range(address, size)
+        now = time.monotonic()
+        for i in range(address, address + size):
+            confirmed = self._confirmed[i]
+            if math.isnan(confirmed):
+                return None
+            if max_staleness is None:
+                if self._kinds[i] is FieldKind.VOLATILE:
+                    return None
+            elif now - confirmed > max_staleness:
+                return None
+        self.hits += 1
+        return bytes(self._image[address : address + size])
+
+    def update(self, address: int, data: bytes, timestamp: typing.Optional[float] = None) -> None:
+        """
+        Record ``data`` as what the servo holds at ``address`` (from a read or an acknowledged write).
+        """
+        self._check_range(address, len(data))
+        if timestamp is None:
+            timestamp = time.monotonic()
+        self._image[address : address + len(data)] = data
+        for i in range(address, address + len(data)):
+            self._confirmed[i] = timestamp
+            self._dirty.pop(i, None)
+
+    def is_redundant(self, address: int, data: bytes) -> bool:
+        """
+        Whether writing ``data`` at ``address`` would change nothing: every byte is a STATIC or RAM byte already known
+        to hold that value.
+        """
+        self._check_range(address, len(data))
+        for offset, value in enumerate(data):
+            i = address + offset
+            if self._kinds[i] is FieldKind.VOLATILE or math.isnan(self._confirmed[i]) or self._image[i] != value:
+                return False
+        return True
+
+    def get_known_ram(self, address: int, size: int) -> typing.Optional[bytes]:
+        """
+        The bytes at ``address`` if every one is a RAM byte with a confirmed value, so writing them back is harmless.
+        """
+        self._check_range(address, size)
+        for i in range(address, address + size):
+            if self._kinds[i] is not FieldKind.RAM or math.isnan(self._confirmed[i]):
+                return None
+        return bytes(self._image[address : address + size])
+
+    def acknowledges_writes(self) -> bool:
+        """
+        Whether the servo answers writes with a status packet: ``False`` only once its Status Return Level is known to
+        be below 2.
+        """
+        address = self.field("status_return_level").address
+        return math.isnan(self._confirmed[address]) or self._image[address] >= 2
+
+    def stage(self, address: int, data: bytes) -> bool:
+        """
+        Queue a write for the next flush. Returns ``False`` (and stages nothing) if it would be redundant.
+        """
+        if self.is_redundant(address, data):
+            self.suppressed_writes += 1
+            for i in range(address, address + len(data)):
+                self._dirty.pop(i, None)
+            return False
+        for offset, value in enumerate(data):
+            self._dirty[address + offset] = value
+        return True
+
+    def dirty_ranges(self) -> typing.List[typing.Tuple[int, bytes]]:
+        """
+        Staged bytes as ``(address, data)`` runs of contiguous addresses, lowest first.
+        """
+        ranges: typing.List[typing.Tuple[int, bytes]] = []
+        run = bytearray()
+        start = -1
+        for address in sorted(self._dirty):
+            if run and address != start + len(run):
+                ranges.append((start, bytes(run)))
+                run = bytearray()
+            if not run:
+                start = address
+            run.append(self._dirty[address])
+        if run:
+            ranges.append((start, bytes(run)))
+        return ranges
+
+    def discard(self, address: typing.Optional[int] = None, size: int = 0) -> None:
+        """
+        Unstage writes to ``size`` bytes at ``address``, or all of them.
+        """
+        if address is None:
+            self._dirty.clear()
+        else:
+            for i in range(address, address + size):
+                self._dirty.pop(i, None)
+
+    def invalidate(self, address: typing.Optional[int] = None, size: int = 0, keep_static: bool = False) -> None:
+        """
+        Forget what the servo holds at ``size`` bytes from ``address`` (everything if ``address`` is ``None``).
+        """
+        if address is None:
+            address, size = 0, self._control_table.size
+        self._check_range(address, size)
+        for i in range(address, address + size):
+            if not (keep_static and self._kinds[i] is FieldKind.STATIC):
+                self._confirmed[i] = math.nan
+
+    def note_status(self, error: int) -> None:
+        """
+        Look at the error byte of a status packet: after an alarm the servo may have cut its torque.
+        """
+        if error & self._control_table.alarm_mask:
+            self.invalidate(keep_static=True)
+
+    def note_lost(self) -> None:
+        """
+        The servo did not answer: it may have been power cycled, which resets everything in RAM.
+        """
+        self.invalidate(keep_static=True)
+
+    def _check_range(self, address: int, size: int) -> None:
+        if address < 0 or size < 0 or address + size > self._control_table.size:
+            raise ValueError(
+                "{} bytes at {} is outside the {} byte control table".format(size, address, self._control_table.size)
+            )
@@ -0,0 +1,361 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+Continuous sampling of servo registers into a ring buffer.
+
+A :class:`TelemetryStream` reads a set of registers from a set of servos at a fixed rate, one
+:attr:`~dragon_stand.mech.scheduler.Priority.TELEMETRY` transaction per tick, and stores every tick as a frame in
+storage allocated once when the stream is created. Consumers either iterate (``async for frame in stream``) or look at
+:attr:`TelemetryStream.latest`; neither touches the bus::
+
+    async with bus.telemetry([1, 2], rate_hz=100) as stream:
+        async for frame in stream:
+            print(frame.timestamp, frame.value(1, "present_position"))
+"""
+
+import array
+import asyncio
+import contextlib
+import logging
+import math
+import time
+import types
+import typing
+
+from . import dynamixel_sdk
+from .scheduler import Priority, TransactionDroppedError
+
+if typing.TYPE_CHECKING:
+    from .bus import Bus
+
+
+class Register(typing.NamedTuple):
+    """
+    A control table field, read as an unsigned little-endian integer.
+    """
+
+    name: str
+    address: int
+    size: int
+
+
+MX_PRESENT_POSITION = Register("present_position", 36, 2)
+MX_PRESENT_SPEED = Register("present_speed", 38, 2)
+MX_PRESENT_LOAD = Register("present_load", 40, 2)
+MX_PRESENT_VOLTAGE = Register("present_voltage", 42, 1)
+MX_PRESENT_TEMPERATURE = Register("present_temperature", 43, 1)
+MX_MOVING = Register("moving", 46, 1)
+
+X_PRESENT_CURRENT = Register("present_current", 126, 2)
+X_PRESENT_VELOCITY = Register("present_velocity", 128, 4)
+X_PRESENT_POSITION = Register("present_position", 132, 4)
+X_MOVING = Register("moving", 122, 1)
+X_PRESENT_VOLTAGE = Register("present_voltage", 144, 2)
+X_PRESENT_TEMPERATURE = Register("present_temperature", 146, 1)
+
+DEFAULT_REGISTERS: typing.Dict[float, typing.Tuple[Register, ...]] = {
+    1.0: (MX_PRESENT_POSITION, MX_PRESENT_SPEED, MX_PRESENT_LOAD),
+    2.0: (X_PRESENT_POSITION, X_PRESENT_VELOCITY, X_PRESENT_CURRENT),
+}
+"""Registers sampled when a stream is created without any, per protocol version."""
+
+DEFAULT_RATE_HZ = 50.0
+DEFAULT_CAPACITY = 256
+
+
+class TelemetryFrame:
+    """
+    One tick of a :class:`TelemetryStream`: what every servo reported. A frame is a copy, so it stays valid after the
+    ring buffer slot it came from is reused.
+    """
+
+    __slots__ = ("sequence", "timestamp", "_stream", "_values", "_valid")
+
+    def __init__(self, sequence: int, timestamp: float, stream: "TelemetryStream", values: array.array, valid: bytes):
+        self.sequence = sequence
+        """Tick number, counted from 0 when the stream started. Gaps are ticks that were missed."""
+        self.timestamp = timestamp
+        """:func:`time.monotonic` when the tick's read finished."""
+        self._stream = stream
+        self._values = values
+        self._valid = valid
+
+    def __repr__(self) -> str:
+        return "TelemetryFrame(sequence={}, timestamp={:.6f}, {})".format(
+            self.sequence, self.timestamp, {i: self.values(i) for i in self._stream.device_ids}
+        )
+
+    def value(self, device_id: int, register: str) -> typing.Optional[int]:
+        """
+        ``register``'s value on servo ``device_id``, or ``None`` if the servo did not answer this tick.
+        """
+        servo = self._stream.device_ids.index(device_id)
+        if not self._valid[servo]:
+            return None
+        return int(self._values[servo * len(self._stream.registers) + self._stream.register_index(register)])
+
+    def values(self, device_id: int) -> typing.Optional[typing.Dict[str, int]]:
+        """
+        Every register of servo ``device_id`` by name, or ``None`` if the servo did not answer this tick.
+        """
+        servo = self._stream.device_ids.index(device_id)
+        if not self._valid[servo]:
+            return None
+        count = len(self._stream.registers)
+        return {
+            r.name: int(v) for r, v in zip(self._stream.registers, self._values[servo * count : (servo + 1) * count])
+        }
+
+
+class TelemetryStream(contextlib.AbstractAsyncContextManager):
+    """
+    Samples ``registers`` from ``device_ids`` every ``1 / rate_hz`` seconds while started. The last ``capacity``
+    frames are kept; an iterator that falls further behind than that skips ahead to the oldest frame still held (and
+    :attr:`overruns` counts the frames it lost).
+
+    Every tick is one GroupSyncRead (a bulk read on Protocol 1.0) of the span covering every register requested, so
+    registers should be close together in the control table. Servos that never answer group reads are read one at a
+    time instead. Ticks are scheduled on a fixed grid; when a read takes longer than a tick the ticks it ran over are
+    skipped rather than bunched up, and counted in :attr:`missed`.
+    """
+
+    def __init__(
+        self,
+        bus: "Bus",
+        device_ids: typing.Iterable[int],
+        registers: typing.Optional[typing.Iterable[Register]] = None,
+        rate_hz: float = DEFAULT_RATE_HZ,
+        capacity: int = DEFAULT_CAPACITY,
+    ):
+        if rate_hz <= 0:
+            raise ValueError("rate_hz must be positive, got {}".format(rate_hz))
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1, got {}".format(capacity))
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._bus = bus
+        self._device_ids = list(device_ids)
+        if registers is None:
+            registers = DEFAULT_REGISTERS[bus.packet_handler.getProtocolVersion()]
+        self._registers = tuple(registers)
+        if not self._device_ids or not self._registers:
+            raise ValueError("A telemetry stream needs at least one servo and one register")
+        self._register_index = {r.name: i for i, r in enumerate(self._registers)}
+        self._span_start = min(r.address for r in self._registers)
+        self._span_length = max(r.address + r.size for r in self._registers) - self._span_start
+        self._period = 1.0 / rate_hz
+        self._capacity = capacity
+
+        width = len(self._device_ids) * len(self._registers)
+        self._width = width
+        self._timestamps = array.array("d", [math.nan]) * capacity
+        self._sequence_of = array.array("q", [0]) * capacity
+        self._values = array.array("q", [0]) * (capacity * width)
+        self._valid = bytearray(capacity * len(self._device_ids))
+        self._scratch = array.array("q", [0]) * width
+        self._scratch_valid = bytearray(len(self._device_ids))
+        self._sequence = 0  # next tick to be written
+        self._written = 0  # frames stored
+        self._next_frame: typing.Optional[asyncio.Future] = None
+        self._task: typing.Optional[asyncio.Task] = None
+        self._missed = 0
+        self._failed_reads = 0
+        self._overruns = 0
+        # whether the servos answer group reads; None until one tick has told us either way
+        self._grouped: typing.Optional[bool] = None
+
+    async def __aenter__(self) -> "TelemetryStream":
+        await self.start()
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: typing.Optional[typing.Type[BaseException]],
+        exc: typing.Optional[BaseException],
+        exc_trace: typing.Optional[types.TracebackType],
+    ) -> None:
+        await self.stop()
+
+    def __aiter__(self) -> typing.AsyncIterator[TelemetryFrame]:
+        return self.frames()
+
+    @property
+    def device_ids(self) -> typing.List[int]:
+        return self._device_ids
+
+    @property
+    def registers(self) -> typing.Tuple[Register, ...]:
+        return self._registers
+
+    @property
+    def rate_hz(self) -> float:
+        return 1.0 / self._period
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def missed(self) -> int:
+        """
+        Ticks skipped because the bus was busy or a read ran over (including reads the scheduler dropped).
+        """
+        return self._missed
+
+    @property
+    def failed_reads(self) -> int:
+        """
+        Servo reads that got no valid reply.
+        """
+        return self._failed_reads
+
+    @property
+    def overruns(self) -> int:
+        """
+        Frames iterators never saw because they fell more than ``capacity`` frames behind.
+        """
+        return self._overruns
+
+    @property
+    def latest(self) -> typing.Optional[TelemetryFrame]:
+        """
+        The most recent frame, or ``None`` before the first one.
+        """
+        if self._written == 0:
+            return None
+        return self._frame(self._written - 1)
+
+    def register_index(self, name: str) -> int:
+        return self._register_index[name]
+
+    def latest_value(self, device_id: int, register: str) -> typing.Optional[int]:
+        latest = self.latest
+        return None if latest is None else latest.value(device_id, register)
+
+    async def start(self) -> None:
+        if self.is_running:
+            return
+        self._next_frame = asyncio.get_running_loop().create_future()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        if self._next_frame is not None and not self._next_frame.done():
+            self._next_frame.cancel()
+
+    async def frames(self) -> typing.AsyncIterator[TelemetryFrame]:
+        """
+        Every frame from now on, in order, until the stream stops.
+        """
+        cursor = self._written
+        while True:
+            if cursor < self._written:
+                oldest = max(0, self._written - self._capacity)
+                if cursor < oldest:
+                    self._overruns += oldest - cursor
+                    cursor = oldest
+                yield self._frame(cursor)
+                cursor += 1
+                continue
+            if self._next_frame is None or not self.is_running:
+                return
+            try:
+                await asyncio.shield(self._next_frame)
+            except asyncio.CancelledError:
+                if not self.is_running:
+                    return
+                raise
+
+    def _frame(self, index: int) -> TelemetryFrame:
+        slot = index % self._capacity
+        servos = len(self._device_ids)
+        return TelemetryFrame(
+            int(self._sequence_of[slot]),
+            self._timestamps[slot],
+            self,
+            self._values[slot * self._width : (slot + 1) * self._width],
+            bytes(self._valid[slot * servos : (slot + 1) * servos]),
+        )
+
+    async def _read(self, port: typing.Any, ph: typing.Any) -> typing.List[typing.Tuple[int, int, typing.Any]]:
+        # (result, error, data) per servo, in device_ids order. Only talks to the bus: on a ThreadedBus this runs on
+        # the bus's thread, so the shadows and the frame are left to _collect on the stream's own loop
+        if self._grouped is not False:
+            group = dynamixel_sdk.GroupSyncRead(port, ph, self._span_start, self._span_length)
+            for device_id in self._device_ids:
+                group.addParam(device_id)
+            await group.txRxPacketAsync()
+            replies = [(group.getResult(i), group.getError(i), group.data_dict.get(i)) for i in self._device_ids]
+            if any(result == dynamixel_sdk.COMM_SUCCESS for result, _, _ in replies):
+                self._grouped = True
+            if self._grouped:
+                return replies
+        # nobody has ever answered a group read: either the bus is quiet or the servos do not take SYNC_READ/BULK_READ
+        replies = []
+        for device_id in self._device_ids:
+            data, result, error = await ph.readTxRxAsync(port, device_id, self._span_start, self._span_length)
+            replies.append((result, error, data))
+        if self._grouped is None and any(result == dynamixel_sdk.COMM_SUCCESS for result, _, _ in replies):
+            self._logger.info("Servos {} ignore group reads; reading them one at a time".format(self._device_ids))
+            self._grouped = False
+        return replies
+
+    def _collect(self, replies: typing.List[typing.Tuple[int, int, typing.Any]]) -> None:
+        # fills the scratch frame from _read's replies; copied into the ring only once the whole tick has been read
+        count = len(self._registers)
+        for servo, (device_id, (result, error, data)) in enumerate(zip(self._device_ids, replies)):
+            shadow = self._bus.shadow(device_id)
+            if result != dynamixel_sdk.COMM_SUCCESS or error != 0:
+                if result == dynamixel_sdk.COMM_SUCCESS:
+                    shadow.note_status(error)
+                else:
+                    shadow.note_lost()
+                self._scratch_valid[servo] = 0
+                self._failed_reads += 1
+                continue
+            shadow.update(self._span_start, bytes(data[: self._span_length]))
+            self._scratch_valid[servo] = 1
+            for i, register in enumerate(self._registers):
+                self._scratch[servo * count + i] = dynamixel_sdk.unpackValue(
+                    data, register.address - self._span_start, register.size
+                )
+
+    def _store(self, timestamp: float) -> None:
+        slot = self._written % self._capacity
+        servos = len(self._device_ids)
+        self._values[slot * self._width : (slot + 1) * self._width] = self._scratch
+        self._valid[slot * servos : (slot + 1) * servos] = self._scratch_valid
+        self._timestamps[slot] = timestamp
+        self._sequence_of[slot] = self._sequence
+        self._written += 1
+        next_frame = self._next_frame
+        self._next_frame = asyncio.get_running_loop().create_future()
+        if next_frame is not None and not next_frame.done():
+            next_frame.set_result(None)
+
+    async def _run(self) -> None:
+        started = time.monotonic()
+        try:
+            while True:
+                try:
+                    replies = await self._bus.transact(self._read, Priority.TELEMETRY)
+                except TransactionDroppedError as e:
+                    self._logger.debug("Telemetry tick {} dropped: {}".format(self._sequence, e))
+                    self._missed += 1
+                else:
+                    self._collect(replies)
+                    self._store(time.monotonic())
+                # next tick on the grid that has not already passed
+                now = time.monotonic()
+                next_tick = max(self._sequence + 1, math.ceil((now - started) / self._period))
+                self._missed += next_tick - self._sequence - 1
+                self._sequence = next_tick
+                await asyncio.sleep(max(0.0, started + next_tick * self._period - time.monotonic()))
+        finally:
+            if self._next_frame is not None and not self._next_frame.done():
+                self._next_frame.cancel()
@@ -0,0 +1,489 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+Time-parameterized motion for several servos, streamed as goal positions at a fixed rate.
+
+A :class:`Path` gives one joint's position (in goal position register units) as a function of time. A
+:class:`Trajectory` samples a path per servo at ``rate_hz`` into setpoint arrays once, up front, and a
+:class:`TrajectoryStream` plays it: every tick it sends all the servos their next setpoint in one broadcast SYNC WRITE
+(the packet :class:`~dragon_stand.mech.dynamixel_sdk.GroupSyncWrite` sends), with the parameters of every tick packed
+before the first one goes out::
+
+    trajectory = Trajectory(
+        {1: MinimumJerk(1024, 3072, 1.5), 2: Spline([(0.0, 2048), (0.5, 2600), (1.5, 1800)])}, rate_hz=200
+    )
+    report = await bus.play(trajectory).run()
+    if not report.ok:
+        print(report)
+
+Ticks are deadlines on a fixed grid from the first one, so lateness never accumulates. The stream wakes ahead of each
+deadline by what it has measured a send to take (queueing on the bus included), and when it falls more than a tick
+behind it skips to the current setpoint rather than playing the backlog out late. Skipped and late ticks are reported.
+The final setpoint is always sent. Setpoints a servo cannot take are clamped (see :data:`GOAL_POSITION_RANGE`).
+"""
+
+import abc
+import array
+import asyncio
+import bisect
+import contextlib
+import logging
+import math
+import time
+import types
+import typing
+
+from . import dynamixel_sdk
+from .scheduler import Priority, TransactionDroppedError
+
+if typing.TYPE_CHECKING:
+    from .bus import Bus
+
+DEFAULT_RATE_HZ = 100.0
+
+GOAL_POSITION_RANGE: typing.Dict[float, typing.Tuple[int, int]] = {1.0: (0, 4095), 2.0: (-1048575, 1048575)}
+"""
+Goal positions the servos accept, per protocol version: MX joint mode, and X extended position mode. Setpoints are
+clamped to this, or to the servo's position limits when the bus's shadow has read them.
+"""
+
+_LIMIT_FIELDS = {1.0: ("cw_angle_limit", "ccw_angle_limit"), 2.0: ("min_position_limit", "max_position_limit")}
+
+_LEAD_GAIN = 0.1  # weight of the newest send in the running estimate of how long a send takes
+
+
+class Path(abc.ABC):
+    """
+    One joint's position over ``[0, duration]`` seconds. Before 0 it is at its start; after ``duration`` it holds
+    its end.
+    """
+
+    @abc.abstractproperty
+    def duration(self) -> float:
+        pass
+
+    @abc.abstractmethod
+    def position(self, t: float) -> float:
+        pass
+
+
+class MinimumJerk(Path):
+    """
+    From ``start`` to ``goal`` in ``duration`` seconds along the fifth order polynomial that minimises jerk: smooth
+    from and to rest, with peak speed 1.875 times the average.
+    """
+
+    def __init__(self, start: float, goal: float, duration: float):
+        if duration <= 0:
+            raise ValueError("duration must be positive, got {}".format(duration))
+        self._start = start
+        self._distance = goal - start
+        self._duration = duration
+
+    @property
+    def duration(self) -> float:
+        return self._duration
+
+    def position(self, t: float) -> float:
+        tau = min(max(t / self._duration, 0.0), 1.0)
+        return self._start + self._distance * tau * tau * tau * (10.0 + tau * (-15.0 + tau * 6.0))
+
+
+class Trapezoidal(Path):
+    """
+    From ``start`` to ``goal`` in ``duration`` seconds: constant acceleration for the first ``ramp`` of the time,
+    constant speed, then constant deceleration for the last ``ramp``. A ``ramp`` of 0.5 never cruises (a triangular
+    profile).
+    """
+
+    def __init__(self, start: float, goal: float, duration: float, ramp: float = 0.25):
+        if duration <= 0:
+            raise ValueError("duration must be positive, got {}".format(duration))
+        if not 0 < ramp <= 0.5:
+            raise ValueError("ramp must be in (0, 0.5], got {}".format(ramp))
+        self._start = start
+        self._goal = goal
+        self._duration = duration
+        self._ramp_time = ramp * duration
+        self._speed = (goal - start) / (duration - self._ramp_time)
+        self._acceleration = self._speed / self._ramp_time
+
+    @classmethod
+    def limited(cls, start: float, goal: float, max_speed: float, max_acceleration: float) -> "Trapezoidal":
+        """
+        The fastest move from ``start`` to ``goal`` within ``max_speed`` (units per second) and ``max_acceleration``
+        (units per second squared).
+        """
+        if max_speed <= 0 or max_acceleration <= 0:
+            raise ValueError("max_speed and max_acceleration must be positive")
+        distance = abs(goal - start)
+        ramp_time = max_speed / max_acceleration
+        if distance <= max_speed * ramp_time:
+            # too short to reach max_speed
+            ramp_time = math.sqrt(distance / max_acceleration)
+            duration = 2.0 * ramp_time
+        else:
+            duration = distance / max_speed + ramp_time
+        if duration == 0:
+            # already there
+            return cls(start, goal, 1e-9, 0.5)
+        return cls(start, goal, duration, ramp_time / duration)
+
+    @property
+    def duration(self) -> float:
+        return self._duration
+
+    def position(self, t: float) -> float:
+        if t <= 0:
+            return self._start
+        if t >= self._duration:
+            return self._goal
+        if t < self._ramp_time:
+            return self._start + 0.5 * self._acceleration * t * t
+        remaining = self._duration - t
+        if remaining < self._ramp_time:
+            return self._goal - 0.5 * self._acceleration * remaining * remaining
+        return self._start + self._speed * (t - 0.5 * self._ramp_time)
+
+
+class Spline(Path):
+    """
+    A cubic spline through ``(time, position)`` waypoints, starting and ending at rest. Times are seconds from the
+    start of the path, strictly increasing, the first 0.
+    """
+
+    def __init__(self, waypoints: typing.Iterable[typing.Tuple[float, float]]):
+        points = list(waypoints)
+        if len(points) < 2:
+            raise ValueError("A spline needs at least two waypoints")
+        self._times = [float(t) for t, _ in points]
+        self._positions = [float(p) for _, p in points]
+        if self._times[0] != 0:
+            raise ValueError("The first waypoint must be at time 0, got {}".format(self._times[0]))
+        if any(b <= a for a, b in zip(self._times, self._times[1:])):
+            raise ValueError("Waypoint times must be strictly increasing")
+        self._moments = self._solve_moments()
+
+    @property
+    def duration(self) -> float:
+        return self._times[-1]
+
+    def position(self, t: float) -> float:
+        if t <= 0:
+            return self._positions[0]
+        if t >= self._times[-1]:
+            return self._positions[-1]
+        i = bisect.bisect_right(self._times, t) - 1
+        t0, t1 = self._times[i], self._times[i + 1]
+        y0, y1 = self._positions[i], self._positions[i + 1]
+        m0, m1 = self._moments[i], self._moments[i + 1]
+        h = t1 - t0
+        a = t1 - t
+        b = t - t0
+        return (m0 * a * a * a + m1 * b * b * b) / (6.0 * h) + (y0 / h - m0 * h / 6.0) * a + (y1 / h - m1 * h / 6.0) * b
+
+    def _solve_moments(self) -> typing.List[float]:
+        # second derivatives at the waypoints of the spline clamped to zero speed at both ends: a tridiagonal system,
+        # solved with the Thomas algorithm
+        t, y = self._times, self._positions
+        n = len(t)
+        h = [t[i + 1] - t[i] for i in range(n - 1)]
+        slope = [(y[i + 1] - y[i]) / h[i] for i in range(n - 1)]
+        lower = [0.0] + h
+        diagonal = [2.0 * h[0]] + [2.0 * (h[i - 1] + h[i]) for i in range(1, n - 1)] + [2.0 * h[-1]]
+        upper = h + [0.0]
+        rhs = [6.0 * slope[0]] + [6.0 * (slope[i] - slope[i - 1]) for i in range(1, n - 1)] + [-6.0 * slope[-1]]
+        for i in range(1, n):
+            w = lower[i] / diagonal[i - 1]
+            diagonal[i] -= w * upper[i - 1]
+            rhs[i] -= w * rhs[i - 1]
+        moments = [0.0] * n
+        moments[-1] = rhs[-1] / diagonal[-1]
+        for i in range(n - 2, -1, -1):
+            moments[i] = (rhs[i] - upper[i] * moments[i + 1]) / diagonal[i]
+        return moments
+
+
+class Trajectory:
+    """
+    ``paths`` (by servo ID) sampled every ``1 / rate_hz`` seconds, from time 0 until the longest path ends. Servos
+    whose path ends sooner hold their last position.
+    """
+
+    def __init__(self, paths: typing.Mapping[int, Path], rate_hz: float = DEFAULT_RATE_HZ):
+        if rate_hz <= 0:
+            raise ValueError("rate_hz must be positive, got {}".format(rate_hz))
+        if not paths:
+            raise ValueError("A trajectory needs at least one path")
+        self._device_ids = list(paths)
+        self._period = 1.0 / rate_hz
+        duration = max(path.duration for path in paths.values())
+        # the last tick lands on the end of the longest path (or just after it)
+        self._ticks = int(math.ceil(duration * rate_hz - 1e-9)) + 1
+        servos = len(self._device_ids)
+        self._setpoints = array.array("q", [0]) * (self._ticks * servos)
+        for servo, device_id in enumerate(self._device_ids):
+            path = paths[device_id]
+            for tick in range(self._ticks):
+                self._setpoints[tick * servos + servo] = int(round(path.position(tick * self._period)))
+
+    def __len__(self) -> int:
+        return self._ticks
+
+    @property
+    def device_ids(self) -> typing.List[int]:
+        return self._device_ids
+
+    @property
+    def rate_hz(self) -> float:
+        return 1.0 / self._period
+
+    @property
+    def period(self) -> float:
+        return self._period
+
+    @property
+    def duration(self) -> float:
+        return (self._ticks - 1) * self._period
+
+    def setpoint(self, tick: int, device_id: int) -> int:
+        return int(self._setpoints[tick * len(self._device_ids) + self._device_ids.index(device_id)])
+
+    def setpoints(self, device_id: int) -> array.array:
+        """
+        Every setpoint of servo ``device_id``, one per tick.
+        """
+        servos = len(self._device_ids)
+        return self._setpoints[self._device_ids.index(device_id) :: servos]
+
+    def outside(self, limits: typing.Mapping[int, typing.Tuple[int, int]]) -> int:
+        """
+        How many setpoints fall outside their servo's inclusive ``(low, high)`` ``limits``.
+        """
+        count = 0
+        for device_id in self._device_ids:
+            low, high = limits[device_id]
+            count += sum(1 for setpoint in self.setpoints(device_id) if not low <= setpoint <= high)
+        return count
+
+    def sync_write_params(self, size: int, limits: typing.Mapping[int, typing.Tuple[int, int]]) -> typing.List[bytes]:
+        """
+        The SYNC WRITE parameters (ID and ``size`` byte goal per servo) of every tick, each setpoint clamped to its
+        servo's inclusive ``(low, high)`` ``limits``.
+        """
+        servos = len(self._device_ids)
+        bounds = [limits[device_id] for device_id in self._device_ids]
+        return [
+            b"".join(
+                bytes((device_id,))
+                + dynamixel_sdk.packValue(
+                    min(max(self._setpoints[tick * servos + servo], bounds[servo][0]), bounds[servo][1]), size
+                )
+                for servo, device_id in enumerate(self._device_ids)
+            )
+            for tick in range(self._ticks)
+        ]
+
+
+class TrajectoryReport(typing.NamedTuple):
+    """
+    How a :class:`TrajectoryStream` kept to its deadlines.
+    """
+
+    ticks: int
+    sent: int
+    missed: typing.Tuple[int, ...]
+    """Ticks never sent: skipped because the stream had fallen behind, or their send failed."""
+    late: typing.Tuple[int, ...]
+    """Ticks sent, but more than the tolerance after their deadline."""
+    max_lateness: float
+    """Seconds, over every tick sent."""
+    elapsed: float
+    """Seconds from the first tick's deadline to the last send."""
+
+    @property
+    def ok(self) -> bool:
+        return not self.missed and not self.late
+
+
+class TrajectoryStream(contextlib.AbstractAsyncContextManager):
+    """
+    Plays a :class:`Trajectory` on ``bus`` while started (see :meth:`Bus.play`). Each tick is one
+    :attr:`~dragon_stand.mech.scheduler.Priority.CONTROL` transaction, sent without waiting for a reply.
+
+    :param tolerance: Seconds after its deadline a tick may go out and still count as on time (half a tick by default).
+    """
+
+    def __init__(self, bus: "Bus", trajectory: Trajectory, tolerance: typing.Optional[float] = None):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._bus = bus
+        self._trajectory = trajectory
+        self._tolerance = trajectory.period / 2.0 if tolerance is None else tolerance
+        goal_position = bus.shadow(trajectory.device_ids[0]).field("goal_position")
+        self._address = goal_position.address
+        self._size = goal_position.size
+        self._limits = {device_id: self._goal_limits(device_id) for device_id in trajectory.device_ids}
+        clamped = trajectory.outside(self._limits)
+        if clamped:
+            self._logger.warning(
+                "{} of {} setpoints are outside the servos' goal position limits {} and will be clamped".format(
+                    clamped, len(trajectory) * len(trajectory.device_ids), self._limits
+                )
+            )
+        self._params = trajectory.sync_write_params(self._size, self._limits)
+        self._task: typing.Optional[asyncio.Task] = None
+        self._tick = 0  # being sent
+        self._sent_at = 0.0
+        self._lead = 0.0
+        self._sent = 0
+        self._last_sent = -1
+        self._missed: typing.List[int] = []
+        self._late: typing.List[int] = []
+        self._max_lateness = 0.0
+        self._started = 0.0
+        self._finished = 0.0
+
+    async def __aenter__(self) -> "TrajectoryStream":
+        await self.start()
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: typing.Optional[typing.Type[BaseException]],
+        exc: typing.Optional[BaseException],
+        exc_trace: typing.Optional[types.TracebackType],
+    ) -> None:
+        await self.stop()
+
+    @property
+    def trajectory(self) -> Trajectory:
+        return self._trajectory
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def report(self) -> TrajectoryReport:
+        """
+        Deadlines kept and missed so far.
+        """
+        return TrajectoryReport(
+            len(self._trajectory),
+            self._sent,
+            tuple(self._missed),
+            tuple(self._late),
+            self._max_lateness,
+            self._finished - self._started,
+        )
+
+    async def start(self) -> None:
+        if self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stop sending setpoints. The servos keep the last one they got.
+        """
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    async def wait(self) -> TrajectoryReport:
+        """
+        Wait for the last setpoint to go out.
+        """
+        if self._task is not None:
+            await asyncio.shield(self._task)
+        return self.report
+
+    async def run(self) -> TrajectoryReport:
+        """
+        Play the whole trajectory and return its :attr:`report`.
+        """
+        await self.start()
+        return await self.wait()
+
+    async def _send(self, port: typing.Any, ph: typing.Any) -> int:
+        param = self._params[self._tick]
+        result = int(ph.syncWriteTxOnly(port, self._address, self._size, param, len(param)))
+        self._sent_at = time.monotonic()
+        return result
+
+    async def _run(self) -> None:
+        period = self._trajectory.period
+        last = len(self._trajectory) - 1
+        self._started = time.monotonic()
+        tick = 0
+        try:
+            while True:
+                deadline = self._started + tick * period
+                delay = deadline - self._lead - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                woke = time.monotonic()
+                self._tick = tick
+                try:
+                    result = await self._bus.transact(self._send, Priority.CONTROL)
+                except TransactionDroppedError as e:
+                    self._logger.debug("Trajectory tick {} dropped: {}".format(tick, e))
+                    result = dynamixel_sdk.COMM_PORT_BUSY
+                self._finished = time.monotonic()
+                if result != dynamixel_sdk.COMM_SUCCESS:
+                    self._missed.append(tick)
+                else:
+                    self._sent += 1
+                    self._last_sent = tick
+                    lateness = self._sent_at - deadline
+                    self._max_lateness = max(self._max_lateness, lateness)
+                    if lateness > self._tolerance:
+                        self._late.append(tick)
+                    # aim the next wake-up so the packet, not the wake-up, lands on the deadline
+                    self._lead += _LEAD_GAIN * (self._sent_at - woke - self._lead)
+                    self._lead = min(max(self._lead, 0.0), period / 2.0)
+                if tick == last:
+                    break
+                # the next tick whose deadline has not passed, but never past the final setpoint
+                now = time.monotonic()
+                next_tick = min(last, max(tick + 1, math.ceil((now - self._started) / period)))
+                self._missed.extend(range(tick + 1, next_tick))
+                tick = next_tick
+        finally:
+            self._note_goals()
+            report = self.report
+            if not report.ok:
+                self._logger.warning(
+                    "Trajectory of {} ticks at {:.0f} Hz: {} missed, {} late (worst {:.2f} ms late)".format(
+                        report.ticks,
+                        self._trajectory.rate_hz,
+                        len(report.missed),
+                        len(report.late),
+                        report.max_lateness * 1000.0,
+                    )
+                )
+
+    def _goal_limits(self, device_id: int) -> typing.Tuple[int, int]:
+        # what the goal register takes, narrowed to the servo's own position limits if the shadow has them
+        protocol_version = self._bus.packet_handler.getProtocolVersion()
+        low, high = GOAL_POSITION_RANGE[protocol_version]
+        shadow = self._bus.shadow(device_id)
+        low_field, high_field = (shadow.field(name) for name in _LIMIT_FIELDS[protocol_version])
+        low_limit = shadow.get(low_field.address, low_field.size)
+        high_limit = shadow.get(high_field.address, high_field.size)
+        # equal limits are MX wheel (0, 0) or multi-turn (4095, 4095) mode rather than a range
+        if low_limit is not None and high_limit is not None and low_limit < high_limit:
+            low, high = max(low, low_limit), min(high, high_limit)
+        return low, high
+
+    def _note_goals(self) -> None:
+        # the servos now hold the last setpoint sent, whatever the shadow thought their goal was
+        if self._last_sent < 0:
+            return
+        for device_id in self._trajectory.device_ids:
+            low, high = self._limits[device_id]
+            goal = min(max(self._trajectory.setpoint(self._last_sent, device_id), low), high)
+            self._bus.shadow(device_id).update(self._address, dynamixel_sdk.packValue(goal, self._size))
@@ -0,0 +1,16 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+A Dynamixel bus simulated on a Linux pseudo-terminal, for exercising and benchmarking the stack without servos::
+
+    with BusSimulator([SimulatedServo(1), SimulatedServo(2)]) as simulator:
+        async with Bus(simulator.port_name) as bus:
+            ...
+
+``python -m dragon_stand.sim`` runs one in the foreground and prints the device to connect to.
+"""
+
+from .device import MX_LAYOUT, X_LAYOUT, ControlTableLayout, SimulatedServo
+from .bus import BusSimulator, status_packet
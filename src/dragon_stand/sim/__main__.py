@@ -0,0 +1,53 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+Run a simulated bus until interrupted::
+
+    python -m dragon_stand.sim --ids 1 2
+    dhs servo --port /dev/pts/N scan
+"""
+
+import argparse
+import sys
+import threading
+
+from .bus import BusSimulator
+from .device import MX_LAYOUT, X_LAYOUT, SimulatedServo
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="python -m dragon_stand.sim", description=__doc__)
+    parser.add_argument("--ids", nargs="+", type=int, default=[1, 2], help="Servo ids on the bus.")
+    parser.add_argument("--protocol", type=float, choices=(1.0, 2.0), default=1.0)
+    parser.add_argument("--no-byte-timing", action="store_true", help="Reply as fast as the pty allows.")
+    parser.add_argument("--adapter-latency", type=float, default=0.0, help="Extra reply delay in milliseconds.")
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--corrupt-rate", type=float, default=0.0)
+    parser.add_argument("--noise-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    layout = X_LAYOUT if args.protocol == 2.0 else MX_LAYOUT
+    simulator = BusSimulator(
+        [SimulatedServo(device_id, layout) for device_id in args.ids],
+        byte_timing=not args.no_byte_timing,
+        adapter_latency=args.adapter_latency / 1000.0,
+        drop_rate=args.drop_rate,
+        corrupt_rate=args.corrupt_rate,
+        noise_rate=args.noise_rate,
+        seed=args.seed,
+    )
+    with simulator:
+        print(simulator.port_name, flush=True)
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+    print("{} instructions, {} replies".format(simulator.instructions, simulator.replies))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,462 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+A pseudo-terminal that behaves like a Dynamixel bus.
+"""
+
+import array
+import contextlib
+import fcntl
+import os
+import pty
+import random
+import select
+import termios
+import threading
+import time
+import tty
+import types
+import typing
+
+from ..mech import baud, dynamixel_sdk
+from .device import SimulatedServo
+
+# pyserial already knows the termios2 ioctl number for this platform
+from serial.serialposix import TCGETS2  # type: ignore
+
+_STANDARD_RATES = {
+    getattr(termios, "B{}".format(rate)): rate
+    for rate in (
+        9600,
+        19200,
+        38400,
+        57600,
+        115200,
+        230400,
+        460800,
+        500000,
+        576000,
+        921600,
+        1000000,
+        1152000,
+        2000000,
+        2500000,
+        3000000,
+        3500000,
+        4000000,
+    )
+    if hasattr(termios, "B{}".format(rate))
+}
+
+_BITS_PER_BYTE = 10  # start + 8 data + stop
+
+
+def status_packet(protocol_version: float, device_id: int, error: int, params: bytes) -> bytes:
+    """
+    A complete status packet as a servo would send it (stuffed, for Protocol 2.0).
+    """
+    if protocol_version == 2.0:
+        packet = bytearray(b"\xff\xff\xfd\x00") + bytes([device_id, 0, 0, dynamixel_sdk.INST_STATUS, error])
+        packet += params + b"\x00\x00"
+        dynamixel_sdk.packWordInto(packet, 5, len(params) + 4)
+        packet = dynamixel_sdk.stuffPacket(packet)
+        dynamixel_sdk.packWordInto(packet, len(packet) - 2, dynamixel_sdk.updateCRC(0, packet, len(packet) - 2))
+        return bytes(packet)
+    packet = bytearray(b"\xff\xff") + bytes([device_id, len(params) + 2, error]) + params + b"\x00"
+    packet[-1] = dynamixel_sdk.calcChecksum(packet, len(packet))
+    return bytes(packet)
+
+
+class _Instruction(typing.NamedTuple):
+    device_id: int
+    instruction: int
+    params: bytes
+    wire_length: int
+
+
+class BusSimulator(contextlib.AbstractContextManager):
+    """
+    Opens a pty pair and answers instruction packets written to :attr:`port_name` the way a bus of ``servos`` would, so
+    ``dynamixel_sdk.PortHandler(simulator.port_name)`` (and everything above it) works unchanged.
+
+    :param byte_timing: Hold every reply until it could have arrived on a real wire at the port's baud rate: the
+        instruction's transmit time, the servo's return delay, then the reply's own transmit time.
+    :param check_baud: Servos only hear instructions sent at (within 3% of) their configured baud rate.
+    :param adapter_latency: Extra seconds before a reply is delivered, like a USB adapter's latency timer.
+    :param drop_rate: Probability that a reply is never sent.
+    :param corrupt_rate: Probability that one bit of a reply is flipped.
+    :param noise_rate: Probability that a few random bytes are sent ahead of a reply.
+    """
+
+    def __init__(
+        self,
+        servos: typing.Iterable[SimulatedServo],
+        byte_timing: bool = True,
+        check_baud: bool = True,
+        adapter_latency: float = 0.0,
+        drop_rate: float = 0.0,
+        corrupt_rate: float = 0.0,
+        noise_rate: float = 0.0,
+        seed: typing.Optional[int] = None,
+    ):
+        self._servos = list(servos)
+        versions = {servo.layout.protocol_version for servo in self._servos}
+        if len(versions) > 1:
+            raise ValueError("Cannot mix Protocol 1.0 and Protocol 2.0 servos on one bus")
+        self._protocol_version = versions.pop() if versions else 1.0
+        self._byte_timing = byte_timing
+        self._check_baud = check_baud
+        self._adapter_latency = adapter_latency
+        self._drop_rate = drop_rate
+        self._corrupt_rate = corrupt_rate
+        self._noise_rate = noise_rate
+        self._random = random.Random(seed)
+        self._master: typing.Optional[int] = None
+        self._slave: typing.Optional[int] = None
+        self._port_name = ""
+        self._thread: typing.Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+        self.instructions = 0
+        self.replies = 0
+        self.dropped = 0
+        self.corrupted = 0
+
+    def __enter__(self) -> "BusSimulator":
+        self.start()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: typing.Optional[typing.Type[BaseException]],
+        exc: typing.Optional[BaseException],
+        exc_trace: typing.Optional[types.TracebackType],
+    ) -> None:
+        self.stop()
+
+    @property
+    def port_name(self) -> str:
+        return self._port_name
+
+    @property
+    def protocol_version(self) -> float:
+        return self._protocol_version
+
+    @property
+    def servos(self) -> typing.List[SimulatedServo]:
+        return self._servos
+
+    def servo(self, device_id: int) -> typing.Optional[SimulatedServo]:
+        for servo in self._servos:
+            if servo.device_id == device_id:
+                return servo
+        return None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self._port_name = os.ttyname(self._slave)
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="BusSimulator", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    # +-----------------------------------------------------------------------------------------------------------+
+    # | I/O thread
+    # +-----------------------------------------------------------------------------------------------------------+
+
+    def _run(self) -> None:
+        master = typing.cast(int, self._master)
+        received = bytearray()
+        while not self._stopping.is_set():
+            ready, _, _ = select.select([master], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                received += os.read(master, 4096)
+            except OSError:
+                return
+            arrived = time.perf_counter()
+            for instruction in self._frame(received):
+                self.instructions += 1
+                self._execute(instruction, arrived)
+
+    def _baudrate(self) -> int:
+        master = typing.cast(int, self._master)
+        rate = _STANDARD_RATES.get(termios.tcgetattr(master)[5])
+        if rate is None:
+            # BOTHER: a custom rate only termios2 can report
+            buffer = array.array("i", [0] * 64)
+            fcntl.ioctl(master, TCGETS2, buffer)
+            rate = buffer[10]
+        return rate
+
+    def _wire_time(self, length: int, baudrate: int) -> float:
+        if not self._byte_timing or baudrate <= 0:
+            return 0.0
+        return length * _BITS_PER_BYTE / baudrate
+
+    def _hears(self, servo: SimulatedServo, baudrate: int) -> bool:
+        if not self._check_baud:
+            return True
+        try:
+            servo_rate = baud.register_baud_rate(servo.baud_rate_value, self._protocol_version)
+        except ValueError:
+            return False
+        return abs(servo_rate - baudrate) <= baudrate * baud.BAUD_TOLERANCE
+
+    # +-----------------------------------------------------------------------------------------------------------+
+    # | framing
+    # +-----------------------------------------------------------------------------------------------------------+
+
+    def _frame(self, received: bytearray) -> typing.Iterator[_Instruction]:
+        if self._protocol_version == 2.0:
+            return self._frame_protocol2(received)
+        return self._frame_protocol1(received)
+
+    def _frame_protocol1(self, received: bytearray) -> typing.Iterator[_Instruction]:
+        # FF FF ID LEN INST PARAM... CHKSUM
+        while True:
+            start = received.find(b"\xff\xff")
+            if start < 0:
+                del received[: max(0, len(received) - 1)]
+                return
+            del received[:start]
+            if len(received) < 4:
+                return
+            length = received[3] + 4
+            if len(received) < length:
+                return
+            packet = bytes(received[:length])
+            if length < 6 or packet[-1] != dynamixel_sdk.calcChecksum(packet, length):
+                del received[:1]
+                continue
+            del received[:length]
+            yield _Instruction(packet[2], packet[4], packet[5:-1], length)
+
+    def _frame_protocol2(self, received: bytearray) -> typing.Iterator[_Instruction]:
+        # FF FF FD 00 ID LEN_L LEN_H INST PARAM... CRC_L CRC_H
+        while True:
+            start = received.find(b"\xff\xff\xfd\x00")
+            if start < 0:
+                del received[: max(0, len(received) - 3)]
+                return
+            del received[:start]
+            if len(received) < 7:
+                return
+            length = (received[5] | (received[6] << 8)) + 7
+            if len(received) < length:
+                return
+            packet = bytearray(received[:length])
+            crc = packet[-2] | (packet[-1] << 8)
+            if length < 10 or crc != dynamixel_sdk.updateCRC(0, packet, length - 2):
+                del received[:1]
+                continue
+            del received[:length]
+            packet = dynamixel_sdk.unstuffPacket(packet)
+            yield _Instruction(packet[4], packet[7], bytes(packet[8:-2]), length)
+
+    def _status(self, device_id: int, error: int, params: bytes) -> bytes:
+        return status_packet(self._protocol_version, device_id, error, params)
+
+    # +-----------------------------------------------------------------------------------------------------------+
+    # | instructions
+    # +-----------------------------------------------------------------------------------------------------------+
+
+    def _execute(self, instruction: _Instruction, arrived: float) -> None:
+        baudrate = self._baudrate()
+        listening = [servo for servo in self._servos if self._hears(servo, baudrate)]
+        if instruction.device_id == dynamixel_sdk.BROADCAST_ID:
+            targets = listening
+        else:
+            targets = [servo for servo in listening if servo.device_id == instruction.device_id]
+        if not targets:
+            return
+
+        if self._protocol_version == 2.0:
+            replies = self._execute_protocol2(instruction, targets, listening)
+        else:
+            replies = self._execute_protocol1(instruction, targets, listening)
+
+        # the servos answer one after another, each once the bus has gone quiet for its return delay
+        bus_free = arrived + self._wire_time(instruction.wire_length, baudrate)
+        for servo, status in replies:
+            start = bus_free + servo.return_delay
+            bus_free = start + self._wire_time(len(status), baudrate)
+            self._deliver(status, bus_free + self._adapter_latency)
+
+    def _unicast_reply(
+        self, instruction: _Instruction, servo: SimulatedServo, error: int, params: bytes = b""
+    ) -> typing.List[typing.Tuple[SimulatedServo, bytes]]:
+        if instruction.device_id == dynamixel_sdk.BROADCAST_ID or not servo.replies_to(instruction.instruction):
+            return []
+        return [(servo, self._status(servo.device_id, error, params))]
+
+    def _by_id(self, servos: typing.List[SimulatedServo], device_id: int) -> typing.Optional[SimulatedServo]:
+        for servo in servos:
+            if servo.device_id == device_id:
+                return servo
+        return None
+
+    def _execute_protocol1(
+        self, instruction: _Instruction, targets: typing.List[SimulatedServo], listening: typing.List[SimulatedServo]
+    ) -> typing.List[typing.Tuple[SimulatedServo, bytes]]:
+        inst, params = instruction.instruction, instruction.params
+        replies: typing.List[typing.Tuple[SimulatedServo, bytes]] = []
+
+        if inst == dynamixel_sdk.INST_SYNC_WRITE:
+            # ADDR LEN (ID DATA...)...
+            address, length = params[0], params[1]
+            for offset in range(2, len(params) - length, length + 1):
+                member = self._by_id(listening, params[offset])
+                if member is not None:
+                    member.write(address, params[offset + 1 : offset + 1 + length])
+            return replies
+
+        if inst == dynamixel_sdk.INST_BULK_READ:
+            # 00 (LEN ID ADDR)...
+            for offset in range(1, len(params) - 2, 3):
+                member = self._by_id(listening, params[offset + 1])
+                if member is not None and member.replies_to(inst):
+                    error, data = member.read(params[offset + 2], params[offset])
+                    replies.append((member, self._status(member.device_id, error, data)))
+            return replies
+
+        for servo in targets:
+            if inst == dynamixel_sdk.INST_PING:
+                replies += self._unicast_reply(instruction, servo, 0)
+            elif inst == dynamixel_sdk.INST_READ:
+                error, data = servo.read(params[0], params[1])
+                replies += self._unicast_reply(instruction, servo, error, data)
+            elif inst == dynamixel_sdk.INST_WRITE:
+                replies += self._unicast_reply(instruction, servo, servo.write(params[0], params[1:]))
+            elif inst == dynamixel_sdk.INST_REG_WRITE:
+                replies += self._unicast_reply(instruction, servo, servo.register(params[0], params[1:]))
+            elif inst == dynamixel_sdk.INST_ACTION:
+                servo.action()
+                replies += self._unicast_reply(instruction, servo, 0)
+            elif inst == dynamixel_sdk.INST_FACTORY_RESET:
+                replies += self._unicast_reply(instruction, servo, 0)
+                servo.reset(1)
+            else:
+                replies += self._unicast_reply(instruction, servo, servo.unknown_instruction())
+        return replies
+
+    def _execute_protocol2(
+        self, instruction: _Instruction, targets: typing.List[SimulatedServo], listening: typing.List[SimulatedServo]
+    ) -> typing.List[typing.Tuple[SimulatedServo, bytes]]:
+        inst, params = instruction.instruction, instruction.params
+        replies: typing.List[typing.Tuple[SimulatedServo, bytes]] = []
+
+        def word(offset: int) -> int:
+            return int(params[offset] | (params[offset + 1] << 8))
+
+        if inst == dynamixel_sdk.INST_PING and instruction.device_id == dynamixel_sdk.BROADCAST_ID:
+            for servo in sorted(listening, key=lambda s: s.device_id):
+                replies.append((servo, self._status(servo.device_id, 0, servo.ping())))
+            return replies
+
+        if inst == dynamixel_sdk.INST_SYNC_READ:
+            # ADDR(2) LEN(2) ID...
+            address, length = word(0), word(2)
+            for device_id in params[4:]:
+                member = self._by_id(listening, device_id)
+                if member is not None and member.replies_to(inst):
+                    error, data = member.read(address, length)
+                    replies.append((member, self._status(member.device_id, error, data)))
+            return replies
+
+        if inst == dynamixel_sdk.INST_SYNC_WRITE:
+            # ADDR(2) LEN(2) (ID DATA...)...
+            address, length = word(0), word(2)
+            for offset in range(4, len(params) - length, length + 1):
+                member = self._by_id(listening, params[offset])
+                if member is not None:
+                    member.write(address, params[offset + 1 : offset + 1 + length])
+            return replies
+
+        if inst == dynamixel_sdk.INST_BULK_READ:
+            # (ID ADDR(2) LEN(2))...
+            for offset in range(0, len(params) - 4, 5):
+                member = self._by_id(listening, params[offset])
+                if member is not None and member.replies_to(inst):
+                    error, data = member.read(word(offset + 1), word(offset + 3))
+                    replies.append((member, self._status(member.device_id, error, data)))
+            return replies
+
+        if inst == dynamixel_sdk.INST_BULK_WRITE:
+            # (ID ADDR(2) LEN(2) DATA...)...
+            offset = 0
+            while offset + 5 <= len(params):
+                length = word(offset + 3)
+                member = self._by_id(listening, params[offset])
+                if member is not None:
+                    member.write(word(offset + 1), params[offset + 5 : offset + 5 + length])
+                offset += 5 + length
+            return replies
+
+        for servo in targets:
+            if inst == dynamixel_sdk.INST_PING:
+                replies += self._unicast_reply(instruction, servo, 0, servo.ping())
+            elif inst == dynamixel_sdk.INST_READ:
+                error, data = servo.read(word(0), word(2))
+                replies += self._unicast_reply(instruction, servo, error, data)
+            elif inst == dynamixel_sdk.INST_WRITE:
+                replies += self._unicast_reply(instruction, servo, servo.write(word(0), params[2:]))
+            elif inst == dynamixel_sdk.INST_REG_WRITE:
+                replies += self._unicast_reply(instruction, servo, servo.register(word(0), params[2:]))
+            elif inst == dynamixel_sdk.INST_ACTION:
+                servo.action()
+                replies += self._unicast_reply(instruction, servo, 0)
+            elif inst in (dynamixel_sdk.INST_REBOOT, dynamixel_sdk.INST_CLEAR):
+                replies += self._unicast_reply(instruction, servo, 0)
+            elif inst == dynamixel_sdk.INST_FACTORY_RESET:
+                replies += self._unicast_reply(instruction, servo, 0)
+                # 0xFF resets everything, 0x01 keeps the ID, 0x02 keeps the ID and baud rate
+                baud_rate_value = servo.baud_rate_value
+                servo.reset(servo.device_id if params and params[0] in (0x01, 0x02) else 1)
+                if params and params[0] == 0x02:
+                    servo.table[servo.layout.baud_rate_address] = baud_rate_value
+            else:
+                replies += self._unicast_reply(instruction, servo, servo.unknown_instruction())
+        return replies
+
+    # +-----------------------------------------------------------------------------------------------------------+
+    # | delivery
+    # +-----------------------------------------------------------------------------------------------------------+
+
+    def _deliver(self, status: bytes, at: float) -> None:
+        rng = self._random
+        if self._drop_rate and rng.random() < self._drop_rate:
+            self.dropped += 1
+            return
+        if self._corrupt_rate and rng.random() < self._corrupt_rate:
+            corrupted = bytearray(status)
+            corrupted[rng.randrange(len(corrupted))] ^= 1 << rng.randrange(8)
+            status = bytes(corrupted)
+            self.corrupted += 1
+        if self._noise_rate and rng.random() < self._noise_rate:
+            status = bytes(rng.randrange(256) for _ in range(rng.randint(1, 8))) + status
+
+        delay = at - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            os.write(typing.cast(int, self._master), status)
+        except OSError:
+            return
+        self.replies += 1
@@ -0,0 +1,244 @@
+#
+# Copyright (C) 2023 Scott Dixon
+# This software is distributed under the terms of the MIT License.
+#
+"""
+Control table and instruction semantics of one simulated Dynamixel. Nothing here does I/O; the
+:class:`~dragon_stand.sim.bus.BusSimulator` frames packets and decides when replies go out.
+"""
+
+import time
+import typing
+
+from ..mech import dynamixel_sdk
+
+
+class ControlTableLayout(typing.NamedTuple):
+    """
+    Where a servo model keeps the registers the simulator gives behaviour to.
+    """
+
+    protocol_version: float
+    size: int
+    model_number: int
+    model_number_address: int
+    firmware_version_address: int
+    id_address: int
+    baud_rate_address: int
+    return_delay_time_address: int
+    status_return_level_address: int
+    torque_enable_address: int
+    goal_position_address: int
+    present_position_address: int
+    position_size: int
+    moving_address: int
+    default_baud_rate_value: int
+
+
+MX_LAYOUT = ControlTableLayout(
+    protocol_version=1.0,
+    size=74,
+    model_number=310,  # MX-64
+    model_number_address=0,
+    firmware_version_address=2,
+    id_address=3,
+    baud_rate_address=4,
+    return_delay_time_address=5,
+    status_return_level_address=16,
+    torque_enable_address=24,
+    goal_position_address=30,
+    present_position_address=36,
+    position_size=2,
+    moving_address=46,
+    default_baud_rate_value=34,  # 57600
+)
+"""Protocol 1.0 MX series, as on the stand."""
+
+X_LAYOUT = ControlTableLayout(
+    protocol_version=2.0,
+    size=147,
+    model_number=1020,  # XM430-W350
+    model_number_address=0,
+    firmware_version_address=6,
+    id_address=7,
+    baud_rate_address=8,
+    return_delay_time_address=9,
+    status_return_level_address=68,
+    torque_enable_address=64,
+    goal_position_address=116,
+    present_position_address=132,
+    position_size=4,
+    moving_address=122,
+    default_baud_rate_value=1,  # 57600
+)
+"""Protocol 2.0 X series."""
+
+# status return levels
+STATUS_PING_ONLY = 0
+STATUS_READ_ONLY = 1
+STATUS_ALL = 2
+
+# error byte values
+_P1_ERRBIT_RANGE = 8
+_P1_ERRBIT_INSTRUCTION = 64
+_P2_ERR_INSTRUCTION = 0x02
+_P2_ERR_ACCESS = 0x07
+
+
+class SimulatedServo:
+    """
+    A servo's control table plus just enough physics to be useful: with torque enabled the present position slews
+    towards the goal position at ``speed`` ticks per second and the moving flag is set until it gets there.
+    """
+
+    def __init__(
+        self,
+        device_id: int,
+        layout: ControlTableLayout = MX_LAYOUT,
+        firmware_version: int = 41,
+        speed: float = 2000.0,
+        position: int = 2048,
+    ):
+        self._layout = layout
+        self._firmware_version = firmware_version
+        self._speed = speed
+        self._table = bytearray(layout.size)
+        self._registered: typing.Optional[typing.Tuple[int, bytes]] = None
+        self._last_update = time.monotonic()
+        self._position = float(position)
+        self.reset(device_id)
+
+    @property
+    def layout(self) -> ControlTableLayout:
+        return self._layout
+
+    @property
+    def table(self) -> bytearray:
+        """
+        The raw control table. Tests may poke it directly.
+        """
+        return self._table
+
+    @property
+    def device_id(self) -> int:
+        return self._table[self._layout.id_address]
+
+    @property
+    def baud_rate_value(self) -> int:
+        return self._table[self._layout.baud_rate_address]
+
+    @property
+    def return_delay(self) -> float:
+        """
+        Seconds between the end of an instruction and the start of the reply (2 µs per unit).
+        """
+        return self._table[self._layout.return_delay_time_address] * 2e-6
+
+    @property
+    def status_return_level(self) -> int:
+        return self._table[self._layout.status_return_level_address]
+
+    def reset(self, device_id: typing.Optional[int] = None) -> None:
+        """
+        Factory defaults, keeping the current ID unless ``device_id`` is given.
+        """
+        layout = self._layout
+        device_id = self.device_id if device_id is None else device_id
+        self._table[:] = bytes(layout.size)
+        self._put(layout.model_number_address, 2, layout.model_number)
+        self._table[layout.firmware_version_address] = self._firmware_version
+        self._table[layout.id_address] = device_id
+        self._table[layout.baud_rate_address] = layout.default_baud_rate_value
+        self._table[layout.return_delay_time_address] = 250
+        self._table[layout.status_return_level_address] = STATUS_ALL
+        position = int(self._position)
+        self._put(layout.goal_position_address, layout.position_size, position)
+        self._put(layout.present_position_address, layout.position_size, position)
+
+    def replies_to(self, instruction: int) -> bool:
+        """
+        Whether a unicast ``instruction`` gets a status packet at the current status return level.
+        """
+        level = self.status_return_level
+        if instruction == dynamixel_sdk.INST_PING:
+            return True
+        if instruction in (dynamixel_sdk.INST_READ, dynamixel_sdk.INST_SYNC_READ, dynamixel_sdk.INST_BULK_READ):
+            return level >= STATUS_READ_ONLY
+        return level >= STATUS_ALL
+
+    def ping(self) -> bytes:
+        if self._layout.protocol_version == 2.0:
+            return bytes(self._table[0:2]) + bytes([self._table[self._layout.firmware_version_address]])
+        return b""
+
+    def read(self, address: int, length: int) -> typing.Tuple[int, bytes]:
+        """
+        ``(error, data)`` for a read of ``length`` bytes at ``address``.
+        """
+        if address < 0 or length < 0 or address + length > len(self._table):
+            return self._access_error(), b""
+        self._update()
+        return 0, bytes(self._table[address : address + length])
+
+    def write(self, address: int, data: bytes) -> int:
+        """
+        Apply a write and return the error byte for its status packet.
+        """
+        if address < 0 or address + len(data) > len(self._table):
+            return self._access_error()
+        self._update()
+        self._table[address : address + len(data)] = data
+        return 0
+
+    def register(self, address: int, data: bytes) -> int:
+        """
+        REG_WRITE: hold the write until ACTION.
+        """
+        if address < 0 or address + len(data) > len(self._table):
+            return self._access_error()
+        self._registered = (address, bytes(data))
+        return 0
+
+    def action(self) -> None:
+        if self._registered is not None:
+            self.write(*self._registered)
+            self._registered = None
+
+    def unknown_instruction(self) -> int:
+        if self._layout.protocol_version == 2.0:
+            return _P2_ERR_INSTRUCTION
+        return _P1_ERRBIT_INSTRUCTION
+
+    def _access_error(self) -> int:
+        if self._layout.protocol_version == 2.0:
+            return _P2_ERR_ACCESS
+        return _P1_ERRBIT_RANGE
+
+    def _get(self, address: int, length: int) -> int:
+        return int.from_bytes(self._table[address : address + length], "little")
+
+    def _put(self, address: int, length: int, value: int) -> None:
+        self._table[address : address + length] = (value & ((1 << (8 * length)) - 1)).to_bytes(length, "little")
+
+    def _update(self) -> None:
+        layout = self._layout
+        now = time.monotonic()
+        elapsed = now - self._last_update
+        self._last_update = now
+
+        present = self._get(layout.present_position_address, layout.position_size)
+        if present != int(round(self._position)):
+            # someone wrote the register directly
+            self._position = float(present)
+        goal = self._get(layout.goal_position_address, layout.position_size)
+        if self._table[layout.torque_enable_address]:
+            step = self._speed * elapsed
+            if abs(goal - self._position) <= step:
+                self._position = float(goal)
+            else:
+                self._position += step if goal > self._position else -step
+        position = int(round(self._position))
+        self._put(layout.present_position_address, layout.position_size, position)
+        self._table[layout.moving_address] = (
+            1 if (self._table[layout.torque_enable_address] and position != goal) else 0
+        )